@@ -1,13 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+import io
+import json
 import mock
 import os
 import pathlib
+import requests
 import shutil
+import tarfile
+import threading
 import time
+import zipfile
 from tests import base
 from girder import config
-from girder.constants import TokenScope
+from girder.constants import AccessType, TokenScope
+from girder.exceptions import AccessException
 from girder.models.api_key import ApiKey
 from girder.models.folder import Folder
 from girder.models.setting import Setting
@@ -541,6 +549,16 @@ class IntegrationTestCase(base.TestCase):
             self.assertFalse(adapter.exists(name),
                              msg='(%s) File should not exist: %s' % (adapter.name, name))
 
+    def waitForSharding(self, realm):
+        for i in range(100):
+            resp = self.request(path='/homedirs/sharding', method='GET', user=self.admin)
+            self.assertStatusOk(resp)
+            status = resp.json[realm]['migration']
+            if status['status'] not in ('waiting', 'running'):
+                return status
+            time.sleep(0.1)
+        self.fail('The sharding of %s did not change in time' % realm)
+
     def test00FolderCreateRemoveDav(self):
         self.forallapps(self._testFolderCreateRemoveDav)
 
@@ -848,6 +866,1003 @@ class IntegrationTestCase(base.TestCase):
         workspace = Folder().load(workspace["_id"], force=True)
         self.assertEqual(workspace, None)
 
+    def test16SharedLocks(self):
+        from wsgidav.dav_error import DAVError
+        from wsgidav.lock_manager import LockManager
+        from girder.plugins.wt_home_dir.lib.WTLockStorage import WTLockStorage
+
+        app = self.homeDirsApps.getApp('homes').app
+        lockManager = app.providerMap['/']['provider'].lockManager
+        storage = lockManager.storage
+        self.assertIsInstance(storage, WTLockStorage)
+
+        path = '/{login}/locked'.format(**self.user)
+        lock = lockManager.acquire(path, 'write', 'exclusive', 'infinity', b'<owner/>', 100,
+                                   self.user['login'], None)
+        # a second manager on the same database plays the role of another process
+        otherManager = LockManager(WTLockStorage(storage._storagePath))
+        self.assertEqual(otherManager.getLock(lock['token'], 'root'), path)
+        self.assertEqual(len(otherManager.getIndirectUrlLockList(path + '/a/b')), 1)
+        with self.assertRaises(DAVError):
+            otherManager.acquire(path + '/a', 'write', 'exclusive', '0', b'<owner/>', 100,
+                                 self.admin['login'], None)
+        # the storage checks again, for processes that race past the check of their manager
+        with self.assertRaises(DAVError) as ctx:
+            otherManager.storage.create(path + '/a', {
+                'type': 'write', 'scope': 'shared', 'depth': '0', 'owner': b'<owner/>',
+                'principal': self.admin['login'], 'timeout': 100})
+        self.assertEqual(ctx.exception.value, 423)
+        otherManager.release(lock['token'])
+        self.assertFalse(lockManager.isUrlLocked(path))
+
+    def test17ArchiveDownload(self):
+        baseUrl = 'http://127.0.0.1:%s' % os.environ['GIRDER_PORT']
+        root = '/homes/%s' % self.user['login']
+        url = baseUrl + root
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        with WebDAVFS(baseUrl, login=auth[0], password=auth[1], root=root) as handle:
+            handle.makedirs('dir/sub')
+            handle.writetext('dir/a.txt', FILE_CONTENTS)
+            handle.writebytes('dir/sub/b.gz', b'not really gzipped')
+
+        resp = requests.get(url + '/dir', params={'archive': 'zip'}, auth=auth)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(resp.content)) as zf:
+            self.assertEqual(zf.read('dir/a.txt').decode(), FILE_CONTENTS)
+            self.assertEqual(zf.getinfo('dir/a.txt').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(zf.getinfo('dir/sub/b.gz').compress_type, zipfile.ZIP_STORED)
+
+        resp = requests.get(url + '/dir', params={'archive': 'tgz'}, auth=auth)
+        self.assertEqual(resp.status_code, 200)
+        with tarfile.open(fileobj=io.BytesIO(resp.content)) as tf:
+            self.assertEqual(sorted(tf.getnames()),
+                             ['dir/a.txt', 'dir/sub', 'dir/sub/b.gz'])
+            self.assertEqual(tf.extractfile('dir/sub/b.gz').read(), b'not really gzipped')
+
+        resp = requests.get(url + '/dir', params={'archive': 'rar'}, auth=auth)
+        self.assertEqual(resp.status_code, 400)
+        # archives are subject to the same authorization as the collection
+        resp = requests.get('%s/homes/%s/dir' % (baseUrl, self.admin['login']),
+                            params={'archive': 'zip'}, auth=auth)
+        self.assertEqual(resp.status_code, 401)
+
+    def test18ArchiveUpload(self):
+        taleId = str(self.privateTale['_id'])
+        url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'], taleId)
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as tf:
+            for name in ('data/a.txt', 'data/sub/b.txt', '../escape.txt'):
+                info = tarfile.TarInfo(name)
+                info.size = len(FILE_CONTENTS)
+                tf.addfile(info, io.BytesIO(FILE_CONTENTS.encode()))
+        resp = requests.put(url, params={'extract': 'auto'}, data=data.getvalue(), auth=auth)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json()['files'], 2)
+        self.assertEqual(resp.json()['skippedNames'], ['../escape.txt'])
+
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, mode='w') as zf:
+            zf.writestr('data/c.txt', FILE_CONTENTS)
+        resp = requests.post(url + '/data', params={'extract': 'zip'}, data=data.getvalue(),
+                             auth=auth)
+        self.assertEqual(resp.status_code, 201)
+
+        entry = self.homeDirsApps.getApp('tales')
+        self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+        for name in ('data/a.txt', 'data/sub/b.txt', 'data/data/c.txt'):
+            self.ensureIsFile(name, len(FILE_CONTENTS))
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.fsAdapter.root),
+                                                     'escape.txt')))
+
+        resp = requests.put(url + '/missing', params={'extract': 'zip'},
+                            data=data.getvalue(), auth=auth)
+        self.assertEqual(resp.status_code, 409)
+
+        # locked files are not overwritten
+        resp = requests.request('LOCK', url + '/data/a.txt', auth=auth,
+                                data='<?xml version="1.0"?><lockinfo xmlns="DAV:">'
+                                     '<lockscope><exclusive/></lockscope>'
+                                     '<locktype><write/></locktype></lockinfo>')
+        self.assertEqual(resp.status_code, 200)
+        lockToken = resp.headers['Lock-Token']
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tf:
+            info = tarfile.TarInfo('data/a.txt')
+            tf.addfile(info, io.BytesIO(b''))
+        resp = requests.put(url, params={'extract': 'tar'}, data=data.getvalue(), auth=auth)
+        self.assertEqual(resp.status_code, 423)
+        self.ensureIsFile('data/a.txt', len(FILE_CONTENTS))
+        resp = requests.request('UNLOCK', url + '/data/a.txt', auth=auth,
+                                headers={'Lock-Token': lockToken})
+        self.assertEqual(resp.status_code, 204)
+
+        # tar archives expanding past the free space are refused
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as tf:
+            info = tarfile.TarInfo('data/zeros.bin')
+            info.size = 1024 * 1024
+            tf.addfile(info, io.BytesIO(bytes(info.size)))
+        from girder.plugins.wt_home_dir.lib.ArchiveExtractor import ArchiveExtractor
+        with mock.patch.object(ArchiveExtractor, '_freeSpace', return_value=65536):
+            resp = requests.put(url, params={'extract': 'tgz'}, data=data.getvalue(),
+                                auth=auth)
+        self.assertEqual(resp.status_code, 507)
+        self.ensureNotExists('data/zeros.bin')
+
+    def test19ResumableUpload(self):
+        taleId = str(self.privateTale['_id'])
+        url = 'http://127.0.0.1:%s/tales/%s/big.bin' % (os.environ['GIRDER_PORT'], taleId)
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        data = os.urandom(3000)
+
+        def put(start, end):
+            return requests.put(url, data=data[start:end], auth=auth, headers={
+                'Content-Range': 'bytes %d-%d/%d' % (start, end - 1, len(data))})
+
+        resp = put(0, 1000)
+        self.assertEqual(resp.status_code, 308)
+        self.assertEqual(resp.headers['Range'], 'bytes=0-999')
+        # a chunk past the current offset is rejected
+        resp = put(2000, 3000)
+        self.assertEqual(resp.status_code, 409)
+        resp = requests.put(url, auth=auth, headers={'Content-Range': 'bytes */3000'})
+        self.assertEqual(resp.status_code, 308)
+        self.assertEqual(resp.headers['Range'], 'bytes=0-999')
+        # probing with another size does not restart the upload
+        resp = requests.put(url, auth=auth, headers={'Content-Range': 'bytes */5000'})
+        self.assertEqual(resp.status_code, 308)
+        self.assertNotIn('Range', resp.headers)
+        resp = requests.put(url, auth=auth, headers={'Content-Range': 'bytes */3000'})
+        self.assertEqual(resp.headers['Range'], 'bytes=0-999')
+        # overlapping retransmission
+        resp = put(500, 2000)
+        self.assertEqual(resp.status_code, 308)
+        self.assertEqual(resp.headers['Range'], 'bytes=0-1999')
+
+        entry = self.homeDirsApps.getApp('tales')
+        self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+        self.assertFalse(os.path.exists(os.path.join(self.fsAdapter.root, 'big.bin')))
+
+        resp = put(2000, 3000)
+        self.assertEqual(resp.status_code, 201)
+        with open(os.path.join(self.fsAdapter.root, 'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        resp = requests.put(url, data=b'x', auth=auth,
+                            headers={'Content-Range': 'bytes 5-4/10'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test20WorkspaceManifest(self):
+        baseUrl = 'http://127.0.0.1:%s' % os.environ['GIRDER_PORT']
+        root = '/tales/%s' % self.privateTale['_id']
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        workspaceId = str(self.privateTale['workspaceId'])
+        with WebDAVFS(baseUrl, login=auth[0], password=auth[1], root=root) as handle:
+            handle.makedirs('dir/sub')
+            handle.writetext('dir/a.txt', FILE_CONTENTS)
+            handle.writetext('dir/sub/b.txt', FILE_CONTENTS)
+            handle.writetext('c.txt', 'c')
+
+        resp = self.request(path='/homedirs/%s/size' % workspaceId, user=self.user)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['files'], 3)
+        self.assertEqual(resp.json['size'], 2 * len(FILE_CONTENTS) + 1)
+
+        resp = self.request(path='/homedirs/%s/manifest' % workspaceId, user=self.user)
+        self.assertStatusOk(resp)
+        self.assertEqual([e['path'] for e in resp.json], ['c.txt', 'dir/a.txt', 'dir/sub/b.txt'])
+        since = max(e['updated'] for e in resp.json)
+
+        time.sleep(0.1)
+        with WebDAVFS(baseUrl, login=auth[0], password=auth[1], root=root) as handle:
+            handle.move('c.txt', 'dir/c.txt')
+            handle.removetree('dir/sub')
+        # files changed behind the back of the DAV server are found by rescans
+        entry = self.homeDirsApps.getApp('tales')
+        self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+        with open(os.path.join(self.fsAdapter.root, 'd.txt'), 'w') as f:
+            f.write('d')
+        resp = self.request(path='/homedirs/%s/rescan' % workspaceId, method='PUT',
+                            user=self.user)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'changed': 1, 'removed': 0})
+
+        resp = self.request(path='/homedirs/%s/manifest' % workspaceId, user=self.user,
+                            params={'since': since})
+        self.assertStatusOk(resp)
+        changes = {e['path']: e['deleted'] for e in resp.json}
+        self.assertEqual(changes, {'c.txt': True, 'dir/c.txt': False, 'dir/sub/b.txt': True,
+                                   'd.txt': False})
+
+        resp = self.request(path='/homedirs/%s/size' % workspaceId, user=self.user)
+        self.assertEqual(resp.json['files'], 3)
+
+    def test21Dedup(self):
+        from girder.plugins.wt_home_dir.constants import CAS_DIR
+        from girder.plugins.wt_home_dir.lib.ContentStore import ContentStore
+
+        entry = self.homeDirsApps.getApp('tales')
+        provider = entry.app.providerMap['/']['provider']
+        store = ContentStore(os.path.join(provider.rootFolderPath, CAS_DIR), minSize=0)
+        provider.contentStore = store
+        try:
+            url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'],
+                                                    self.privateTale['_id'])
+            auth = (self.user['login'], 'token:%s' % self.token['_id'])
+            for name in ('a.txt', 'b.txt'):
+                resp = requests.put('%s/%s' % (url, name), data=FILE_CONTENTS, auth=auth)
+                self.assertEqual(resp.status_code, 201)
+            self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+            pathA = os.path.join(self.fsAdapter.root, 'a.txt')
+            pathB = os.path.join(self.fsAdapter.root, 'b.txt')
+            # copies share data blocks at most, never the inode
+            self.assertNotEqual(os.stat(pathA).st_ino, os.stat(pathB).st_ino)
+            self.assertEqual(os.stat(pathA).st_nlink, 1)
+            blobs = sum(len(names) for _, _, names in os.walk(store.root))
+            self.assertEqual(blobs, 1 if store.supported else 0)
+
+            # so are completed resumable uploads
+            size = len(FILE_CONTENTS)
+            with mock.patch.object(store, 'addFile', wraps=store.addFile) as addFile:
+                resp = requests.put(url + '/c.txt', data=FILE_CONTENTS, auth=auth, headers={
+                    'Content-Range': 'bytes 0-%d/%d' % (size - 1, size)})
+                self.assertEqual(resp.status_code, 201)
+            if store.supported:
+                self.assertEqual(addFile.call_args[0][1],
+                                 hashlib.sha256(FILE_CONTENTS.encode()).hexdigest())
+            self.assertEqual(sum(len(names) for _, _, names in os.walk(store.root)), blobs)
+
+            # writing to one of the copies, even in place, leaves the other alone
+            resp = requests.put(url + '/b.txt', data='changed', auth=auth)
+            self.assertEqual(resp.status_code, 204)
+            with open(pathA, 'r+') as f:
+                f.write('modified')
+            os.chmod(pathA, 0o700)
+            self.ensureFileContentEqualTo('b.txt', 'changed')
+            self.assertNotEqual(os.stat(pathB).st_mode & 0o777, 0o700)
+
+            self.assertEqual(store.collectGarbage()['removed'], 0)
+            # removing unused blobs does not affect the files cloned from them
+            self.assertEqual(store.collectGarbage(maxAge=-1)['removed'], blobs)
+            self.ensureFileContentEqualTo('a.txt', 'modified' + FILE_CONTENTS[8:])
+        finally:
+            provider.contentStore = None
+
+    @mock.patch("girder.plugins.wholetale.lib.manifest.ImageBuilder")
+    def test22RunProvisioning(self, mock_builder):
+        from girder.plugins.wt_home_dir.lib.Authorizer import RunsAuthorizer
+        from girder.plugins.wt_home_dir.lib.PathMapper import RunsPathMapper
+
+        mock_builder.return_value.container_config.repo2docker_version = (
+            "craigwillis/repo2docker:latest"
+        )
+        mock_builder.return_value.get_tag.return_value = "some_image_digest"
+        resp = self.request(
+            path="/version", method="POST", user=self.user,
+            params={"taleId": self.privateTale["_id"]}
+        )
+        self.assertStatusOk(resp)
+        version = resp.json
+        runIds = []
+        for name in ("run 1", "run 2"):
+            resp = self.request(
+                path="/run", method="POST", user=self.user,
+                params={"versionId": version["_id"], "name": name},
+            )
+            self.assertStatusOk(resp)
+            runIds.append(resp.json["_id"])
+
+        resp = self.request(path="/homedirs/runs/provision", method="POST",
+                            user=self.user, params={"ids": json.dumps(runIds)})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {"provisioned": 2})
+        taleId = str(self.privateTale["_id"])
+        for runId in runIds:
+            self.assertEqual(RunsPathMapper.run_to_tale[runId], taleId)
+            self.assertIsNotNone(RunsAuthorizer.runCache.get(runId))
+            self.assertTrue(os.path.isdir(os.path.join(
+                self.rootPaths["runs"], taleId[:2], taleId, runId, "workspace")))
+
+        url = "http://127.0.0.1:%s/runs/%s" % (os.environ["GIRDER_PORT"], runIds[0])
+        auth = (self.user["login"], "token:%s" % self.token["_id"])
+        resp = requests.request("PROPFIND", url, headers={"Depth": "1"}, auth=auth)
+        self.assertEqual(resp.status_code, 207)
+
+        resp = self.request(path="/homedirs/runs/provision", method="POST",
+                            user=self.user, params={"ids": "[\"nope\"]"})
+        self.assertStatus(resp, 400)
+
+    def test23Sharding(self):
+        baseUrl = 'http://127.0.0.1:%s' % os.environ['GIRDER_PORT']
+        root = '/tales/%s' % self.privateTale['_id']
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        taleId = str(self.privateTale['_id'])
+        with WebDAVFS(baseUrl, login=auth[0], password=auth[1], root=root) as handle:
+            handle.writetext('a.txt', FILE_CONTENTS)
+
+        params = {'realm': 'tales', 'scheme': 'hash:2:2'}
+        resp = self.request(path='/homedirs/sharding', method='PUT', user=self.user,
+                            params=params)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/homedirs/sharding', method='PUT', user=self.admin,
+                            params={'realm': 'tales', 'scheme': 'hash:99'})
+        self.assertStatus(resp, 400)
+        try:
+            with mock.patch('girder.plugins.wt_home_dir.resources.homedirs.ADOPTION_DELAY', 0):
+                resp = self.request(path='/homedirs/sharding', method='PUT', user=self.admin,
+                                    params=params)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json['previous'], 'prefix:1')
+            status = self.waitForSharding('tales')
+            self.assertEqual(status['status'], 'done')
+            self.assertEqual(status['moved'], 2)
+            self.assertEqual(status['conflicts'], [])
+
+            entry = self.homeDirsApps.getApp('tales')
+            self.assertEqual(str(entry.pathMapper.sharding), 'hash:2:2')
+            self.assertIsNone(entry.pathMapper.previousSharding)
+            workspace = Folder().load(self.privateTale['workspaceId'], force=True)
+            self.assertEqual(workspace['fsPath'], os.path.join(
+                self.rootPaths['tales'], entry.pathMapper.davToPhysical('/' + taleId)[1:]))
+            self.assertFalse(os.path.exists(os.path.join(self.rootPaths['tales'], taleId[0])))
+            with WebDAVFS(baseUrl, login=auth[0], password=auth[1], root=root) as handle:
+                self.assertEqual(handle.readtext('a.txt'), FILE_CONTENTS)
+        finally:
+            with mock.patch('girder.plugins.wt_home_dir.resources.homedirs.ADOPTION_DELAY', 0):
+                resp = self.request(path='/homedirs/sharding', method='PUT', user=self.admin,
+                                    params={'realm': 'tales', 'scheme': 'prefix:1'})
+            self.assertStatusOk(resp)
+            self.assertEqual(self.waitForSharding('tales')['status'], 'done')
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.rootPaths['tales'], taleId[0], taleId, 'a.txt')))
+
+    def test24FastPath(self):
+        url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'],
+                                                self.privateTale['_id'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        resp = requests.options(url + '/nope')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['DAV'], '1,2')
+        self.assertIn('PROPFIND', resp.headers['Allow'])
+
+        resp = requests.put(url + '/a.txt', data=FILE_CONTENTS, auth=auth)
+        self.assertEqual(resp.status_code, 201)
+        # not authorized for this directory yet, so answered by wsgidav
+        resp = requests.head(url + '/a.txt', auth=auth)
+        self.assertEqual(resp.status_code, 200)
+        expected = {key: resp.headers[key] for key in ('Content-Length', 'ETag',
+                                                       'Last-Modified', 'Content-Type')}
+        resp = requests.head(url + '/a.txt', auth=auth)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual({key: resp.headers[key] for key in expected}, expected)
+
+        resp = requests.head(url + '/a.txt')
+        self.assertEqual(resp.status_code, 401)
+        resp = requests.head(url + '/a.txt', auth=(self.user['login'], 'wrong'))
+        self.assertEqual(resp.status_code, 401)
+        resp = requests.head(url + '/b.txt', auth=auth)
+        self.assertEqual(resp.status_code, 404)
+
+        # removing the token drops what was granted to it
+        Token().remove(self.token)
+        resp = requests.head(url + '/a.txt', auth=auth)
+        self.assertEqual(resp.status_code, 401)
+
+    def test25TokenHeader(self):
+        url = 'http://127.0.0.1:%s/homes/%s' % (os.environ['GIRDER_PORT'],
+                                                self.user['login'])
+        tokenId = str(self.token['_id'])
+        resp = requests.put(url + '/a.txt', data=FILE_CONTENTS,
+                            headers={'Girder-Token': tokenId})
+        self.assertEqual(resp.status_code, 201)
+        resp = requests.get(url + '/a.txt', headers={'Authorization': 'Bearer ' + tokenId})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.text, FILE_CONTENTS)
+        resp = requests.get(url + '/a.txt', cookies={'girderToken': tokenId})
+        self.assertEqual(resp.status_code, 200)
+        # cookies are not good enough for writes
+        resp = requests.delete(url + '/a.txt', cookies={'girderToken': tokenId})
+        self.assertEqual(resp.status_code, 401)
+        resp = requests.get(url + '/a.txt', headers={'Girder-Token': 'nope'})
+        self.assertEqual(resp.status_code, 401)
+
+        # tokens of other users don't give access to this home
+        otherToken = str(Token().createToken(self.admin)['_id'])
+        resp = requests.get(url + '/a.txt', headers={'Girder-Token': otherToken})
+        self.assertEqual(resp.status_code, 401)
+
+        # only tokens that authenticate their user, or grant WebDAV access, are accepted
+        readToken = str(Token().createToken(self.user, scope=TokenScope.DATA_READ)['_id'])
+        resp = requests.get(url + '/a.txt', headers={'Girder-Token': readToken})
+        self.assertEqual(resp.status_code, 401)
+        davToken = str(Token().createToken(self.user, scope='wt_home_dir.dav')['_id'])
+        resp = requests.get(url + '/a.txt', headers={'Girder-Token': davToken})
+        self.assertEqual(resp.status_code, 200)
+
+        # locks taken with a token belong to its user
+        resp = requests.request('LOCK', url + '/a.txt', headers={'Girder-Token': tokenId},
+                                data='<?xml version="1.0"?><lockinfo xmlns="DAV:">'
+                                     '<lockscope><exclusive/></lockscope>'
+                                     '<locktype><write/></locktype></lockinfo>')
+        self.assertEqual(resp.status_code, 200)
+        lockManager = self.homeDirsApps.getApp('homes').app.providerMap['/']['provider'] \
+            .lockManager
+        lockToken = resp.headers['Lock-Token'].strip('<>')
+        self.assertEqual(lockManager.getLock(lockToken, 'principal'), self.user['login'])
+        lockManager.release(lockToken)
+
+        Token().remove(self.token)
+        resp = requests.get(url + '/a.txt', headers={'Girder-Token': tokenId})
+        self.assertEqual(resp.status_code, 401)
+
+    def test26Snapshot(self):
+        from girder.plugins.wt_home_dir.lib.SnapshotEngine import SnapshotEngine, \
+            MODE_REFLINK
+        entry = self.homeDirsApps.getApp('tales')
+        self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+        src = self.fsAdapter.root
+        os.makedirs(os.path.join(src, 'dir', 'sub'))
+        for path in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt'):
+            with open(os.path.join(src, path), 'w') as f:
+                f.write(FILE_CONTENTS)
+        os.symlink('b.txt', os.path.join(src, 'dir', 'link'))
+        snapshots = os.path.join(self.rootPaths['tales'], 'snapshots')
+        os.makedirs(snapshots)
+
+        engine = SnapshotEngine(maxWorkers=4)
+        stats = engine.snapshot(src, os.path.join(snapshots, 's1'))
+        self.assertEqual((stats['directories'], stats['files'], stats['links']), (3, 3, 1))
+        self.assertEqual(os.readlink(os.path.join(snapshots, 's1/dir/link')), 'b.txt')
+        self.assertEqual(os.stat(os.path.join(src, 'dir/b.txt')).st_ino,
+                         os.stat(os.path.join(snapshots, 's1/dir/b.txt')).st_ino)
+        with self.assertRaises(FileExistsError):
+            engine.snapshot(src, os.path.join(snapshots, 's1'))
+
+        # files modified in place in directories that are not listed again are stat-ed
+        old = time.time() - 3600
+        for path in ('', 'dir', 'dir/sub'):
+            os.utime(os.path.join(src, path), (old, old))
+        engine.snapshot(src, os.path.join(snapshots, 's2'))
+        with open(os.path.join(src, 'dir/sub/c.txt'), 'a') as f:
+            f.write('more')
+        stats = engine.snapshot(src, os.path.join(snapshots, 's3'),
+                                base=os.path.join(snapshots, 's2'))
+        self.assertEqual(stats['listed'], 0)
+        self.assertEqual(stats['bytes'], 3 * len(FILE_CONTENTS) + 4)
+        manifest = engine.readManifest(os.path.join(snapshots, 's3'))
+        self.assertEqual(manifest['dirs']['dir/sub'][1]['c.txt'][1], len(FILE_CONTENTS) + 4)
+
+        # reflinks (or copies) are not affected by changes made in place
+        engine = SnapshotEngine(mode=MODE_REFLINK)
+        engine.snapshot(src, os.path.join(snapshots, 'r1'))
+        with open(os.path.join(src, 'a.txt'), 'a') as f:
+            f.write('more')
+        stats = engine.snapshot(src, os.path.join(snapshots, 'r2'),
+                                base=os.path.join(snapshots, 'r1'))
+        self.assertEqual(stats['reused'], 2)
+        with open(os.path.join(snapshots, 'r1', 'a.txt')) as f:
+            self.assertEqual(f.read(), FILE_CONTENTS)
+        with open(os.path.join(snapshots, 'r2', 'a.txt')) as f:
+            self.assertEqual(f.read(), FILE_CONTENTS + 'more')
+
+    def test27SharedCache(self):
+        from girder.plugins.wt_home_dir.lib.WTDomainController import WTDomainController
+        token = Token().createToken(user=self.user)
+        tokenId = str(token['_id'])
+        user = WTDomainController.getTokenUser(tokenId)
+        self.assertEqual(user['_id'], self.user['_id'])
+        # what other processes would see
+        tokenCache = WTDomainController.tokenCache
+        tokenCache.cache.clearLocal()
+        self.assertEqual(tokenCache.get(tokenId), self.user['_id'])
+        # only hashes of token IDs are stored
+        self.assertIsNone(tokenCache.cache.get(tokenId))
+        Token().remove(token)
+        tokenCache.cache.clearLocal()
+        self.assertIsNone(tokenCache.get(tokenId))
+        self.assertIsNone(WTDomainController.getTokenUser(tokenId))
+
+        # saving a user drops its record only
+        records = WTDomainController.userCache.records
+        WTDomainController.userCache.getById(self.user['_id'])
+        WTDomainController.userCache.getById(self.admin['_id'])
+        self.model('user').save(self.user)
+        records.clearLocal()
+        self.assertIsNone(records.get(self.user['_id']))
+        self.assertEqual(records.get(self.admin['_id']).login, self.admin['login'])
+
+    def test28IOStats(self):
+        from girder.plugins.wt_home_dir.lib.IOAccountant import IOAccountant
+        IOAccountant.accounting.clear()
+        url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'],
+                                                self.privateTale['_id'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        resp = requests.put(url + '/a.txt', data=FILE_CONTENTS, auth=auth)
+        self.assertEqual(resp.status_code, 201)
+        resp = requests.get(url + '/a.txt', auth=auth)
+        self.assertEqual(resp.status_code, 200)
+        # recorded when the server closes the response
+        time.sleep(0.5)
+
+        resp = self.request(path='/homedirs/io', user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/homedirs/io', user=self.admin, params={'sort': 'nope'})
+        self.assertStatus(resp, 400)
+        resp = self.request(path='/homedirs/io', user=self.admin, params={'sort': 'bytesRead'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['top'][0]['id'], self.user['login'])
+        self.assertEqual(resp.json['top'][0]['bytesRead'], len(FILE_CONTENTS))
+        self.assertEqual(resp.json['top'][0]['bytesWritten'], len(FILE_CONTENTS))
+        resp = self.request(path='/homedirs/io', user=self.admin, params={'kind': 'tale'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['top'][0]['id'], str(self.privateTale['_id']))
+        self.assertEqual(resp.json['flagged'], [])
+
+    def test29ExecutableBatch(self):
+        url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'],
+                                                self.privateTale['_id'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        entry = self.homeDirsApps.getApp('tales')
+        self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+        root = self.fsAdapter.root
+        os.makedirs(os.path.join(root, 'bin', 'sub'))
+        for path in ('bin/a.sh', 'bin/sub/b.sh'):
+            with open(os.path.join(root, path), 'w') as f:
+                f.write(FILE_CONTENTS)
+        body = ('<propertyupdate xmlns="DAV:" xmlns:A="http://apache.org/dav/props/">'
+                '<set><prop><A:executable>T</A:executable></prop></set></propertyupdate>')
+
+        resp = requests.request('PROPPATCH', url + '/bin', data=body, auth=auth,
+                                headers={'Depth': '1'})
+        self.assertEqual(resp.status_code, 207)
+        self.assertTrue(os.access(os.path.join(root, 'bin/a.sh'), os.X_OK))
+        self.assertFalse(os.access(os.path.join(root, 'bin/sub/b.sh'), os.X_OK))
+        resp = requests.request('PROPPATCH', url + '/bin', data=body, auth=auth,
+                                headers={'Depth': 'infinity'})
+        self.assertEqual(resp.status_code, 207)
+        self.assertTrue(os.access(os.path.join(root, 'bin/sub/b.sh'), os.X_OK))
+        self.assertIn('Changed 1 of 2 files', resp.text)
+
+        # nothing is changed while a file below the collection is locked
+        resp = requests.request('LOCK', url + '/bin/a.sh', auth=auth,
+                                data='<?xml version="1.0"?><lockinfo xmlns="DAV:">'
+                                     '<lockscope><exclusive/></lockscope>'
+                                     '<locktype><write/></locktype></lockinfo>')
+        self.assertEqual(resp.status_code, 200)
+        lockToken = resp.headers['Lock-Token']
+        clear = body.replace('>T<', '>F<')
+        resp = requests.request('PROPPATCH', url + '/bin', data=clear, auth=auth,
+                                headers={'Depth': '1'})
+        self.assertEqual(resp.status_code, 423)
+        self.assertTrue(os.access(os.path.join(root, 'bin/a.sh'), os.X_OK))
+        resp = requests.request('UNLOCK', url + '/bin/a.sh', auth=auth,
+                                headers={'Lock-Token': lockToken})
+        self.assertEqual(resp.status_code, 204)
+
+        resp = requests.request('PROPPATCH', url + '/bin', auth=auth,
+                                data=body.replace('executable', 'other'),
+                                headers={'Depth': 'infinity'})
+        self.assertEqual(resp.status_code, 400)
+
+        resp = requests.request('PROPFIND', url + '/bin', auth=auth, headers={'Depth': '1'})
+        self.assertEqual(resp.status_code, 207)
+        # the collection, a.sh and sub
+        self.assertEqual(resp.text.count('>T<'), 3)
+
+    def test30LazyRealm(self):
+        from girder.plugins.wt_home_dir import AppEntry
+        from girder.plugins.wt_home_dir.lib.PathMapper import HomePathMapper
+        built = []
+
+        def build():
+            time.sleep(0.1)
+            built.append(1)
+            return lambda environ, start_response: [b'ok']
+
+        entry = AppEntry('homes', HomePathMapper(), build)
+        self.assertFalse(entry.isBuilt())
+        threads = [threading.Thread(target=lambda: entry({}, None)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(built, [1])
+        self.assertTrue(entry.isBuilt())
+        self.assertGreater(entry.buildTime, 0)
+        self.assertEqual(entry({}, None), [b'ok'])
+
+        # failures are logged once and the app is built again on the next request
+        failures = []
+
+        def failingBuild():
+            if len(failures) < 2:
+                failures.append(1)
+                raise OSError('no such directory')
+            return build()
+
+        entry = AppEntry('homes', HomePathMapper(), failingBuild)
+        with mock.patch('girder.plugins.wt_home_dir.logger') as logger:
+            self.assertRaises(OSError, entry, {}, None)
+            self.assertRaises(OSError, entry, {}, None)
+            self.assertEqual(logger.exception.call_count, 1)
+        self.assertEqual(entry({}, None), [b'ok'])
+
+        # setUp() used the app of each realm
+        self.assertTrue(self.homeDirsApps.getApp('tales').isBuilt())
+
+    def test31PasswordHashing(self):
+        passwordModel = self.model('password', 'wt_home_dir')
+        passwordModel.setPassword(self.user, 'secret-password')
+        self.assertTrue(passwordModel.findOne({'userId': self.user['_id']})['hash']
+                        .startswith('$pbkdf2-sha256$'))
+
+        resp = self.request(path='/system/setting', method='PUT', user=self.admin, params={
+            'key': 'wthome.password_hashing', 'value': json.dumps({'scheme': 'md5'})})
+        self.assertStatus(resp, 400)
+        # too few rounds for passwords chosen by users
+        resp = self.request(path='/system/setting', method='PUT', user=self.admin, params={
+            'key': 'wthome.password_hashing',
+            'value': json.dumps({'scheme': 'pbkdf2_sha256', 'rounds': 1000})})
+        self.assertStatus(resp, 400)
+        resp = self.request(path='/system/setting', method='PUT', user=self.admin, params={
+            'key': 'wthome.password_hashing',
+            'value': json.dumps({'scheme': 'sha512_crypt', 'rounds': 5000,
+                                 'generated': {'scheme': 'pbkdf2_sha256', 'rounds': 1000}})})
+        self.assertStatusOk(resp)
+        try:
+            # rehashed with the new policy on login
+            passwordModel.authenticate(self.user['login'], 'secret-password')
+            entry = passwordModel.findOne({'userId': self.user['_id']})
+            self.assertTrue(entry['hash'].startswith('$6$rounds=5000$'))
+            passwordModel.authenticate(self.user['login'], 'secret-password')
+            self.assertEqual(passwordModel.findOne({'userId': self.user['_id']})['hash'],
+                             entry['hash'])
+
+            # a password changed while its old hash is verified is kept
+            stale = passwordModel.findOne({'userId': self.user['_id']})
+            passwordModel.setPassword(self.user, 'other-password')
+            Setting().set('wthome.password_hashing', {'scheme': 'pbkdf2_sha512'})
+            with mock.patch.object(passwordModel, 'findOne', return_value=stale):
+                passwordModel.authenticate(self.user['login'], 'secret-password')
+            passwordModel.authenticate(self.user['login'], 'other-password')
+            Setting().set('wthome.password_hashing', {
+                'scheme': 'sha512_crypt', 'rounds': 5000,
+                'generated': {'scheme': 'pbkdf2_sha256', 'rounds': 1000}})
+
+            resp = self.request(path='/homedirpass/generate', user=self.user)
+            self.assertStatusOk(resp)
+            entry = passwordModel.findOne({'userId': self.user['_id']})
+            self.assertTrue(entry['generated'])
+            self.assertTrue(entry['hash'].startswith('$pbkdf2-sha256$1000$'))
+            passwordModel.authenticate(self.user['login'], resp.json['password'])
+        finally:
+            Setting().unset('wthome.password_hashing')
+
+        resp = self.request(path='/homedirpass/benchmark', user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/homedirpass/benchmark', user=self.admin, params={
+            'policies': json.dumps([{'scheme': 'pbkdf2_sha256', 'rounds': 1000}]),
+            'samples': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+        self.assertEqual(resp.json[0]['rounds'], 1000)
+        self.assertGreater(resp.json[0]['seconds'], 0)
+        resp = self.request(path='/homedirpass/benchmark', user=self.admin,
+                            params={'samples': 100})
+        self.assertStatus(resp, 400)
+
+    def test32UserRecords(self):
+        from girder.plugins.wt_home_dir.lib.UserRecord import UserRecord
+        from girder.plugins.wt_home_dir.lib.WTDomainController import WTDomainController
+        controller = WTDomainController('homes')
+        controller.clearCache()
+        user = controller._getUser(self.user['login'])
+        self.assertIsInstance(user, UserRecord)
+        self.assertEqual(user['_id'], self.user['_id'])
+        self.assertEqual(user.get('groups'), ())
+        self.assertIsNone(user.get('email'))
+        self.assertRaises(KeyError, lambda: user['email'])
+        # what other processes would see
+        WTDomainController.userCache.records.clearLocal()
+        self.assertEqual(WTDomainController.userCache.records.get(self.user['_id']).login,
+                         self.user['login'])
+        # usable for access checks
+        from girder.plugins.wholetale.models.tale import Tale
+        self.assertIsNotNone(Tale().load(self.privateTale['_id'], user=user, exc=True))
+        # a non-admin record of another user
+        other = UserRecord(self.admin['_id'], self.admin['login'])
+        self.assertRaises(AccessException, Tale().load, self.privateTale['_id'], user=other,
+                          exc=True)
+
+        self.user['status'] = 'disabled'
+        self.user = self.model('user').save(self.user)
+        try:
+            self.assertIsNone(controller._getUser(self.user['login']))
+            url = 'http://127.0.0.1:%s/homes/%s' % (os.environ['GIRDER_PORT'],
+                                                    self.user['login'])
+            resp = requests.request('PROPFIND', url, headers={'Depth': '0'},
+                                    auth=(self.user['login'], 'token:%s' % self.token['_id']))
+            self.assertEqual(resp.status_code, 401)
+        finally:
+            self.user['status'] = 'enabled'
+            self.user = self.model('user').save(self.user)
+
+    def test33Onboarding(self):
+        from girder.plugins.wt_home_dir import deferredMapping
+        from girder.plugins.wholetale.models.image import Image
+        from girder.plugins.wholetale.models.tale import Tale
+        image = Image().load(self.privateTale['imageId'], force=True)
+        userModel = self.model('user')
+        with deferredMapping():
+            users = [userModel.createUser(login='workshop%d' % i, email='w%d@dev.null' % i,
+                                          firstName='W', lastName=str(i), password='secret')
+                     for i in range(20)]
+            self.assertIsNone(Folder().findOne({'parentId': users[0]['_id']}))
+            tale = Tale().createTale(image, [], creator=self.user, public=False)
+        for user in users:
+            home = Folder().findOne({'parentId': user['_id'], 'name': 'Home'})
+            self.assertTrue(home['isMapping'])
+            self.assertTrue(os.path.isdir(home['fsPath']))
+            self.assertTrue(Folder().hasAccess(home, user=user, level=AccessType.ADMIN))
+        tale = Tale().load(tale['_id'], force=True)
+        workspace = Folder().load(tale['workspaceId'], force=True)
+        self.assertTrue(os.path.isdir(workspace['fsPath']))
+
+        # users whose mapping was lost are mapped again
+        Folder().update({'parentId': users[0]['_id']}, {'$unset': {'isMapping': True}})
+        resp = self.request(path='/homedirs/onboard', method='POST', user=self.user,
+                            params={'users': json.dumps([str(users[0]['_id'])])})
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/homedirs/onboard', method='POST', user=self.admin, params={
+            'users': json.dumps([str(user['_id']) for user in users]),
+            'tales': json.dumps([str(tale['_id'])])})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['users'], {'provisioned': 1, 'existing': 19})
+        self.assertEqual(resp.json['tales'], {'provisioned': 0, 'existing': 1})
+        self.assertTrue(Folder().findOne({'parentId': users[0]['_id']})['isMapping'])
+
+    def test34Compression(self):
+        url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'],
+                                                self.privateTale['_id'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        entry = self.homeDirsApps.getApp('tales')
+        self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+        for i in range(100):
+            with open(os.path.join(self.fsAdapter.root, 'file%03d.txt' % i), 'w') as f:
+                f.write(FILE_CONTENTS)
+
+        resp = requests.request('PROPFIND', url, auth=auth, headers={
+            'Depth': '1', 'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 207)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        # the connection is kept alive
+        self.assertIn('Content-Length', resp.headers)
+        self.assertNotEqual(resp.headers.get('Connection', '').lower(), 'close')
+        # decoded by requests
+        self.assertIn('file099.txt', resp.text)
+        resp = requests.request('PROPFIND', url, auth=auth, headers={
+            'Depth': '1', 'Accept-Encoding': 'identity'})
+        self.assertEqual(resp.status_code, 207)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+        # files are not compressed unless enabled, however large
+        contents = FILE_CONTENTS * (2048 // len(FILE_CONTENTS) + 1)
+        with open(os.path.join(self.fsAdapter.root, 'large.txt'), 'w') as f:
+            f.write(contents)
+        resp = requests.get(url + '/large.txt', auth=auth,
+                            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertNotIn('Accept-Encoding', resp.headers.get('Vary', ''))
+        self.assertEqual(resp.text, contents)
+
+    def test35ContentCache(self):
+        url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'],
+                                                self.privateTale['_id'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        entry = self.homeDirsApps.getApp('tales')
+        contentCache = entry.app.providerMap['/']['provider'].contentCache
+        self.assertIsNotNone(contentCache)
+        resp = requests.put(url + '/notebook.ipynb', data=FILE_CONTENTS, auth=auth)
+        self.assertEqual(resp.status_code, 201)
+        hits = contentCache.hits
+        for i in range(3):
+            resp = requests.get(url + '/notebook.ipynb', auth=auth)
+            self.assertEqual(resp.text, FILE_CONTENTS)
+        self.assertEqual(contentCache.hits, hits + 2)
+        # ranges are served from memory too
+        resp = requests.get(url + '/notebook.ipynb', auth=auth, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.text, FILE_CONTENTS[:10])
+
+        # writes through WebDAV drop the entry
+        resp = requests.put(url + '/notebook.ipynb', data=FILE_CONTENTS[::-1], auth=auth)
+        self.assertEqual(resp.status_code, 204)
+        resp = requests.get(url + '/notebook.ipynb', auth=auth)
+        self.assertEqual(resp.text, FILE_CONTENTS[::-1])
+        # changes made behind its back are noticed
+        self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+        with open(os.path.join(self.fsAdapter.root, 'notebook.ipynb'), 'a') as f:
+            f.write('more')
+        resp = requests.get(url + '/notebook.ipynb', auth=auth)
+        self.assertEqual(resp.text, FILE_CONTENTS[::-1] + 'more')
+
+    def test36IOTuning(self):
+        from girder.plugins.wt_home_dir.lib.IOTuning import IOTuning, SequentialReader
+
+        url = 'http://127.0.0.1:%s/tales/%s' % (os.environ['GIRDER_PORT'],
+                                                self.privateTale['_id'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        entry = self.homeDirsApps.getApp('tales')
+        provider = entry.app.providerMap['/']['provider']
+        self.assertEqual(entry.app.config['block_size'], provider.ioTuning.blockSize)
+        self.assertEqual(IOTuning({'blockSize': {'homes': 4096}}, 'homes').blockSize, 4096)
+        self.assertEqual(IOTuning({'blockSize': {'homes': 4096}}, 'tales').blockSize,
+                         1024 * 1024)
+        self.assertRaises(Exception, Setting().set, 'wthome.io_tuning',
+                          {'blockSize': {'homes': 0}})
+
+        saved = provider.ioTuning
+        provider.ioTuning = IOTuning({'blockSize': 65536, 'largeFileSize': 1024 * 1024})
+        try:
+            data = os.urandom(3 * 1024 * 1024 + 17)
+            resp = requests.put(url + '/large.bin', data=data, auth=auth)
+            self.assertEqual(resp.status_code, 201)
+            self.makeTaleAdapters(entry.pathMapper, entry.app, self.user)
+            # preallocation does not show in the size
+            path = os.path.join(self.fsAdapter.root, 'large.bin')
+            self.assertEqual(os.path.getsize(path), len(data))
+            resp = requests.get(url + '/large.bin', auth=auth)
+            self.assertEqual(resp.content, data)
+            resp = requests.get(url + '/large.bin', auth=auth,
+                                headers={'Range': 'bytes=2097152-2097161'})
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(resp.content, data[2097152:2097162])
+            with open(path, 'rb') as f:
+                reader = provider.ioTuning.openForReading(f, len(data))
+                self.assertIsInstance(reader, SequentialReader)
+                self.assertEqual(reader.read(), data)
+        finally:
+            provider.ioTuning = saved
+
+    def test37Orphans(self):
+        from bson.objectid import ObjectId
+        from girder.plugins.wholetale.models.image import Image
+        from girder.plugins.wholetale.models.tale import Tale
+        entry = self.homeDirsApps.getApp('tales')
+        root = entry.app.config['wt_home_dirs_root']
+        # the directory of a tale removed behind the plugin's back
+        orphanId = str(ObjectId())
+        orphan = entry.pathMapper.davToPhysical('/' + orphanId).lstrip('/')
+        os.makedirs(os.path.join(root, orphan, 'data'))
+        with open(os.path.join(root, orphan, 'data', 'big.bin'), 'wb') as f:
+            f.write(b'x' * 1000)
+        # a workspace whose directory is gone
+        image = Image().load(self.privateTale['imageId'], force=True)
+        tale = Tale().createTale(image, [], creator=self.user, public=False)
+        workspace = Folder().load(tale['workspaceId'], force=True)
+        shutil.rmtree(workspace['fsPath'])
+
+        resp = self.request(path='/homedirs/orphans', user=self.user, params={'realm': 'tales'})
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/homedirs/orphans', user=self.admin, params={'realm': 'tales'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['orphans'], [{
+            'path': orphan, 'files': 1, 'size': 1000,
+            'mtime': os.stat(os.path.join(root, orphan)).st_mtime}])
+        self.assertEqual(resp.json['orphanSize'], 1000)
+        self.assertEqual([d['folderId'] for d in resp.json['dangling']],
+                         [str(workspace['_id'])])
+
+        # recently modified orphans are kept
+        resp = self.request(path='/homedirs/orphans/reclaim', method='POST', user=self.admin,
+                            params={'realm': 'tales'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['reclaimed'], [])
+        resp = self.request(path='/homedirs/orphans/reclaim', method='POST', user=self.admin,
+                            params={'realm': 'tales', 'minAge': 0})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['reclaimed'], [orphan])
+        self.assertFalse(os.path.exists(os.path.join(root, orphan)))
+        self.assertTrue(os.path.isfile(os.path.join(resp.json['trash'], orphan, 'data',
+                                                    'big.bin')))
+        # live workspaces are left alone
+        privateWorkspace = Folder().load(self.privateTale['workspaceId'], force=True)
+        self.assertTrue(os.path.isdir(privateWorkspace['fsPath']))
+        resp = self.request(path='/homedirs/orphans', user=self.admin, params={'realm': 'tales'})
+        self.assertEqual(resp.json['orphans'], [])
+
+    def test38SyncCollection(self):
+        from xml.etree import ElementTree
+        url = 'http://127.0.0.1:%s/homes/%s' % (os.environ['GIRDER_PORT'], self.user['login'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+
+        def report(token, level='infinite'):
+            body = ('<sync-collection xmlns="DAV:"><sync-token>%s</sync-token>'
+                    '<sync-level>%s</sync-level><prop><getetag/></prop></sync-collection>'
+                    % (token, level))
+            resp = requests.request('REPORT', url, data=body, auth=auth)
+            if resp.status_code != 207:
+                return resp.status_code, resp.text, None
+            root = ElementTree.fromstring(resp.content)
+            statuses = {}
+            for response in root.findall('{DAV:}response'):
+                href = response.find('{DAV:}href').text.split('/', 3)[-1]
+                status = response.find('{DAV:}status')
+                if status is None:
+                    status = response.find('{DAV:}propstat/{DAV:}status')
+                statuses[href] = status.text.split()[1]
+            return resp.status_code, statuses, root.find('{DAV:}sync-token').text
+
+        self.assertEqual(requests.request('MKCOL', url + '/sub', auth=auth).status_code, 201)
+        for path in ('a.txt', 'sub/b.txt'):
+            resp = requests.put(url + '/' + path, data=FILE_CONTENTS, auth=auth)
+            self.assertEqual(resp.status_code, 201)
+        status, files, token = report('')
+        self.assertEqual(status, 207)
+        self.assertEqual(files, {'a.txt': '200', 'sub/b.txt': '200'})
+        status, files, _ = report('', level='1')
+        self.assertEqual(files, {'a.txt': '200'})
+
+        resp = requests.put(url + '/c.txt', data=FILE_CONTENTS, auth=auth)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(requests.delete(url + '/a.txt', auth=auth).status_code, 204)
+        status, files, newToken = report(token)
+        self.assertEqual(status, 207)
+        # changes made shortly before the token was issued may be reported again
+        self.assertEqual(files['c.txt'], '200')
+        self.assertEqual(files['a.txt'], '404')
+        self.assertNotEqual(newToken, token)
+
+        status, body, _ = report('urn:x-wt-sync:0')
+        self.assertEqual(status, 403)
+        self.assertIn('valid-sync-token', body)
+        resp = requests.request('PROPFIND', url, auth=auth, headers={'Depth': '0'}, data=(
+            '<propfind xmlns="DAV:"><prop><supported-report-set/></prop></propfind>'))
+        self.assertIn('sync-collection', resp.text)
+
+    def test39QuotaProperties(self):
+        from xml.etree import ElementTree
+        from girder.plugins.wt_home_dir.lib.UsageIndex import UsageIndex
+        url = 'http://127.0.0.1:%s/homes/%s' % (os.environ['GIRDER_PORT'], self.user['login'])
+        auth = (self.user['login'], 'token:%s' % self.token['_id'])
+        body = ('<propfind xmlns="DAV:"><prop><quota-used-bytes/><quota-available-bytes/>'
+                '</prop></propfind>')
+
+        def quota():
+            resp = requests.request('PROPFIND', url, data=body, auth=auth,
+                                    headers={'Depth': '0'})
+            self.assertEqual(resp.status_code, 207)
+            root = ElementTree.fromstring(resp.content)
+            return {name: root.find('.//{DAV:}%s' % name).text
+                    for name in ('quota-used-bytes', 'quota-available-bytes')}
+
+        UsageIndex.usage.clear()
+        resp = requests.put(url + '/a.txt', data=FILE_CONTENTS, auth=auth)
+        self.assertEqual(resp.status_code, 201)
+        # not measured yet
+        self.assertEqual(quota(), {'quota-used-bytes': None, 'quota-available-bytes': None})
+        UsageIndex().refresh()
+        values = quota()
+        self.assertEqual(int(values['quota-used-bytes']), len(FILE_CONTENTS))
+        self.assertGreater(int(values['quota-available-bytes']), 0)
+
+        # writes and deletes are applied without measuring again
+        resp = requests.put(url + '/b.txt', data=FILE_CONTENTS * 2, auth=auth)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(int(quota()['quota-used-bytes']), 3 * len(FILE_CONTENTS))
+        self.assertEqual(requests.delete(url + '/a.txt', auth=auth).status_code, 204)
+        self.assertEqual(int(quota()['quota-used-bytes']), 2 * len(FILE_CONTENTS))
+
+        # only on the root collections, and not with allprop
+        resp = requests.request('PROPFIND', url, auth=auth, headers={'Depth': '0'})
+        self.assertNotIn('quota-used-bytes', resp.text)
+
     def tearDown(self):
         for path in self.rootPaths.values():
             shutil.rmtree(path, ignore_errors=True)
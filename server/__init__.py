@@ -2,18 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import cherrypy
+import contextlib
+from cherrypy.process.plugins import Monitor
 import os
 import pathlib
 import shutil
 import tempfile
-from wsgidav.wsgidav_app import DEFAULT_CONFIG, WsgiDAVApp
-from wsgidav.dir_browser import WsgiDavDirBrowser
-from wsgidav.debug_filter import WsgiDavDebugFilter
-from wsgidav.http_authenticator import HTTPAuthenticator
-from wsgidav.error_printer import ErrorPrinter
+import threading
+import time
 from girder import logger
 from girder import events
-from girder.constants import ROOT_DIR, AccessType, CoreEventHandler
+from girder.constants import ROOT_DIR, AccessType, CoreEventHandler, TokenScope
+from girder.exceptions import ValidationException
 from girder.models.folder import Folder
 from girder.models.setting import Setting
 from girder.models.user import User
@@ -21,24 +21,81 @@ from girder.utility import setting_utilities
 from girder.constants import SettingDefault
 from girder.plugins.wholetale.models.tale import Tale
 
-from .constants import PluginSettings, WORKSPACE_NAME
+from .constants import PluginSettings, WORKSPACE_NAME, CAS_DIR, SHARDING_POLL_INTERVAL, \
+    DAV_TOKEN_SCOPE
+from .lib.ArchiveDownloader import ArchiveDownloader
+from .lib.ArchiveExtractor import ArchiveExtractor
+from .lib.ContentCache import ContentCache, DEFAULT_MAX_BYTES, DEFAULT_MAX_FILE_SIZE
+from .lib.ContentStore import ContentStore
+from .lib.ExecutableBatcher import ExecutableBatcher
+from .lib.FastPathResponder import FastPathResponder
+from .lib.IOTuning import IOTuning, DEFAULT_BLOCK_SIZE, DEFAULT_LARGE_FILE_SIZE
+from .lib.IOAccountant import IOAccountant
 from .lib.Authorizer import HomeAuthorizer, TaleAuthorizer, RunsAuthorizer
 from .lib.DirectoryInitializer import (
     HomeDirectoryInitializer,
     TaleDirectoryInitializer,
     RunsDirectoryInitializer
 )
+from .lib.TokenAuthenticator import TokenAuthenticator, TOKEN_USER_KEY
 from .lib.WTDomainController import WTDomainController
 from .lib.WTFilesystemProvider import WTFilesystemProvider
-from .lib.PathMapper import HomePathMapper, TalePathMapper, RunsPathMapper
+from .lib.WTLockStorage import WTLockStorage
+from .lib.PathMapper import HomePathMapper, TalePathMapper, RunsPathMapper, \
+    REALM_PATH_MAPPERS, parseSharding, configureSharding
+from .lib.Onboarder import Onboarder
+from .lib.ResponseCompressor import ResponseCompressor, DEFAULT_LEVEL, DEFAULT_MIN_SIZE
+from .lib.ResumableUploader import ResumableUploader
+from .lib.SharedCache import configureSharedCaches
+from .lib.SyncCollectionReporter import SyncCollectionReporter
+from .lib.UsageIndex import UsageIndex
+from .lib.WorkspaceIndexer import WorkspaceIndexer
+from .models.password import DEFAULT_HASHING, validateHashingPolicy
+from .models.workspace_manifest import WorkspaceManifest
 from .resources.homedirpass import Homedirpass
+from .resources.homedirs import Homedirs
 
 
 class AppEntry:
-    def __init__(self, realm: str, pathMapper, app):
+    """
+    A DAV realm, grafted onto the CherryPy tree in place of its wsgidav app. The app
+    (the provider and the whole middleware stack) is built by <build> on the first
+    request to the realm or the first access to .app, rather than when the plugin is
+    loaded.
+    """
+    def __init__(self, realm: str, pathMapper, build):
         self.realm = realm
         self.pathMapper = pathMapper
-        self.app = app
+        self.build = build
+        # seconds it took to build the app
+        self.buildTime = None
+        self._app = None
+        self._lock = threading.Lock()
+        # whether a failure to build the app was logged; later requests try again
+        self._failureLogged = False
+
+    @property
+    def app(self):
+        if self._app is None:
+            with self._lock:
+                if self._app is None:
+                    start = time.time()
+                    try:
+                        self._app = self.build()
+                    except Exception:
+                        if not self._failureLogged:
+                            self._failureLogged = True
+                            logger.exception('Cannot build the %s realm' % self.realm)
+                        raise
+                    self.buildTime = time.time() - start
+                    logger.info('Built the %s realm in %.3fs' % (self.realm, self.buildTime))
+        return self._app
+
+    def isBuilt(self):
+        return self._app is not None
+
+    def __call__(self, environ, start_response):
+        return self.app(environ, start_response)
 
 
 class AppsList:
@@ -46,8 +103,10 @@ class AppsList:
         self.list = []
         self.map = {}
 
-    def add(self, realm: str, pathMapper, app):
-        self.addEntry(AppEntry(realm, pathMapper, app))
+    def add(self, realm: str, pathMapper, build):
+        entry = AppEntry(realm, pathMapper, build)
+        self.addEntry(entry)
+        return entry
 
     def addEntry(self, appEntry: AppEntry):
         self.list.append(appEntry)
@@ -65,25 +124,169 @@ HOME_DIRS_APPS = AppsList()
 
 @setting_utilities.validator({
     PluginSettings.HOME_DIRS_ROOT,
-    PluginSettings.TALE_DIRS_ROOT
+    PluginSettings.TALE_DIRS_ROOT,
+    PluginSettings.LOCKS_ROOT
 })
 def validateOtherSettings(event):
     pass
 
 
-class WTDAVApp(WsgiDAVApp):
-    def __call__(self, environ, start_response):
-        if 'HTTP_X_FORWARDED_PROTO' in environ:
-            environ['wsgi.url_scheme'] = environ['HTTP_X_FORWARDED_PROTO']
-        return super().__call__(environ, start_response)
+@setting_utilities.validator(PluginSettings.DEDUP)
+def validateDedup(doc):
+    if not isinstance(doc['value'], bool):
+        raise ValidationException('Deduplication must be enabled (true) or disabled (false).',
+                                  'value')
+
+
+@setting_utilities.validator(PluginSettings.INDEX_RESCAN_INTERVAL)
+def validateRescanInterval(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        doc['value'] = -1
+    if doc['value'] < 0:
+        raise ValidationException('The rescan interval must be a number of seconds, or 0 to '
+                                  'disable rescans.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.SHARDING)
+def validateSharding(doc):
+    if not isinstance(doc['value'], dict):
+        raise ValidationException('Sharding must be an object mapping realms to schemes.',
+                                  'value')
+    for realm, entry in doc['value'].items():
+        if realm not in REALM_PATH_MAPPERS:
+            raise ValidationException('Unknown realm: %s' % realm, 'value')
+        if not isinstance(entry, dict) or 'scheme' not in entry:
+            raise ValidationException('Missing sharding scheme for %s' % realm, 'value')
+        try:
+            parseSharding(entry['scheme'])
+            if entry.get('previous'):
+                parseSharding(entry['previous'])
+        except ValueError as ex:
+            raise ValidationException(str(ex), 'value')
+        if not isinstance(entry.get('published', 0), (int, float)):
+            raise ValidationException('Invalid publication time for %s' % realm, 'value')
+
+
+@setting_utilities.validator(PluginSettings.PASSWORD_HASHING)
+def validatePasswordHashing(doc):
+    if not isinstance(doc['value'], dict):
+        raise ValidationException('Password hashing must be an object with a scheme and, '
+                                  'optionally, rounds and a "generated" policy.', 'value')
+    try:
+        validateHashingPolicy(doc['value'])
+        if doc['value'].get('generated') is not None:
+            validateHashingPolicy(doc['value']['generated'], generated=True)
+    except ValueError as ex:
+        raise ValidationException(str(ex), 'value')
+
+
+@setting_utilities.validator(PluginSettings.COMPRESSION)
+def validateCompression(doc):
+    value = doc['value']
+    if not isinstance(value, dict):
+        raise ValidationException('Compression must be an object with a level, minSize '
+                                  'and files.', 'value')
+    level = value.get('level', DEFAULT_LEVEL)
+    if not isinstance(level, int) or isinstance(level, bool) or not 0 <= level <= 9:
+        raise ValidationException('The compression level must be between 0 (disabled) '
+                                  'and 9.', 'value')
+    minSize = value.get('minSize', DEFAULT_MIN_SIZE)
+    if not isinstance(minSize, int) or isinstance(minSize, bool) or minSize < 0:
+        raise ValidationException('minSize must be a number of bytes.', 'value')
+    if not isinstance(value.get('files', False), bool):
+        raise ValidationException('files must be true or false.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.CONTENT_CACHE)
+def validateContentCache(doc):
+    value = doc['value']
+    if not isinstance(value, dict):
+        raise ValidationException('The content cache must be an object with maxBytes and '
+                                  'maxFileSize.', 'value')
+    for name in ('maxBytes', 'maxFileSize'):
+        size = value.get(name, 0)
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            raise ValidationException('%s must be a number of bytes.' % name, 'value')
+
+
+def _isSize(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+@setting_utilities.validator(PluginSettings.IO_TUNING)
+def validateIOTuning(doc):
+    value = doc['value']
+    if not isinstance(value, dict):
+        raise ValidationException('I/O tuning must be an object with a blockSize, '
+                                  'largeFileSize, preallocate and fadvise.', 'value')
+    blockSize = value.get('blockSize', DEFAULT_BLOCK_SIZE)
+    blockSizes = blockSize.values() if isinstance(blockSize, dict) else [blockSize]
+    if not all(_isSize(size) and size > 0 for size in blockSizes):
+        raise ValidationException('blockSize must be a number of bytes or an object '
+                                  'mapping realms to numbers of bytes.', 'value')
+    if not _isSize(value.get('largeFileSize', DEFAULT_LARGE_FILE_SIZE)):
+        raise ValidationException('largeFileSize must be a number of bytes.', 'value')
+    for name in ('preallocate', 'fadvise'):
+        if not isinstance(value.get(name, True), bool):
+            raise ValidationException('%s must be true or false.' % name, 'value')
+
+
+def applySharding():
+    # Picks up changes made by other processes (see Homedirs.setSharding())
+    configureSharding(Setting().get(PluginSettings.SHARDING))
+
+
+def startDAVServer(rootPath, directoryInitializer, authorizer, pathMapper, contentCache=None):
+    """Mounts a realm. Its wsgidav app is only built on first use (see AppEntry)."""
+    start = time.time()
+    realm = pathMapper.getRealm()
+    contentStore = None
+    if Setting().get(PluginSettings.DEDUP):
+        contentStore = ContentStore(os.path.join(rootPath, CAS_DIR))
+        Monitor(cherrypy.engine, contentStore.collectGarbage, frequency=3600,
+                name='wt_home_dirs blob collection (%s)' % rootPath).subscribe()
 
+    def build():
+        return buildDAVApp(rootPath, directoryInitializer, authorizer, pathMapper,
+                           contentStore, contentCache)
+
+    global HOME_DIRS_APPS
+    entry = HOME_DIRS_APPS.add(realm, pathMapper, build)
+    cherrypy.tree.graft(entry, '/' + realm)
+    logger.info('Mounted the %s realm in %.3fs' % (realm, time.time() - start))
+
+
+def buildDAVApp(rootPath, directoryInitializer, authorizer, pathMapper, contentStore=None,
+                contentCache=None):
+    # wsgidav's core (utilities, providers and middleware base) is imported with the
+    # plugin's middleware; its app, which brings in the request server and property
+    # and lock managers, and the middleware only used here are imported with the first realm
+    from wsgidav.wsgidav_app import DEFAULT_CONFIG
+    from wsgidav.dir_browser import WsgiDavDirBrowser
+    from wsgidav.debug_filter import WsgiDavDebugFilter
+    from wsgidav.http_authenticator import HTTPAuthenticator
+    from wsgidav.error_printer import ErrorPrinter
+    from .lib.WTDAVApp import WTDAVApp
 
-def startDAVServer(rootPath, directoryInitializer, authorizer, pathMapper):
     if not os.path.exists(rootPath):
         os.makedirs(rootPath)
 
     provider = WTFilesystemProvider(rootPath, pathMapper)
+    provider.addChangeListener(WorkspaceIndexer())
+    provider.contentStore = contentStore
+    if contentCache is not None:
+        provider.contentCache = contentCache
+        provider.addChangeListener(contentCache.invalidate)
+    provider.usageIndex = UsageIndex()
+    provider.addChangeListener(provider.usageIndex)
     realm = pathMapper.getRealm()
+    provider.ioTuning = IOTuning(Setting().get(PluginSettings.IO_TUNING), realm)
+    # Keep locks in a store shared by all worker processes on this host instead of
+    # wsgidav's per-process dictionary
+    locksRoot = Setting().get(PluginSettings.LOCKS_ROOT)
+    lockStorage = WTLockStorage(os.path.join(locksRoot, '%s.sqlite' % realm))
     config = DEFAULT_CONFIG.copy()
     # Accept basic authentication and assume access through HTTPS only. This (HTTPS when only
     # basic is accepted) is enforced by some clients.
@@ -96,21 +299,26 @@ def startDAVServer(rootPath, directoryInitializer, authorizer, pathMapper):
         'wt_home_dirs_root': rootPath,
         'provider_mapping': {'/': provider},
         'user_mapping': {},
-        'middleware_stack': [WsgiDavDirBrowser, directoryInitializer, authorizer,
-                             HTTPAuthenticator, ErrorPrinter, WsgiDavDebugFilter],
+        'locksmanager': lockStorage,
+        'middleware_stack': [WsgiDavDirBrowser, ArchiveDownloader, ArchiveExtractor,
+                             ResumableUploader, ExecutableBatcher, SyncCollectionReporter,
+                             directoryInitializer, authorizer, HTTPAuthenticator,
+                             TokenAuthenticator, ResponseCompressor, IOAccountant,
+                             FastPathResponder, ErrorPrinter, WsgiDavDebugFilter],
+        'trusted_auth_header': TOKEN_USER_KEY,
         'acceptbasic': True,
         'acceptdigest': False,
         'defaultdigest': False,
         'domaincontroller': WTDomainController(realm),
-        'server': 'cherrypy'
+        'server': 'cherrypy',
+        'wt_compression': Setting().get(PluginSettings.COMPRESSION),
+        # used by wsgidav to stream GET and PUT bodies and by our middleware
+        'block_size': provider.ioTuning.blockSize
     })
     # Increase verbosity when running tests.
     if 'GIRDER_TEST_ASSETSTORE' in os.environ:
         config.update({'verbose': 2})
-    global HOME_DIRS_APPS
-    app = WTDAVApp(config)
-    HOME_DIRS_APPS.add(realm, pathMapper, app)
-    cherrypy.tree.graft(app, '/' + realm)
+    return WTDAVApp(config)
 
 
 def setDefaults():
@@ -130,26 +338,84 @@ def setDefaults():
         else:
             # normal /tmp/wt-home-dirs, /tmp/wt-tale-dirs
             SettingDefault.defaults[key] = '/tmp/wt-%s-dirs' % name
+    if 'GIRDER_TEST_ASSETSTORE' in os.environ:
+        SettingDefault.defaults[PluginSettings.LOCKS_ROOT] = tempfile.mkdtemp(prefix='locks')
+    else:
+        SettingDefault.defaults[PluginSettings.LOCKS_ROOT] = '/tmp/wt-dav-locks'
+    SettingDefault.defaults[PluginSettings.INDEX_RESCAN_INTERVAL] = 3600
+    SettingDefault.defaults[PluginSettings.DEDUP] = False
+    SettingDefault.defaults[PluginSettings.SHARDING] = {}
+    SettingDefault.defaults[PluginSettings.PASSWORD_HASHING] = dict(DEFAULT_HASHING)
+    SettingDefault.defaults[PluginSettings.CONTENT_CACHE] = {
+        'maxBytes': DEFAULT_MAX_BYTES, 'maxFileSize': DEFAULT_MAX_FILE_SIZE}
+    SettingDefault.defaults[PluginSettings.COMPRESSION] = {
+        'level': DEFAULT_LEVEL, 'minSize': DEFAULT_MIN_SIZE, 'files': False}
+    SettingDefault.defaults[PluginSettings.IO_TUNING] = {
+        'blockSize': DEFAULT_BLOCK_SIZE, 'largeFileSize': DEFAULT_LARGE_FILE_SIZE,
+        'preallocate': True, 'fadvise': True}
+
+
+# Users and tales whose mapping is deferred by deferredMapping(), per thread
+_deferred = threading.local()
+
+
+@contextlib.contextmanager
+def deferredMapping():
+    """
+    Within this context, the Home folders of users and the workspaces of tales created by
+    the current thread are mapped in bulk when the context exits (see Onboarder), rather
+    than one at a time as they are created. Meant for scripts importing many users or
+    tales; tales created within the context have no workspace until it exits.
+    """
+    if getattr(_deferred, 'pending', None) is not None:
+        # nested; the outer context maps everything
+        yield
+        return
+    _deferred.pending = {'users': [], 'tales': []}
+    try:
+        yield
+    finally:
+        pending = _deferred.pending
+        _deferred.pending = None
+        onboarder = makeOnboarder()
+        onboarder.provisionUsers(pending['users'])
+        onboarder.provisionTales(pending['tales'])
+
+
+def makeOnboarder():
+    settings = Setting()
+    return Onboarder(settings.get(PluginSettings.HOME_DIRS_ROOT),
+                     settings.get(PluginSettings.TALE_DIRS_ROOT))
 
 
 def setHomeFolderMapping(event: events.Event):
     user = event.info
+    pending = getattr(_deferred, 'pending', None)
+    if pending is not None:
+        pending['users'].append(user)
+        return
     homeDirsRoot = Setting().get(PluginSettings.HOME_DIRS_ROOT)
+    # gives the user (the creator) admin access
     homeFolder = Folder().createFolder(
         user, "Home", parentType="user", public=False, creator=user
     )
-    Folder().setUserAccess(homeFolder, user, AccessType.ADMIN, save=False)
 
     absDir = "%s/%s" % (homeDirsRoot, HomePathMapper().davToPhysical("/" + user["login"]))
     absDir = pathlib.Path(absDir)
     absDir.mkdir(parents=True, exist_ok=True)
     homeFolder.update({"fsPath": absDir.as_posix(), "isMapping": True})
-    # We don't want to trigger events here, amirite?
-    Folder().save(homeFolder, validate=True, triggerEvents=False)
+    # The folder was just validated and saved, so only set what changed; we don't want
+    # to trigger events here, amirite?
+    Folder().update({"_id": homeFolder["_id"]}, {"$set": {
+        "fsPath": homeFolder["fsPath"], "isMapping": True}})
 
 
 def setTaleFolderMapping(event: events.Event):
     tale = event.info
+    pending = getattr(_deferred, 'pending', None)
+    if pending is not None:
+        pending['tales'].append(tale)
+        return
     root_path = Setting().get(PluginSettings.TALE_DIRS_ROOT)
     creator = User().load(tale["creatorId"], force=True)
     workspace = Tale()._createAuxFolder(tale, WORKSPACE_NAME, creator=creator)
@@ -157,9 +423,11 @@ def setTaleFolderMapping(event: events.Event):
     absDir = pathlib.Path(absDir)
     absDir.mkdir(parents=True, exist_ok=True)
     workspace.update({'fsPath': absDir.as_posix(), 'isMapping': True})
-    Folder().save(workspace, validate=True, triggerEvents=False)
+    Folder().update({'_id': workspace['_id']}, {'$set': {
+        'fsPath': workspace['fsPath'], 'isMapping': True}})
+    # the tale was saved just before this event; saving all of it again is not needed
     tale["workspaceId"] = workspace["_id"]
-    tale = Tale().save(tale)
+    Tale().update({'_id': tale['_id']}, {'$set': {'workspaceId': workspace['_id']}})
     event.addResponse(tale)
 
 
@@ -168,35 +436,96 @@ def deleteWorkspace(event: events.Event):
     if (workspace := Folder().load(tale["workspaceId"], force=True)):
         if "fsPath" in workspace:
             shutil.rmtree(workspace["fsPath"])
+            WorkspaceManifest().removeRoot(workspace["fsPath"])
+            TaleDirectoryInitializer.initializedFor.remove(os.path.relpath(
+                workspace["fsPath"], Setting().get(PluginSettings.TALE_DIRS_ROOT)))
         Folder().remove(workspace)
 
 
+def forgetToken(event: events.Event):
+    WTDomainController.tokenCache.remove(str(event.info['_id']))
+    FastPathResponder.forget()
+
+
+def forgetUser(event: events.Event):
+    # the status, admin flag, groups or login may have changed
+    WTDomainController.userCache.forget(event.info)
+    FastPathResponder.forget()
+
+
 def load(info):
+    start = time.time()
     setDefaults()
+    TokenScope.describeScope(DAV_TOKEN_SCOPE, 'WebDAV access',
+                             'Read and write home, tale and run directories through WebDAV.')
 
     settings = Setting()
+    # caches shared by the processes on this host live next to the lock databases
+    configureSharedCaches(os.path.join(settings.get(PluginSettings.LOCKS_ROOT),
+                                       'cache.sqlite'))
+    applySharding()
+    Monitor(cherrypy.engine, applySharding, frequency=SHARDING_POLL_INTERVAL,
+            name='wt_home_dirs sharding').subscribe()
+    # fsPath is looked up by prefix when directories are moved
+    Folder().ensureIndex(('fsPath', {'sparse': True}))
+
+    contentCache = None
+    cacheConfig = settings.get(PluginSettings.CONTENT_CACHE)
+    if cacheConfig.get('maxBytes') and cacheConfig.get('maxFileSize'):
+        contentCache = ContentCache(cacheConfig['maxBytes'], cacheConfig['maxFileSize'])
 
     homeDirsRoot = settings.get(PluginSettings.HOME_DIRS_ROOT)
     logger.info('WT Home Dirs root: %s' % homeDirsRoot)
-    startDAVServer(homeDirsRoot, HomeDirectoryInitializer, HomeAuthorizer, HomePathMapper())
+    startDAVServer(homeDirsRoot, HomeDirectoryInitializer, HomeAuthorizer, HomePathMapper(),
+                   contentCache)
 
     taleDirsRoot = settings.get(PluginSettings.TALE_DIRS_ROOT)
     logger.info('WT Tale Dirs root: %s' % taleDirsRoot)
-    startDAVServer(taleDirsRoot, TaleDirectoryInitializer, TaleAuthorizer, TalePathMapper())
+    startDAVServer(taleDirsRoot, TaleDirectoryInitializer, TaleAuthorizer, TalePathMapper(),
+                   contentCache)
 
     runsDirsRoot = settings.get(PluginSettings.RUNS_DIRS_ROOT)
     if runsDirsRoot:
         logger.info('WT Runs Dirs root: %s' % runsDirsRoot)
-        startDAVServer(runsDirsRoot, RunsDirectoryInitializer, RunsAuthorizer, RunsPathMapper())
+        startDAVServer(runsDirsRoot, RunsDirectoryInitializer, RunsAuthorizer, RunsPathMapper(),
+                       contentCache)
 
     events.unbind('model.user.save.created', CoreEventHandler.USER_DEFAULT_FOLDERS)
     events.bind('model.user.save.created', 'wt_home_dirs', setHomeFolderMapping)
     events.bind('model.tale.save.created', 'wt_home_dirs', setTaleFolderMapping)
     events.bind('model.tale.remove', 'wt_home_dirs', deleteWorkspace)
+    events.bind('model.token.remove', 'wt_home_dirs', forgetToken)
+    events.bind('model.user.save.after', 'wt_home_dirs', forgetUser)
+    events.bind('model.user.remove', 'wt_home_dirs', forgetUser)
 
     hdp = Homedirpass()
     info['apiRoot'].homedirpass = hdp
     info['apiRoot'].homedirpass.route('GET', ('generate',), hdp.generatePassword)
     info['apiRoot'].homedirpass.route('PUT', ('set',), hdp.setPassword)
+    info['apiRoot'].homedirpass.route('GET', ('benchmark',), hdp.benchmark)
+
+    hd = Homedirs(HOME_DIRS_APPS)
+    info['apiRoot'].homedirs = hd
+    info['apiRoot'].homedirs.route('GET', (':id', 'manifest'), hd.getManifest)
+    info['apiRoot'].homedirs.route('GET', (':id', 'size'), hd.getSize)
+    info['apiRoot'].homedirs.route('PUT', (':id', 'rescan'), hd.rescan)
+    info['apiRoot'].homedirs.route('POST', ('runs', 'provision'), hd.provisionRuns)
+    info['apiRoot'].homedirs.route('POST', ('onboard',), hd.onboard)
+    info['apiRoot'].homedirs.route('GET', ('sharding',), hd.getSharding)
+    info['apiRoot'].homedirs.route('PUT', ('sharding',), hd.setSharding)
+    info['apiRoot'].homedirs.route('GET', ('io',), hd.getIOStats)
+    info['apiRoot'].homedirs.route('GET', ('orphans',), hd.scanOrphans)
+    info['apiRoot'].homedirs.route('POST', ('orphans', 'reclaim'), hd.reclaimOrphans)
+
+    # Pick up changes not made through DAV; the task itself checks the rescan interval
+    Monitor(cherrypy.engine, WorkspaceIndexer().rescanStale, frequency=60,
+            name='wt_home_dirs rescan').subscribe()
+    # directories followed by sync clients (see SyncCollectionReporter)
+    Monitor(cherrypy.engine, WorkspaceIndexer().rescanWatched, frequency=15,
+            name='wt_home_dirs sync rescan').subscribe()
+    # directories whose quota properties were asked for (see UsageIndex)
+    Monitor(cherrypy.engine, UsageIndex().refresh, frequency=5,
+            name='wt_home_dirs usage').subscribe()
 
     Tale().exposeFields(level=AccessType.READ, fields={"workspaceId"})
+    logger.info('wt_home_dirs loaded in %.3fs' % (time.time() - start))
@@ -2,9 +2,28 @@
 # -*- coding: utf-8 -*-
 
 WORKSPACE_NAME = "WholeTale Workspaces"
+# Directory under each realm root for partially received data. It is on the same
+# filesystem as the user directories, so finished files can be moved in place atomically.
+STAGING_DIR = ".wt-staging"
+# Directory under each realm root holding the content-addressed store used for
+# deduplication (see lib/ContentStore.py)
+CAS_DIR = ".wt-cas"
+# How often, in seconds, each server process picks up changes to the sharding schemes
+SHARDING_POLL_INTERVAL = 30
+# Token scope granting WebDAV access only; tokens with the user authentication scope are
+# accepted too
+DAV_TOKEN_SCOPE = "wt_home_dir.dav"
 
 
 class PluginSettings:
     HOME_DIRS_ROOT = "wthome.homedir_root"
     TALE_DIRS_ROOT = "wthome.taledir_root"
     RUNS_DIRS_ROOT = "wtversioning.runs_root"  # FIXME
+    LOCKS_ROOT = "wthome.locks_root"
+    INDEX_RESCAN_INTERVAL = "wthome.index_rescan_interval"
+    DEDUP = "wthome.dedup"
+    SHARDING = "wthome.sharding"
+    PASSWORD_HASHING = "wthome.password_hashing"
+    COMPRESSION = "wthome.compression"
+    CONTENT_CACHE = "wthome.content_cache"
+    IO_TUNING = "wthome.io_tuning"
@@ -0,0 +1,192 @@
+import os
+import tarfile
+import zipfile
+from urllib.parse import parse_qs
+
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST, HTTP_NOT_FOUND
+from wsgidav.middleware import BaseMiddleware
+from wsgidav import util
+
+_logger = util.getModuleLogger(__name__, True)
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+ARCHIVE_FORMATS = {
+    # format: (content type, file extension)
+    'zip': ('application/zip', 'zip'),
+    'tgz': ('application/gzip', 'tar.gz'),
+    'tar.gz': ('application/gzip', 'tar.gz'),
+    'tar': ('application/x-tar', 'tar'),
+}
+
+# Deflating these again costs CPU and gains nothing
+COMPRESSED_EXTENSIONS = set([
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.jar', '.whl',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.m4a', '.mkv', '.mov',
+    '.avi', '.webm', '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.parquet'
+])
+
+
+class _ChunkBuffer:
+    """A write-only file object collecting archiver output until it is drained."""
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+class ArchiveDownloader(BaseMiddleware):
+    """
+    Streams a collection as an archive built on the fly, e.g.:
+
+        GET /tales/<taleId>/dir?archive=zip
+
+    Supported formats are zip, tgz (or tar.gz) and tar. For zip archives, files that
+    are already compressed (judging by their extension) are stored rather than
+    deflated; `compress=none` stores everything and `compress=all` deflates everything.
+
+    Authorization is done once, for the collection, by the authorizer further up the
+    stack; the members are then read directly from the physical tree, so no per-file
+    DAV requests or checks are involved. Memory use is bounded by the block size
+    regardless of the size of the files.
+    """
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+        self.blockSize = config.get('block_size', DEFAULT_BLOCK_SIZE)
+
+    def __call__(self, environ, start_response):
+        query = environ.get('QUERY_STRING', '')
+        if environ['REQUEST_METHOD'] != 'GET' or 'archive=' not in query:
+            return self.application(environ, start_response)
+        params = parse_qs(query)
+        format = params.get('archive', [''])[0].lower()
+        if format not in ARCHIVE_FORMATS:
+            raise DAVError(HTTP_BAD_REQUEST, 'Unsupported archive format: %s' % format)
+        compress = params.get('compress', ['auto'])[0].lower()
+        if compress not in ('auto', 'none', 'all'):
+            raise DAVError(HTTP_BAD_REQUEST, 'Invalid compress value: %s' % compress)
+
+        res = environ['wsgidav.provider'].getResourceInst(environ['PATH_INFO'], environ)
+        if res is None:
+            raise DAVError(HTTP_NOT_FOUND)
+        if not res.isCollection:
+            raise DAVError(HTTP_BAD_REQUEST, 'Only collections can be archived')
+
+        contentType, ext = ARCHIVE_FORMATS[format]
+        name = res.name or 'archive'
+        start_response('200 OK', [('Content-Type', contentType),
+                                  ('Content-Disposition',
+                                   'attachment; filename="%s.%s"' % (name, ext)),
+                                  ('Date', util.getRfc1123Time())])
+        if format == 'zip':
+            return self._streamZip(res._filePath, name, compress)
+        else:
+            return self._streamTar(res._filePath, name, format != 'tar')
+
+    def _walk(self, root, arcroot):
+        # Yields (physical path, archive name, DirEntry) for the tree under root. Only
+        # regular files and directories are included; symlinks could point outside of
+        # the authorized tree.
+        stack = [(root, arcroot)]
+        while stack:
+            dir, arcdir = stack.pop()
+            try:
+                entries = sorted(os.scandir(dir), key=lambda e: e.name)
+            except OSError as ex:
+                _logger.warning('Cannot list %s: %s' % (dir, ex))
+                continue
+            for entry in entries:
+                arcname = '%s/%s' % (arcdir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.path, arcname, entry
+                    stack.append((entry.path, arcname))
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, arcname, entry
+
+    def _compressType(self, arcname, compress):
+        if compress == 'none':
+            return zipfile.ZIP_STORED
+        if compress == 'auto' and os.path.splitext(arcname)[1].lower() in COMPRESSED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def _streamZip(self, root, arcroot, compress):
+        buf = _ChunkBuffer()
+        # The buffer is not seekable, so zipfile writes sizes and CRCs in data
+        # descriptors and switches entries to zip64 when they need it.
+        with zipfile.ZipFile(buf, mode='w', allowZip64=True) as zf:
+            for path, arcname, entry in self._walk(root, arcroot):
+                try:
+                    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                    if entry.is_dir(follow_symlinks=False):
+                        zf.writestr(zinfo, b'')
+                        continue
+                    zinfo.compress_type = self._compressType(arcname, compress)
+                    with open(path, 'rb') as src, zf.open(zinfo, mode='w') as dst:
+                        while True:
+                            data = src.read(self.blockSize)
+                            if not data:
+                                break
+                            dst.write(data)
+                            if buf.size >= self.blockSize:
+                                yield buf.drain()
+                except OSError as ex:
+                    # the file may have been removed in the meantime
+                    _logger.warning('Skipping %s: %s' % (path, ex))
+                if buf.size >= self.blockSize:
+                    yield buf.drain()
+        yield buf.drain()
+
+    def _streamTar(self, root, arcroot, gzip):
+        buf = _ChunkBuffer()
+        with tarfile.open(fileobj=buf, mode='w|gz' if gzip else 'w|') as tf:
+            for path, arcname, entry in self._walk(root, arcroot):
+                try:
+                    tinfo = tf.gettarinfo(path, arcname)
+                    src = open(path, 'rb') if tinfo.isreg() else None
+                except OSError as ex:
+                    # the file may have been removed in the meantime
+                    _logger.warning('Skipping %s: %s' % (path, ex))
+                    continue
+                # directories and hard links to files already in the archive have no data
+                tf.addfile(tinfo)
+                if src is not None:
+                    # TarFile.addfile() would copy the whole file into the buffer before
+                    # we get a chance to send it, so write the data ourselves. If the
+                    # file changes size while being read, the archive cannot be fixed,
+                    # so the OSError is left to abort the response.
+                    with src:
+                        remaining = tinfo.size
+                        while remaining > 0:
+                            data = src.read(min(self.blockSize, remaining))
+                            if not data:
+                                raise OSError('%s was truncated while reading' % path)
+                            tf.fileobj.write(data)
+                            remaining -= len(data)
+                            if buf.size >= self.blockSize:
+                                yield buf.drain()
+                    blocks, remainder = divmod(tinfo.size, tarfile.BLOCKSIZE)
+                    if remainder > 0:
+                        tf.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                        blocks += 1
+                    tf.offset += blocks * tarfile.BLOCKSIZE
+                # TarFile keeps every member; we don't need them
+                tf.members = []
+                if buf.size >= self.blockSize:
+                    yield buf.drain()
+        yield buf.drain()
@@ -0,0 +1,287 @@
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from urllib.parse import parse_qs
+
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST, HTTP_CONFLICT, HTTP_FORBIDDEN, \
+    HTTP_INSUFFICIENT_STORAGE, HTTP_LENGTH_REQUIRED
+from wsgidav.middleware import BaseMiddleware
+from wsgidav import util
+from girder.utility.progress import ProgressContext
+
+from ..constants import STAGING_DIR
+from .ContentStore import HashingWriter
+from .RequestContext import RequestContext
+from .WTFilesystemProvider import CHANGE_WRITE
+
+_logger = util.getModuleLogger(__name__, True)
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+EXTRACT_FORMATS = set(['auto', 'zip', 'tar', 'tgz', 'tar.gz'])
+MAX_REPORTED_SKIPS = 100
+
+
+class _InputReader:
+    """A file-like view of the request body that stops at Content-Length."""
+    def __init__(self, environ, contentLength):
+        self.environ = environ
+        self.input = environ['wsgi.input']
+        self.remaining = contentLength
+        self.consumed = 0
+        self.pushback = b''
+
+    def peek(self, n):
+        data = self.read(n)
+        self.pushback = data + self.pushback
+        return data
+
+    def read(self, n=-1):
+        if self.pushback:
+            if n is None or n < 0:
+                data, self.pushback = self.pushback + self._read(-1), b''
+            else:
+                data, self.pushback = self.pushback[:n], self.pushback[n:]
+            return data
+        return self._read(n)
+
+    def _read(self, n):
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                self.environ['wsgidav.all_input_read'] = 1
+                return b''
+            n = self.remaining if n is None or n < 0 else min(n, self.remaining)
+        data = self.input.read(n)
+        self.environ['wsgidav.some_input_read'] = 1
+        self.consumed += len(data)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+            if len(data) == 0:
+                # client went away
+                raise DAVError(HTTP_BAD_REQUEST, 'Request body is shorter than Content-Length')
+        if self.remaining == 0 or (self.remaining is None and len(data) == 0):
+            self.environ['wsgidav.all_input_read'] = 1
+        return data
+
+    def discard(self, blockSize):
+        while self.read(blockSize):
+            pass
+
+
+class ArchiveExtractor(BaseMiddleware):
+    """
+    Extracts an archive sent to a collection into that collection, e.g.:
+
+        PUT /tales/<taleId>/data?extract=tgz
+
+    (POST is accepted as well). The format is one of zip, tar, tgz (or tar.gz) or auto,
+    in which case it is guessed from the content. Tar archives are extracted while they
+    are being received; zip archives need their central directory, which is at the end,
+    so they are first spooled to the realm's staging area.
+
+    The whole upload goes through authentication, authorization, lock checks and directory
+    initialization once, instead of once per file. Free space is measured once: zip
+    archives are refused up front if their files do not fit, and tar archives as soon as
+    what was extracted exceeds it (the file being written is removed; those before it are
+    kept).
+    Member names are sanitized: absolute paths, '..' components and paths that would
+    resolve outside of the target collection (e.g., through existing symlinks) are
+    rejected, and only regular files and directories are extracted. Progress is
+    reported through Girder notifications.
+    """
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+        self.blockSize = config.get('block_size', DEFAULT_BLOCK_SIZE)
+
+    def __call__(self, environ, start_response):
+        query = environ.get('QUERY_STRING', '')
+        if environ['REQUEST_METHOD'] not in ('PUT', 'POST') or 'extract=' not in query:
+            return self.application(environ, start_response)
+        format = parse_qs(query).get('extract', [''])[0].lower()
+        if format not in EXTRACT_FORMATS:
+            raise DAVError(HTTP_BAD_REQUEST, 'Unsupported archive format: %s' % format)
+
+        provider = environ['wsgidav.provider']
+        if provider.isReadOnly():
+            raise DAVError(HTTP_FORBIDDEN)
+        res = provider.getResourceInst(environ['PATH_INFO'], environ)
+        if res is None or not res.isCollection:
+            raise DAVError(HTTP_CONFLICT, 'Archives must be extracted into an existing '
+                                          'collection')
+
+        if provider.lockManager is not None:
+            util.parseIfHeaderDict(environ)
+            # any lock below the collection conflicts, as when deleting it
+            provider.lockManager.checkWritePermission(
+                res.getRefUrl(), 'infinity', environ['wsgidav.ifLockTokenList'],
+                environ.get('http_authenticator.username'))
+
+        contentLength = self._getContentLength(environ)
+        target = os.path.realpath(res._filePath)
+        available = self._freeSpace(target)
+        if (contentLength or 0) > available:
+            raise DAVError(HTTP_INSUFFICIENT_STORAGE)
+
+        reader = _InputReader(environ, contentLength)
+        stats = {'files': 0, 'directories': 0, 'bytes': 0, 'skipped': 0, 'skippedNames': []}
+        user = RequestContext.of(environ).user
+        with ProgressContext(user is not None, user=user, title='Extracting archive into %s'
+                             % environ['PATH_INFO'], total=contentLength or 0) as progress:
+            if format == 'zip' or (format == 'auto' and self._looksLikeZip(reader)):
+                self._extractZip(reader, target, stats, progress, provider.contentStore)
+            else:
+                self._extractTar(reader, target, stats, progress, provider.contentStore,
+                                 available)
+        reader.discard(self.blockSize)
+        provider.notifyChange(CHANGE_WRITE, environ['PATH_INFO'], environ)
+
+        body = json.dumps(stats).encode('utf8')
+        start_response('201 Created', [('Content-Type', 'application/json'),
+                                       ('Content-Length', str(len(body))),
+                                       ('Date', util.getRfc1123Time())])
+        return [body]
+
+    def _getContentLength(self, environ):
+        try:
+            contentLength = int(environ.get('CONTENT_LENGTH', ''))
+        except ValueError:
+            contentLength = None
+        if contentLength is None or contentLength < 0:
+            if environ.get('HTTP_TRANSFER_ENCODING', '').lower() != 'chunked':
+                raise DAVError(HTTP_LENGTH_REQUIRED)
+            # the server de-chunks wsgi.input; read until EOF
+            return None
+        return contentLength
+
+    def _freeSpace(self, path):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+
+    def _looksLikeZip(self, reader):
+        # zip archives start with a local file header
+        return reader.peek(4) == b'PK\x03\x04'
+
+    def _destination(self, target, name):
+        # Returns the physical path for archive member <name>, or None if the name is
+        # not acceptable
+        name = name.replace('\\', '/')
+        if name.startswith('/') or (len(name) > 1 and name[1] == ':'):
+            return None
+        parts = [p for p in posixpath.normpath(name).split('/') if p not in ('', '.')]
+        if '..' in parts:
+            return None
+        # an empty name (e.g., "./") is the target itself
+        return os.path.join(target, *parts)
+
+    def _ensureInside(self, target, path):
+        # Existing symlinks in the tree must not redirect writes outside of it
+        parent = os.path.realpath(os.path.dirname(path))
+        if parent != target and not parent.startswith(target + os.sep):
+            return False
+        return not os.path.islink(path)
+
+    def _mkdir(self, target, path, stats):
+        if path == target:
+            return True
+        if not self._ensureInside(target, path):
+            return False
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+            stats['directories'] += 1
+        return True
+
+    def _writeFile(self, target, path, src, stats, store, limit=None):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            if not self._mkdir(target, parent, stats):
+                return False
+        if path == target or not self._ensureInside(target, path) or os.path.isdir(path):
+            return False
+        if os.path.exists(path):
+            # Like WTFileResource.beginWrite(), replace rather than overwrite so that
+            # content hard-linked elsewhere is preserved
+            os.remove(path)
+        with open(path, 'wb') as file:
+            dst = file if store is None else HashingWriter(file)
+            while True:
+                data = src.read(self.blockSize)
+                if not data:
+                    break
+                dst.write(data)
+                stats['bytes'] += len(data)
+                if limit is not None and stats['bytes'] > limit:
+                    file.close()
+                    os.remove(path)
+                    raise DAVError(HTTP_INSUFFICIENT_STORAGE)
+        if store is not None:
+            store.addFile(path, dst.hexdigest())
+        stats['files'] += 1
+        return True
+
+    def _skip(self, name, stats, reason):
+        _logger.warning('Not extracting %r: %s' % (name, reason))
+        stats['skipped'] += 1
+        if len(stats['skippedNames']) < MAX_REPORTED_SKIPS:
+            stats['skippedNames'].append(name)
+
+    def _extractTar(self, reader, target, stats, progress, store, limit):
+        try:
+            tf = tarfile.open(fileobj=reader, mode='r|*',
+                              bufsize=self.blockSize)
+        except tarfile.TarError as ex:
+            raise DAVError(HTTP_BAD_REQUEST, 'Invalid archive: %s' % ex)
+        with tf:
+            try:
+                for member in tf:
+                    path = self._destination(target, member.name)
+                    if path is None:
+                        self._skip(member.name, stats, 'invalid path')
+                    elif member.isdir():
+                        if not self._mkdir(target, path, stats):
+                            self._skip(member.name, stats, 'outside of target')
+                    elif member.isreg():
+                        src = tf.extractfile(member)
+                        if not self._writeFile(target, path, src, stats, store, limit):
+                            self._skip(member.name, stats, 'outside of target')
+                    else:
+                        self._skip(member.name, stats, 'not a regular file or directory')
+                    progress.update(current=reader.consumed, message=member.name)
+            except tarfile.TarError as ex:
+                raise DAVError(HTTP_BAD_REQUEST, 'Invalid archive: %s' % ex)
+
+    def _extractZip(self, reader, target, stats, progress, store):
+        stagingDir = os.path.join(self.config['wt_home_dirs_root'], STAGING_DIR)
+        os.makedirs(stagingDir, exist_ok=True)
+        with tempfile.TemporaryFile(dir=stagingDir) as spool:
+            shutil.copyfileobj(reader, spool, self.blockSize)
+            spool.seek(0)
+            try:
+                zf = zipfile.ZipFile(spool)
+            except zipfile.BadZipFile as ex:
+                raise DAVError(HTTP_BAD_REQUEST, 'Invalid archive: %s' % ex)
+            with zf:
+                members = zf.infolist()
+                if sum(m.file_size for m in members) > self._freeSpace(target):
+                    raise DAVError(HTTP_INSUFFICIENT_STORAGE)
+                progress.update(total=len(members), current=0, force=True)
+                for i, member in enumerate(members):
+                    path = self._destination(target, member.filename)
+                    # the high bits of external_attr hold the unix mode, if any
+                    mode = member.external_attr >> 16
+                    if path is None:
+                        self._skip(member.filename, stats, 'invalid path')
+                    elif member.is_dir():
+                        if not self._mkdir(target, path, stats):
+                            self._skip(member.filename, stats, 'outside of target')
+                    elif mode and (mode & 0o170000) not in (0, 0o100000):
+                        self._skip(member.filename, stats, 'not a regular file or directory')
+                    else:
+                        with zf.open(member) as src:
+                            if not self._writeFile(target, path, src, stats, store):
+                                self._skip(member.filename, stats, 'outside of target')
+                    progress.update(current=i + 1, message=member.filename)
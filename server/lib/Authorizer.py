@@ -4,11 +4,14 @@ from girder.models.folder import Folder
 from girder.utility.model_importer import ModelImporter
 from girder.constants import AccessType
 from girder.exceptions import AccessException, ValidationException
-import pathlib
+from .RequestContext import RequestContext
+from .WTDomainController import Cache
 
 _logger = util.getModuleLogger(__name__, True)
 
-DAV_READ_OPS = set(['HEAD', 'GET', 'PROPFIND', 'OPTIONS'])
+DAV_READ_OPS = set(['HEAD', 'GET', 'PROPFIND', 'OPTIONS', 'REPORT'])
+# How long the folders of a run are used for access checks before being reloaded
+RUN_CACHE_TTL = 60.0
 
 
 class Authorizer(BaseMiddleware):
@@ -18,26 +21,23 @@ class Authorizer(BaseMiddleware):
         self.config = config
 
     def __call__(self, environ, start_response):
-        userName = self.getUserName(environ)
-        environ['WT_DAV_AUTHORIZED_USER'] = userName
-        return self.checkAccess(userName, environ, start_response)
-
-    def getUserName(self, environ):
-        if 'TOKEN_USER' in environ:
-            return environ['TOKEN_USER']['login']
-        if 'http_authenticator.username' in environ:
-            return environ['http_authenticator.username']
-        return None
-
-    def checkAccess(self, userName, environ, start_response):
-        path = environ['PATH_INFO']
-        if userName is None or userName == '':
-            body = self.buildMustAuthenticateBody(path)
+        context = RequestContext.of(environ)
+        context.userName = self.getUserName(environ, context)
+        return self.checkAccess(context, environ, start_response)
+
+    def getUserName(self, environ, context):
+        if context.user is not None:
+            return context.user.login
+        return environ.get('http_authenticator.username')
+
+    def checkAccess(self, context, environ, start_response):
+        if context.userName is None or context.userName == '':
+            body = self.buildMustAuthenticateBody(context.path)
             return self.sendNotAuthorizedResponse(body, environ, start_response)
 
-        return self._checkAccess(userName, path, environ, start_response)
+        return self._checkAccess(context, environ, start_response)
 
-    def _checkAccess(self, userName, path, environ, start_response):
+    def _checkAccess(self, context, environ, start_response):
         pass
 
     def buildNotAuthorizedResponseBody(self, userName, path):
@@ -63,13 +63,13 @@ class HomeAuthorizer(Authorizer):
     def __init__(self, application, config):
         Authorizer.__init__(self, application, config)
 
-    def _checkAccess(self, userName, path, environ, start_response):
+    def _checkAccess(self, context, environ, start_response):
         # allow /<userName> and /<userName>/*
         # should probably check that login names don't allow things like '../../etc'
-        if path == ('/%s' % userName) or path.startswith('/%s/' % userName):
+        if context.parts and context.parts[0] == context.userName:
             return self.application(environ, start_response)
         else:
-            body = self.buildNotAuthorizedResponseBody(userName, path)
+            body = self.buildNotAuthorizedResponseBody(context.userName, context.path)
             return self.sendNotAuthorizedResponse(body, environ, start_response)
 
 
@@ -78,20 +78,18 @@ class TaleAuthorizer(Authorizer):
         Authorizer.__init__(self, application, config)
         self.taleModel = ModelImporter.model('tale', 'wholetale')
 
-    def _checkAccess(self, userName, spath: str, environ, start_response):
+    def _checkAccess(self, context, environ, start_response):
         # allow access to /<tale> and /<tale>/* if:
         #   it's a write op and user has admin access on tale
         #   it's a read op and user has read access on tale
         # otherwise, deny access
 
-        path = pathlib.Path(spath)
-
-        if len(path.parts) < 2:
-            body = self.buildNotAuthorizedResponseBody(userName, path)
+        if not context.parts:
+            body = self.buildNotAuthorizedResponseBody(context.userName, context.path)
             return self.sendNotAuthorizedResponse(body, environ, start_response)
 
-        taleId = self.getTaleId(path)
-        user = environ['WT_DAV_USER_DICT']
+        taleId = context.parts[0]
+        user = context.user
 
         if self.isReadOp(environ):
             access_level = AccessType.READ
@@ -101,31 +99,33 @@ class TaleAuthorizer(Authorizer):
         try:
             tale = self.taleModel.load(taleId, user=user, level=access_level, exc=True)
         except (AccessException, ValidationException):
-            body = self.buildNotAuthorizedResponseBody(userName, path)
+            body = self.buildNotAuthorizedResponseBody(context.userName, context.path)
             return self.sendNotAuthorizedResponse(body, environ, start_response)
 
-        environ['WT_DAV_TALE_DICT'] = tale
-        environ['WT_DAV_TALE_ID'] = taleId
+        context.tale = tale
+        context.taleId = taleId
         return self.application(environ, start_response)
 
-    def getTaleId(self, path: pathlib.Path):
-        return path.parts[1]
-
     def isReadOp(self, environ):
         return environ['REQUEST_METHOD'] in DAV_READ_OPS
 
 
 class RunsAuthorizer(Authorizer):
+    # run id -> (run folder, parent folder); shared by all instances and filled ahead
+    # of time by RunsProvisioner
+    runCache = Cache(RUN_CACHE_TTL)
 
-    def _checkAccess(self, userName, spath: str, environ, start_response):
-        path = pathlib.Path(spath)
+    @classmethod
+    def cacheRun(cls, run, parent):
+        cls.runCache.set(str(run['_id']), (run, parent))
 
-        if len(path.parts) < 2:
-            body = self.buildNotAuthorizedResponseBody(userName, path)
+    def _checkAccess(self, context, environ, start_response):
+        if not context.parts:
+            body = self.buildNotAuthorizedResponseBody(context.userName, context.path)
             return self.sendNotAuthorizedResponse(body, environ, start_response)
 
-        runId = path.parts[1]
-        user = environ['WT_DAV_USER_DICT']
+        runId = context.parts[0]
+        user = context.user
 
         if self.isReadOp(environ):
             access_level = AccessType.READ
@@ -133,15 +133,23 @@ class RunsAuthorizer(Authorizer):
             access_level = AccessType.WRITE
 
         try:
-            run_dir = Folder().load(runId, user=user, level=access_level, exc=True)
-            parent = Folder().load(run_dir["parentId"], user=user, level=access_level, exc=True)
+            cached = self.runCache.get(runId)
+            if cached is None:
+                run_dir = Folder().load(runId, force=True, exc=True)
+                parent = Folder().load(run_dir["parentId"], force=True, exc=True)
+                self.cacheRun(run_dir, parent)
+            else:
+                run_dir, parent = cached
+            # the documents may be cached, but access is checked on every request
+            Folder().requireAccess(run_dir, user=user, level=access_level)
+            Folder().requireAccess(parent, user=user, level=access_level)
         except (AccessException, ValidationException):
-            body = self.buildNotAuthorizedResponseBody(userName, path)
+            body = self.buildNotAuthorizedResponseBody(context.userName, context.path)
             return self.sendNotAuthorizedResponse(body, environ, start_response)
 
-        environ['WT_DAV_RUN_DICT'] = run_dir
-        environ['WT_DAV_RUN_ID'] = str(run_dir["_id"])
-        environ['WT_DAV_TALE_ID'] = parent["name"]
+        context.run = run_dir
+        context.runId = str(run_dir["_id"])
+        context.taleId = parent["name"]
         return self.application(environ, start_response)
 
     def isReadOp(self, environ):
@@ -0,0 +1,105 @@
+import collections
+import io
+import os
+import threading
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+
+
+def statKey(filestat):
+    """What identifies a version of a file: a rewritten file has a new inode (see
+    WTFileResource.beginWrite()) or, if modified in place, a new mtime."""
+    return filestat.st_ino, filestat.st_size, filestat.st_mtime_ns
+
+
+class ContentCache:
+    """
+    Keeps the content of small files (up to <maxFileSize> bytes) that are read through
+    WebDAV in memory, up to <maxBytes> in total, evicting the least recently used files.
+    Entries are keyed by physical path and only used while the file's inode, size and
+    mtime are those it was read with, so changes made behind the provider's back are
+    picked up; changes made through the provider drop entries right away (see
+    invalidate()). One instance is shared by all realms.
+    """
+    def __init__(self, maxBytes=DEFAULT_MAX_BYTES, maxFileSize=DEFAULT_MAX_FILE_SIZE):
+        self.maxBytes = maxBytes
+        self.maxFileSize = min(maxFileSize, maxBytes)
+        self.size = 0
+        # path -> (statKey, data)
+        self.entries = collections.OrderedDict()
+        # directory -> paths of the entries in it, to drop the entries below a directory
+        self.dirs = collections.defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def isCacheable(self, filestat):
+        return filestat.st_size <= self.maxFileSize
+
+    def open(self, path, filestat, counters=None):
+        """Returns a file object with the content of the file at <path>, whose stat is
+        <filestat>, from memory if possible. Reads from disk are counted in <counters>
+        (see IOCounters)."""
+        key = statKey(filestat)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return io.BytesIO(entry[1])
+            self.misses += 1
+        with open(path, 'rb') as f:
+            # what is read is only cached if it is the version that was stat-ed
+            current = statKey(os.fstat(f.fileno()))
+            data = f.read()
+        if counters is not None:
+            counters.filesOpened += 1
+            counters.bytesRead += len(data)
+        if current == key and len(data) == filestat.st_size:
+            self._put(path, key, data)
+        return io.BytesIO(data)
+
+    def _put(self, path, key, data):
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = (key, data)
+            self.dirs[os.path.dirname(path)].add(path)
+            self.size += len(data)
+            while self.size > self.maxBytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return False
+        self.size -= len(entry[1])
+        dirname = os.path.dirname(path)
+        paths = self.dirs[dirname]
+        paths.discard(path)
+        if not paths:
+            del self.dirs[dirname]
+        return True
+
+    def remove(self, path):
+        """Drops the entry of the file at <path> or, if it is a directory, of all the files
+        below it."""
+        with self.lock:
+            if self._remove(path):
+                return
+            prefix = path.rstrip('/') + '/'
+            for dirname in [d for d in self.dirs if d + '/' == prefix or d.startswith(prefix)]:
+                for p in list(self.dirs.get(dirname, ())):
+                    self._remove(p)
+
+    def invalidate(self, change):
+        """A provider change listener (see WTFilesystemProvider.addChangeListener())."""
+        self.remove(change.filePath)
+        if change.destPath is not None:
+            self.remove(change.destFilePath)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.dirs.clear()
+            self.size = 0
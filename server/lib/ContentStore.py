@@ -0,0 +1,188 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+from girder import logger
+
+# Files smaller than this are not worth a lookup and a clone
+DEFAULT_MIN_SIZE = 64 * 1024
+# Blobs that have not been cloned for this long are removed
+BLOB_TTL = 7 * 24 * 3600
+# ioctl(dest, FICLONE, src), from linux/fs.h
+FICLONE = 0x40049409
+# What clone() fails with when the filesystem cannot share data between files
+_NO_REFLINK_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV,
+                      errno.ENOSYS)
+
+
+class HashingWriter:
+    """Wraps a file being written, computing the sha256 of the data on the way."""
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def hashFile(path, blockSize=1024 * 1024):
+    """Returns the sha256 of the content of the file at <path>."""
+    hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(blockSize)
+            if not data:
+                break
+            hash.update(data)
+    return hash.hexdigest()
+
+
+def breakLink(path):
+    """Gives <path> its own copy of its data if it shares it with other hard links (e.g.,
+    in runs or versions), so that it can be modified in place (e.g., chmod-ed) without
+    affecting the others."""
+    if os.stat(path).st_nlink <= 1:
+        return
+    tmpPath = '%s.%s.wt-copy' % (path, uuid.uuid4().hex)
+    shutil.copy2(path, tmpPath)
+    os.replace(tmpPath, path)
+
+
+def clone(src, dst):
+    """Creates <dst> as a reflink copy of <src>: a separate file that shares the data
+    of <src> until either is modified. Raises OSError if the filesystem does not
+    support it."""
+    with open(src, 'rb') as srcFile, open(dst, 'xb') as dstFile:
+        try:
+            fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+        except OSError:
+            os.unlink(dst)
+            raise
+
+
+class ContentStore:
+    """
+    A content-addressed store of file data, used to deduplicate files across the
+    directories of a realm. The store holds one blob per distinct content, named by its
+    sha256 (<root>/ab/cd/abcd...), and files with the same content are made reflink
+    copies (see clone()) of that blob. Unlike hard links, reflinks are separate inodes
+    that only share data blocks, copied on write by the filesystem, so files in
+    different tales or homes never see each other's changes, modes or times. On
+    filesystems without reflinks (e.g., ext4), nothing is deduplicated.
+
+    Blobs are not reference counted; removing one does not affect the files cloned
+    from it, it only means the next identical file is not deduplicated with them.
+    Blobs that were not used for BLOB_TTL seconds are removed.
+    """
+    def __init__(self, root, minSize=DEFAULT_MIN_SIZE):
+        self.root = root
+        self.minSize = minSize
+        # cleared on the first failed clone
+        self.supported = True
+
+    def _blobPath(self, digest):
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def addFile(self, path, digest):
+        """
+        Deduplicates the file at <path>, whose content has the sha256 <digest>. If the
+        content is already in the store, the file is atomically replaced by a clone of
+        it (with the mode and times of the file); otherwise a clone of the file becomes
+        the stored copy. Returns True if the file now shares its data with the store.
+        """
+        if not self.supported:
+            return False
+        st = os.stat(path)
+        if st.st_size < self.minSize or st.st_nlink > 1:
+            # too small, or hard-linked (e.g., with a run or version), in which case
+            # replacing it would only break the link
+            return False
+        blobPath = self._blobPath(digest)
+        os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+        try:
+            if self._store(path, blobPath):
+                return True
+            if os.stat(blobPath).st_size != st.st_size:
+                logger.warning('Size mismatch for %s and blob %s' % (path, blobPath))
+                return False
+            # keeps the blob from being collected
+            os.utime(blobPath)
+            return self._replace(path, st, blobPath)
+        except FileNotFoundError:
+            # the file was removed, or the blob collected, in the meantime
+            return False
+        except OSError as ex:
+            if ex.errno not in _NO_REFLINK_ERRORS:
+                raise
+            logger.warning('Cannot clone files in %s (%s), not deduplicating' %
+                           (self.root, ex))
+            self.supported = False
+            return False
+
+    def _store(self, path, blobPath):
+        """Stores a clone of <path> as <blobPath>, unless there is one already. Returns
+        True if it did."""
+        if os.path.exists(blobPath):
+            return False
+        tmpPath = '%s.%s.tmp' % (blobPath, uuid.uuid4().hex)
+        clone(path, tmpPath)
+        try:
+            os.link(tmpPath, blobPath)
+            return True
+        except FileExistsError:
+            # stored by someone else in the meantime
+            return False
+        finally:
+            os.unlink(tmpPath)
+
+    def _replace(self, path, st, blobPath):
+        """Replaces <path>, as it was when stat-ed (<st>), by a clone of <blobPath>."""
+        tmpPath = '%s.%s.wt-dedup' % (path, uuid.uuid4().hex)
+        clone(blobPath, tmpPath)
+        try:
+            shutil.copystat(path, tmpPath)
+            if os.stat(path).st_ino != st.st_ino:
+                # the file was replaced in the meantime
+                os.unlink(tmpPath)
+                return False
+            os.replace(tmpPath, path)
+            return True
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+            raise
+
+    def collectGarbage(self, maxAge=BLOB_TTL):
+        """Removes blobs that have not been used for <maxAge> seconds."""
+        removed = size = 0
+        olderThan = time.time() - maxAge
+        for dirPath, dirNames, fileNames in os.walk(self.root):
+            for name in fileNames:
+                path = os.path.join(dirPath, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_mtime < olderThan:
+                        os.unlink(path)
+                        removed += 1
+                        size += st.st_size
+                except FileNotFoundError:
+                    pass
+        if removed:
+            logger.info('Removed %d unused blobs (%d bytes) from %s' %
+                        (removed, size, self.root))
+        return {'removed': removed, 'bytes': size}
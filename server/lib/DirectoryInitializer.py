@@ -1,26 +1,42 @@
 from wsgidav.middleware import BaseMiddleware
 import os
 from .PathMapper import HomePathMapper, TalePathMapper, RunsPathMapper
+from .RequestContext import RequestContext
+from .SharedCache import SharedCache
+
+# Directories may be removed behind our back (e.g., by a sharding migration), so don't
+# trust the shared record of their existence forever
+INITIALIZED_TTL = 24 * 3600.0
 
 
 class DirectoryInitializer(BaseMiddleware):
+    # Subdirectories known to exist. Subclasses have their own, shared by all instances
+    # (and processes) so that directories created ahead of time (see RunsProvisioner) are
+    # not checked again.
+    initializedFor = None
+
     def __init__(self, application, config, pathMapper):
         BaseMiddleware.__init__(self, application, config)
         self.application = application
         self.config = config
         self.pathMapper = pathMapper
-        self.initializedFor = {}
 
     def __call__(self, environ, start_response):
+        context = RequestContext.of(environ)
         # subdir is the user/tale specific part of the directory
-        subdir = self.pathMapper.getSubdir(environ)
+        subdir = self.pathMapper.getSubdir(context)
         if subdir not in self.initializedFor:
             root = self.config['wt_home_dirs_root']
             if root is None:
                 raise EnvironmentError('wt_home_dirs_root not in config')
-            path = '/%s/%s' % (root, subdir)
-            os.makedirs(path, exist_ok=True)
-            self.initializedFor[subdir] = True
+            previousSubdir = self._getPreviousSubdir(root, context)
+            if previousSubdir is not None:
+                subdir = previousSubdir
+            else:
+                os.makedirs('/%s/%s' % (root, subdir), exist_ok=True)
+                self.initializedFor[subdir] = True
+        # the provider resolves paths within this directory relative to it
+        context.subdir = subdir
         # use a multi-level path such that we don't end up with a large number of
         # entries in a single directory.
         # Specifically, use <firstLetterOfUsername>/<username> for homedir
@@ -31,17 +47,31 @@ class DirectoryInitializer(BaseMiddleware):
         # first filter to be aware of the mapping, do it here
         return self.application(environ, start_response)
 
+    def _getPreviousSubdir(self, root, context):
+        # The directory may have yet to be moved by a sharding migration
+        previous = self.pathMapper.previousSharding
+        if previous is None:
+            return None
+        subdir = self.pathMapper.getSubdir(context, previous)
+        return subdir if os.path.isdir('/%s/%s' % (root, subdir)) else None
+
 
 class HomeDirectoryInitializer(DirectoryInitializer):
+    initializedFor = SharedCache('initialized.home', ttl=INITIALIZED_TTL)
+
     def __init__(self, application, config):
         DirectoryInitializer.__init__(self, application, config, HomePathMapper())
 
 
 class TaleDirectoryInitializer(DirectoryInitializer):
+    initializedFor = SharedCache('initialized.tale', ttl=INITIALIZED_TTL)
+
     def __init__(self, application, config):
         DirectoryInitializer.__init__(self, application, config, TalePathMapper())
 
 
 class RunsDirectoryInitializer(DirectoryInitializer):
+    initializedFor = SharedCache('initialized.runs', ttl=INITIALIZED_TTL)
+
     def __init__(self, application, config):
         DirectoryInitializer.__init__(self, application, config, RunsPathMapper())
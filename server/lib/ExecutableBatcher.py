@@ -0,0 +1,127 @@
+import os
+import stat
+
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST, HTTP_FORBIDDEN, HTTP_NOT_FOUND
+from wsgidav.middleware import BaseMiddleware
+from wsgidav import compat, util, xml_tools
+from wsgidav.xml_tools import etree
+
+from .ContentStore import breakLink
+from .WTFilesystemProvider import PROP_EXECUTABLE, isExecutableValue, executableMode
+
+_logger = util.getModuleLogger(__name__, True)
+
+MAX_REPORTED_FAILURES = 100
+
+
+class ExecutableBatcher(BaseMiddleware):
+    """
+    Sets or clears the executable property of all the files in a collection with a
+    single PROPPATCH request on the collection, with a "Depth: 1" (files directly in the
+    collection) or "Depth: infinity" (all files below it) header, e.g.:
+
+        PROPPATCH /tales/<taleId>/scripts
+        Depth: infinity
+
+        <propertyupdate xmlns="DAV:" xmlns:A="http://apache.org/dav/props/">
+          <set><prop><A:executable>T</A:executable></prop></set>
+        </propertyupdate>
+
+    wsgidav only accepts Depth 0 for PROPPATCH, which is still handled by it. Only the
+    executable property can be updated this way. Directories are left alone (their
+    executable bit is what allows looking into them) and symlinks are not followed.
+    Files whose mode does not change are not touched.
+
+    The response is a multistatus with the result for the collection, followed by the
+    files that could not be updated, if any.
+    """
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        depth = environ.get('HTTP_DEPTH', '0').lower()
+        if environ['REQUEST_METHOD'] != 'PROPPATCH' or depth not in ('1', 'infinity'):
+            return self.application(environ, start_response)
+        provider = environ['wsgidav.provider']
+        if provider.isReadOnly():
+            raise DAVError(HTTP_FORBIDDEN)
+        res = provider.getResourceInst(environ['PATH_INFO'], environ)
+        if res is None:
+            raise DAVError(HTTP_NOT_FOUND)
+        if not res.isCollection:
+            raise DAVError(HTTP_BAD_REQUEST, 'Depth must be 0 for non-collections')
+        executable = self._parseBody(environ)
+        if provider.lockManager is not None:
+            util.parseIfHeaderDict(environ)
+            # checkWritePermission() only knows about depths 0 and infinity; as when
+            # deleting a collection, any lock below it conflicts
+            provider.lockManager.checkWritePermission(
+                res.getRefUrl(), 'infinity', environ['wsgidav.ifLockTokenList'],
+                environ.get('http_authenticator.username', 'anonymous'))
+
+        stats = {'files': 0, 'changed': 0}
+        failures = []
+        self._apply(res._filePath, '', executable, depth == 'infinity', stats, failures)
+        _logger.debug('%s executable=%s: %s' % (environ['PATH_INFO'], executable, stats))
+
+        multistatusEL = xml_tools.makeMultistatusEL()
+        util.addPropertyResponse(multistatusEL, res.getHref(), [(PROP_EXECUTABLE, None)])
+        for relPath in failures[:MAX_REPORTED_FAILURES]:
+            href = util.joinUri(res.getHref(), compat.quote(relPath))
+            util.addPropertyResponse(multistatusEL, href,
+                                     [(PROP_EXECUTABLE, DAVError(HTTP_FORBIDDEN))])
+        etree.SubElement(multistatusEL, '{DAV:}responsedescription').text = \
+            'Changed %d of %d files; %d failed' % (stats['changed'], stats['files'],
+                                                   len(failures))
+        return util.sendMultiStatusResponse(environ, start_response, multistatusEL)
+
+    def _parseBody(self, environ):
+        """Returns whether the request makes files executable, if it only sets the
+        executable property."""
+        requestEL = util.parseXmlBody(environ)
+        values = []
+        if requestEL.tag != '{DAV:}propertyupdate':
+            raise DAVError(HTTP_BAD_REQUEST)
+        for ppnode in requestEL:
+            for propnode in ppnode:
+                for propertynode in propnode:
+                    if ppnode.tag != '{DAV:}set' or propnode.tag != '{DAV:}prop' or \
+                            propertynode.tag != PROP_EXECUTABLE:
+                        raise DAVError(HTTP_BAD_REQUEST, 'Only the executable property can '
+                                                         'be set on multiple resources')
+                    values.append(isExecutableValue(propertynode))
+        if len(set(values)) != 1:
+            raise DAVError(HTTP_BAD_REQUEST, 'Expected one value for the executable property')
+        return values[0]
+
+    def _apply(self, dirPath, relDir, executable, recursive, stats, failures):
+        with os.scandir(dirPath) as it:
+            entries = list(it)
+        for entry in entries:
+            relPath = entry.name if not relDir else relDir + '/' + entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        self._apply(entry.path, relPath, executable, recursive, stats,
+                                    failures)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stats['files'] += 1
+                # entry.stat() comes from the directory listing where possible
+                st = entry.stat(follow_symlinks=False)
+                newmode = executableMode(stat.S_IMODE(st.st_mode), executable)
+                if newmode == stat.S_IMODE(st.st_mode):
+                    continue
+                if st.st_nlink > 1:
+                    # the mode belongs to the inode, which may be shared with other files
+                    breakLink(entry.path)
+                os.chmod(entry.path, newmode)
+                stats['changed'] += 1
+            except FileNotFoundError:
+                # removed in the meantime
+                continue
+            except OSError:
+                failures.append(relPath)
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import stat
+
+from wsgidav.middleware import BaseMiddleware
+from wsgidav import util
+
+from .RequestContext import RequestContext
+from .WTDomainController import Cache
+from .WTFilesystemProvider import CHANGE_WRITE
+
+# How long a user (identified by the Authorization header) keeps being allowed to HEAD
+# files in a user/tale/run directory after a request to it was authorized. Access can be
+# revoked in any process, so this bounds how long revoked credentials keep working.
+GRANT_CACHE_TTL = 2.0
+# How long the stat of a file is used to answer HEAD requests
+STAT_CACHE_TTL = 2.0
+STAT_CACHE_SIZE = 10000
+
+ALLOWED_METHODS = 'OPTIONS HEAD GET PROPFIND REPORT PUT POST MKCOL DELETE COPY MOVE PROPPATCH'
+LOCK_METHODS = ' LOCK UNLOCK'
+
+
+class FastPathResponder(BaseMiddleware):
+    """
+    Answers the cheap requests that DAV clients (notably the Windows mini-redirector
+    and the macOS Finder) send in large numbers without going through authentication,
+    authorization and directory initialization:
+
+    - OPTIONS, with headers computed once for the realm (the methods allowed anywhere in
+      it, rather than for the requested resource);
+    - HEAD on files, when the same credentials (Authorization or Girder-Token header)
+      were recently authorized for the user/tale/run directory the file is in, from a
+      short-lived stat cache.
+
+    Anything else, including conditional and range HEAD requests, is passed on. This
+    must sit outside of HTTPAuthenticator in the middleware stack.
+    """
+    # hash of (credentials, realm root, directory) -> subdir, shared by the realms so
+    # that forget() can drop them all
+    grants = Cache(GRANT_CACHE_TTL)
+
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+        self.provider = config['provider_mapping']['/']
+        self.rootPath = self.provider.rootFolderPath
+        self.stats = Cache(STAT_CACHE_TTL, maxSize=STAT_CACHE_SIZE)
+        self.provider.addChangeListener(self._invalidate)
+        self.optionsHeaders = self._buildOptionsHeaders()
+
+    @classmethod
+    def forget(cls):
+        """Drops the grants of this process, e.g., when tokens are removed."""
+        cls.grants.clear()
+
+    def _buildOptionsHeaders(self):
+        allow = ALLOWED_METHODS
+        dav = '1'
+        if not self.provider.isReadOnly() and self.config.get('locksmanager'):
+            allow += LOCK_METHODS
+            dav = '1,2'
+        headers = [('Content-Type', 'text/html'),
+                   ('Content-Length', '0'),
+                   ('DAV', dav),
+                   ('Allow', allow)]
+        if self.config.get('add_header_MS_Author_Via', False):
+            headers.append(('MS-Author-Via', 'DAV'))
+        return headers
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        if method == 'OPTIONS':
+            start_response('200 OK', self.optionsHeaders + [('Date', util.getRfc1123Time())])
+            return [b'']
+        if method == 'HEAD':
+            response = self._head(environ, start_response)
+            if response is not None:
+                return response
+        response = self.application(environ, start_response)
+        self._rememberGrant(environ)
+        return response
+
+    def _grantKey(self, environ, context):
+        credentials = environ.get('HTTP_AUTHORIZATION') or environ.get('HTTP_GIRDER_TOKEN')
+        if not credentials or not context.parts:
+            return None
+        # don't keep credentials around
+        return hashlib.sha256(('%s\0%s\0%s' % (credentials, self.rootPath, context.parts[0]))
+                              .encode('utf8')).hexdigest()
+
+    def _rememberGrant(self, environ):
+        # The directory is only initialized for authorized requests, and those that
+        # need write access also have read access.
+        context = RequestContext.of(environ)
+        if context.subdir is None:
+            return
+        key = self._grantKey(environ, context)
+        if key is not None:
+            self.grants.set(key, str(context.subdir))
+
+    def _head(self, environ, start_response):
+        if util.getContentLength(environ) != 0 or environ.get('HTTP_DEPTH', '0') != '0' or \
+                'HTTP_RANGE' in environ or \
+                any(key.startswith('HTTP_IF_') for key in environ):
+            return None
+        context = RequestContext.of(environ)
+        if len(context.parts) < 2 or '..' in context.parts or '.' in context.parts:
+            return None
+        key = self._grantKey(environ, context)
+        subdir = self.grants.get(key) if key is not None else None
+        if subdir is None:
+            return None
+        filePath = os.path.join(self.rootPath, subdir, *context.parts[1:])
+        st = self.stats.get(filePath)
+        if st is None:
+            try:
+                st = os.stat(filePath)
+            except OSError:
+                # let the full stack produce the error
+                return None
+            self.stats.set(filePath, st)
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        headers = [('Content-Length', str(st.st_size)),
+                   ('Last-Modified', util.getRfc1123Time(st.st_mtime)),
+                   ('Content-Type', util.guessMimeType(context.path)),
+                   ('Date', util.getRfc1123Time()),
+                   # same as wsgidav's util.getETag()
+                   ('ETag', '"%d-%d-%d"' % (st.st_ino, int(st.st_mtime), st.st_size))]
+        headers.extend(self.config.get('response_headers', []))
+        start_response('200 OK', headers)
+        return [b'']
+
+    def _invalidate(self, change):
+        for filePath in (change.filePath, change.destFilePath):
+            if filePath is None:
+                continue
+            if os.path.isdir(filePath) or change.action != CHANGE_WRITE:
+                # anything below may have changed
+                self.stats.clear()
+                return
+            self.stats.remove(filePath)
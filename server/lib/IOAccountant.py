@@ -0,0 +1,274 @@
+import collections
+import threading
+import time
+
+from wsgidav.middleware import BaseMiddleware
+from wsgidav import util
+from girder import logger
+
+from .RequestContext import RequestContext
+
+# Counters kept for each user, tale and run
+COUNTERS = ('requests', 'bytesRead', 'bytesWritten', 'bytesSent', 'filesOpened', 'stats',
+            'wallTime', 'propfinds', 'deepPropfinds', 'slowRequests')
+_INDEX = {name: i for i, name in enumerate(COUNTERS)}
+KINDS = ('user', 'tale', 'run')
+
+# Counters are aggregated in buckets of BUCKET_SECONDS, of which the last WINDOW_BUCKETS
+# are kept
+BUCKET_SECONDS = 60
+WINDOW_BUCKETS = 60
+# Beyond this many users, tales and runs in a bucket, the rest are counted under OTHER
+MAX_KEYS = 5000
+OTHER = '(other)'
+# Distinct PROPFIND paths remembered per user in the current bucket
+MAX_PATHS = 1000
+MAX_FLAGS = 1000
+
+# A user is flagged when, within a bucket, it sends at least LOOP_PROPFINDS PROPFIND
+# requests, on average LOOP_RATIO times on each path (a client walking the same tree over
+# and over), or DEEP_PROPFINDS "Depth: infinity" PROPFIND requests, or has SLOW_REQUESTS
+# requests that took more than SLOW_SECONDS at less than SLOW_RATE bytes per second
+LOOP_PROPFINDS = 300
+LOOP_RATIO = 5
+DEEP_PROPFINDS = 10
+SLOW_REQUESTS = 3
+SLOW_SECONDS = 30.0
+SLOW_RATE = 16 * 1024
+
+
+class _Bucket:
+    def __init__(self, id):
+        self.id = id
+        # (kind, id) -> list of COUNTERS values
+        self.counters = {}
+        # user -> set of PROPFIND paths
+        self.paths = {}
+
+
+class IOAccounting:
+    """
+    Per-user, tale and run I/O statistics over the last WINDOW_BUCKETS * BUCKET_SECONDS
+    seconds, in memory bounded by MAX_KEYS per bucket. Statistics are per process.
+    """
+    def __init__(self):
+        self.buckets = collections.deque(maxlen=WINDOW_BUCKETS)
+        # user -> {'user', 'reasons', 'first', 'last'}
+        self.flags = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _current(self, now):
+        id = int(now // BUCKET_SECONDS)
+        if not self.buckets or self.buckets[-1].id != id:
+            if self.buckets:
+                # only needed for loop detection in the current bucket
+                self.buckets[-1].paths = {}
+            self.buckets.append(_Bucket(id))
+        return self.buckets[-1]
+
+    def record(self, keys, values, propfindPath=None, now=None):
+        """
+        Adds <values> ({counter: value}) to the counters of each (kind, id) in <keys>.
+        The first key must be the user, if known. Returns the reasons for which the user
+        was newly flagged, if any.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            bucket = self._current(now)
+            for key in keys:
+                counters = bucket.counters.get(key)
+                if counters is None:
+                    if len(bucket.counters) >= MAX_KEYS:
+                        key = (key[0], OTHER)
+                    counters = bucket.counters.setdefault(key, [0] * len(COUNTERS))
+                for name, value in values.items():
+                    counters[_INDEX[name]] += value
+            if not keys or keys[0][0] != 'user':
+                return []
+            user = keys[0][1]
+            if propfindPath is not None:
+                paths = bucket.paths.setdefault(user, set())
+                if len(paths) < MAX_PATHS:
+                    paths.add(propfindPath)
+            return self._check(bucket, user, now)
+
+    def _check(self, bucket, user, now):
+        counters = bucket.counters.get(('user', user))
+        if counters is None:
+            return []
+        reasons = []
+        propfinds = counters[_INDEX['propfinds']]
+        if propfinds >= LOOP_PROPFINDS and \
+                propfinds >= LOOP_RATIO * len(bucket.paths.get(user, ())):
+            reasons.append('PROPFIND loop')
+        if counters[_INDEX['deepPropfinds']] >= DEEP_PROPFINDS:
+            reasons.append('recursive PROPFIND')
+        if counters[_INDEX['slowRequests']] >= SLOW_REQUESTS:
+            reasons.append('slow client')
+        if not reasons:
+            return []
+        flag = self.flags.pop(user, None)
+        if flag is None or flag['last'] < bucket.id * BUCKET_SECONDS:
+            # (re)flagged in this bucket
+            newReasons = reasons
+            flag = flag or {'user': user, 'first': now}
+            flag['reasons'] = reasons
+        else:
+            newReasons = [reason for reason in reasons if reason not in flag['reasons']]
+            flag['reasons'] = reasons
+        flag['last'] = now
+        self.flags[user] = flag
+        while len(self.flags) > MAX_FLAGS:
+            self.flags.popitem(last=False)
+        return newReasons
+
+    def top(self, kind='user', sort='wallTime', limit=10, minutes=5, now=None):
+        """Returns the statistics of the <limit> users (tales, runs) with the largest
+        <sort> counter over the last <minutes>."""
+        now = time.time() if now is None else now
+        first = int(now // BUCKET_SECONDS) - minutes + 1
+        totals = {}
+        with self.lock:
+            for bucket in self.buckets:
+                if bucket.id < first:
+                    continue
+                for (k, id), counters in bucket.counters.items():
+                    if k != kind:
+                        continue
+                    total = totals.setdefault(id, [0] * len(COUNTERS))
+                    for i, value in enumerate(counters):
+                        total[i] += value
+        index = _INDEX[sort]
+        ids = sorted(totals, key=lambda id: totals[id][index], reverse=True)[:limit]
+        result = []
+        for id in ids:
+            entry = dict(zip(COUNTERS, totals[id]))
+            entry['id'] = id
+            result.append(entry)
+        return result
+
+    def flagged(self, minutes=WINDOW_BUCKETS, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            return [dict(flag) for flag in reversed(self.flags.values())
+                    if flag['last'] >= now - minutes * BUCKET_SECONDS]
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+            self.flags.clear()
+
+
+class CountingReader:
+    """Wraps a file being read, counting the bytes in IOCounters."""
+    def __init__(self, file, io):
+        self.file = file
+        self.io = io
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.io.bytesRead += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class CountingWriter:
+    """Wraps a file being written, counting the bytes in IOCounters."""
+    def __init__(self, file, io):
+        self.file = file
+        self.io = io
+
+    def write(self, data):
+        self.io.bytesWritten += len(data)
+        return self.file.write(data)
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+class IOAccountant(BaseMiddleware):
+    """
+    Records, for each request, the I/O done by the provider (see IOCounters), the bytes
+    sent and the time until the response is closed, under the user, tale and run the
+    request was for, and flags users whose clients behave pathologically. Must sit
+    outside of the authorizer in the middleware stack.
+    """
+    # shared by all realms, read by the homedirs/io endpoint
+    accounting = IOAccounting()
+
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        try:
+            response = self.application(environ, start_response)
+        except BaseException:
+            self.record(environ, start, 0)
+            raise
+        return _AccountedResponse(self, environ, start, response)
+
+    def record(self, environ, start, bytesSent):
+        context = RequestContext.of(environ)
+        keys = []
+        if context.userName:
+            keys.append(('user', context.userName))
+        if context.taleId:
+            keys.append(('tale', str(context.taleId)))
+        if context.runId:
+            keys.append(('run', str(context.runId)))
+        if not keys:
+            # not authenticated; nothing done on anyone's behalf
+            return
+        now = time.time()
+        wallTime = now - start
+        io = context.io
+        values = {'requests': 1, 'bytesRead': io.bytesRead, 'bytesWritten': io.bytesWritten,
+                  'bytesSent': bytesSent, 'filesOpened': io.filesOpened, 'stats': io.stats,
+                  'wallTime': wallTime}
+        propfindPath = None
+        if environ['REQUEST_METHOD'] == 'PROPFIND':
+            values['propfinds'] = 1
+            propfindPath = context.path
+            if environ.get('HTTP_DEPTH', 'infinity').lower() == 'infinity':
+                values['deepPropfinds'] = 1
+        transferred = bytesSent + util.getContentLength(environ)
+        if wallTime > SLOW_SECONDS and transferred / wallTime < SLOW_RATE:
+            values['slowRequests'] = 1
+        reasons = self.accounting.record(keys, values, propfindPath, now)
+        if reasons:
+            logger.warning('Client of %s in %s flagged: %s (%s)' %
+                           (keys[0][1], self.config['mount_path'], ', '.join(reasons),
+                            environ.get('HTTP_USER_AGENT', 'no user agent')))
+
+
+class _AccountedResponse:
+    def __init__(self, accountant, environ, start, response):
+        self.accountant = accountant
+        self.environ = environ
+        self.start = start
+        self.response = response
+        self.bytesSent = 0
+        self.recorded = False
+
+    def __iter__(self):
+        for data in self.response:
+            self.bytesSent += len(data)
+            yield data
+
+    def close(self):
+        try:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+        finally:
+            if not self.recorded:
+                self.recorded = True
+                self.accountant.record(self.environ, self.start, self.bytesSent)
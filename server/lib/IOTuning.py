@@ -0,0 +1,172 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Transfers of files at least this large get preallocation and page cache hints
+DEFAULT_LARGE_FILE_SIZE = 16 * 1024 * 1024
+# Pages behind the current position are dropped from the page cache in windows of this
+# size; dirty pages are only dropped once written back, which is usually the case one
+# window later
+DROP_WINDOW = 32 * 1024 * 1024
+# fallocate(2) mode: the size of the file only changes as data is written
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def _loadFallocate():
+    # os.posix_fallocate() falls back to writing zeros where the filesystem cannot
+    # preallocate (e.g., NFSv3), which would double the data written; fallocate(2)
+    # fails instead
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _loadFallocate()
+
+
+def preallocate(fd, length):
+    """Reserves <length> bytes for the file open as <fd>, so that it is not fragmented
+    as it grows, without changing its size. Returns whether it was done. Raises
+    OSError(ENOSPC) if there is not enough space."""
+    if _fallocate is None or length <= 0:
+        return False
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, length) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EDQUOT):
+        raise OSError(err, os.strerror(err))
+    # not supported by the filesystem
+    return False
+
+
+def fadvise(fd, offset, length, advice):
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except (OSError, AttributeError):
+        # advisory only
+        pass
+
+
+class IOTuning:
+    """
+    How a realm does large file transfers, from the wthome.io_tuning setting: the block
+    size used to stream data (wsgidav's and the plugin middleware's "block_size"), and,
+    for files of at least largeFileSize bytes, whether uploads are preallocated and
+    whether sequential access and page cache hints (posix_fadvise) are given, so that
+    big transfers get readahead and do not evict the rest of the page cache.
+    """
+    def __init__(self, config=None, realm=None):
+        config = config or {}
+        blockSize = config.get('blockSize', DEFAULT_BLOCK_SIZE)
+        if isinstance(blockSize, dict):
+            blockSize = blockSize.get(realm, DEFAULT_BLOCK_SIZE)
+        self.blockSize = blockSize
+        self.largeFileSize = config.get('largeFileSize', DEFAULT_LARGE_FILE_SIZE)
+        self.preallocate = config.get('preallocate', True)
+        self.fadvise = config.get('fadvise', True)
+
+    def isLarge(self, size):
+        return size is not None and size >= self.largeFileSize
+
+    def openForReading(self, file, size):
+        """Wraps <file>, open for reading, if hints apply to <size> bytes."""
+        if not self.fadvise or not self.isLarge(size):
+            return file
+        return SequentialReader(file)
+
+    def openForWriting(self, file, expectedSize):
+        """Preallocates <file>, just created, for <expectedSize> (the Content-Length of the
+        upload, or None) bytes and wraps it if hints apply. Returns the file to write to
+        and whether it was preallocated, in which case a file that ends up shorter
+        should be truncated to its size to release the rest (see releaseUnused())."""
+        if not self.isLarge(expectedSize):
+            return file, False
+        preallocated = False
+        if self.preallocate:
+            try:
+                preallocated = preallocate(file.fileno(), expectedSize)
+            except OSError:
+                file.close()
+                raise
+        if self.fadvise:
+            file = SequentialWriter(file)
+        return file, preallocated
+
+
+def releaseUnused(path):
+    """Releases the space preallocated past the end of the file at <path>."""
+    try:
+        os.truncate(path, os.stat(path).st_size)
+    except OSError:
+        pass
+
+
+class SequentialReader:
+    """Wraps a file read sequentially, asking for aggressive readahead and dropping the
+    pages already read from the page cache."""
+    def __init__(self, file):
+        self.file = file
+        self.fd = file.fileno()
+        fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        # what was read since the last drop
+        self.start = self.pos = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.pos += len(data)
+        if self.pos - self.start >= DROP_WINDOW:
+            fadvise(self.fd, self.start, self.pos - self.start, os.POSIX_FADV_DONTNEED)
+            self.start = self.pos
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.start = self.pos = self.file.seek(offset, whence)
+        return self.pos
+
+    def close(self):
+        fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        self.file.close()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class SequentialWriter:
+    """Wraps a file written sequentially, dropping the pages of what was written from
+    the page cache once they are likely to have been written back."""
+    def __init__(self, file):
+        self.file = file
+        self.fd = file.fileno()
+        self.written = 0
+        # [start, end) of the previous window, dropped after the next one is written
+        self.window = (0, 0)
+
+    def write(self, data):
+        n = self.file.write(data)
+        self.written += len(data)
+        if self.written - self.window[1] >= DROP_WINDOW:
+            self.file.flush()
+            if self.window[1] > self.window[0]:
+                fadvise(self.fd, self.window[0], self.window[1] - self.window[0],
+                        os.POSIX_FADV_DONTNEED)
+            self.window = (self.window[1], self.written)
+        return n
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    def close(self):
+        self.file.flush()
+        fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        self.file.close()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
@@ -0,0 +1,126 @@
+import datetime
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import InsertOne, UpdateOne
+from girder.constants import AccessType
+from girder.models.folder import Folder
+from girder.models.user import User
+from girder.plugins.wholetale.models.tale import Tale
+
+from ..constants import WORKSPACE_NAME
+from .DirectoryInitializer import HomeDirectoryInitializer, TaleDirectoryInitializer
+from .PathMapper import HomePathMapper, TalePathMapper
+
+# mkdir on shared storage is mostly waiting for the server, so do a few at once
+DEFAULT_WORKERS = 8
+
+
+class Onboarder:
+    """
+    Maps the Home folders of many users, or the workspaces of many tales, at once: what
+    setHomeFolderMapping() and setTaleFolderMapping() in the plugin do for one user or
+    tale as it is created. Users and tales that are already mapped are skipped, so it is
+    safe to call again. Folders and documents are written with one bulk operation per
+    collection (home folders are inserted with their mapping, so they are not saved
+    twice), and directories are created concurrently.
+
+    Home folders are inserted directly, without triggering folder events.
+    """
+    def __init__(self, homesRoot, talesRoot, maxWorkers=DEFAULT_WORKERS):
+        self.homesRoot = homesRoot
+        self.talesRoot = talesRoot
+        self.maxWorkers = maxWorkers
+
+    def provisionUsers(self, users):
+        """Maps the Home folders of <users> (documents with at least _id and login).
+        Returns the number of users mapped and of those already mapped."""
+        users = {user['_id']: user for user in users}
+        if not users:
+            return {'provisioned': 0, 'existing': 0}
+        homes = {home['parentId']: home for home in Folder().find({
+            'parentId': {'$in': list(users)}, 'parentCollection': 'user', 'name': 'Home'
+        }, fields=['parentId', 'isMapping'])}
+        pathMapper = HomePathMapper()
+        now = datetime.datetime.utcnow()
+        subdirs = []
+        requests = []
+        existing = 0
+        for userId, user in users.items():
+            home = homes.get(userId)
+            if home is not None and home.get('isMapping'):
+                existing += 1
+                continue
+            subdir = pathMapper.shard(pathlib.PurePosixPath(user['login'])).as_posix()
+            subdirs.append(subdir)
+            mapping = {'fsPath': self._absPath(self.homesRoot, subdir), 'isMapping': True}
+            if home is not None:
+                requests.append(UpdateOne({'_id': home['_id']}, {'$set': mapping}))
+                continue
+            # what Folder().createFolder(user, 'Home', parentType='user', public=False,
+            # creator=user) would save
+            folder = {
+                'name': 'Home',
+                'lowerName': 'home',
+                'description': '',
+                'parentCollection': 'user',
+                'baseParentId': userId,
+                'baseParentType': 'user',
+                'parentId': userId,
+                'creatorId': userId,
+                'created': now,
+                'updated': now,
+                'size': 0
+            }
+            Folder().setUserAccess(folder, user, AccessType.ADMIN, save=False)
+            Folder().setPublic(folder, False, save=False)
+            folder.update(mapping)
+            requests.append(InsertOne(folder))
+        self._makeDirs(self.homesRoot, subdirs, HomeDirectoryInitializer.initializedFor)
+        if requests:
+            Folder().collection.bulk_write(requests, ordered=False)
+        return {'provisioned': len(subdirs), 'existing': existing}
+
+    def provisionTales(self, tales):
+        """Creates and maps the workspaces of <tales>. Returns the number of tales mapped
+        and of those already mapped."""
+        tales = list(tales)
+        if not tales:
+            return {'provisioned': 0, 'existing': 0}
+        workspaceIds = [tale['workspaceId'] for tale in tales if tale.get('workspaceId')]
+        mapped = {folder['_id'] for folder in Folder().find({
+            '_id': {'$in': workspaceIds}, 'isMapping': True}, fields=['_id'])}
+        pending = [tale for tale in tales if tale.get('workspaceId') not in mapped]
+        creatorIds = list({tale['creatorId'] for tale in pending})
+        creators = {user['_id']: user for user in User().find({'_id': {'$in': creatorIds}})}
+        pathMapper = TalePathMapper()
+        subdirs = []
+        folderRequests = []
+        taleRequests = []
+        for tale in pending:
+            workspace = Tale()._createAuxFolder(tale, WORKSPACE_NAME,
+                                                creator=creators.get(tale['creatorId']))
+            subdir = pathMapper.shard(pathlib.PurePosixPath(str(tale['_id']))).as_posix()
+            subdirs.append(subdir)
+            folderRequests.append(UpdateOne({'_id': workspace['_id']}, {'$set': {
+                'fsPath': self._absPath(self.talesRoot, subdir), 'isMapping': True}}))
+            taleRequests.append(UpdateOne({'_id': tale['_id']},
+                                          {'$set': {'workspaceId': workspace['_id']}}))
+        self._makeDirs(self.talesRoot, subdirs, TaleDirectoryInitializer.initializedFor)
+        if folderRequests:
+            Folder().collection.bulk_write(folderRequests, ordered=False)
+            Tale().collection.bulk_write(taleRequests, ordered=False)
+        return {'provisioned': len(pending), 'existing': len(tales) - len(pending)}
+
+    def _absPath(self, root, subdir):
+        return pathlib.Path(root, subdir).as_posix()
+
+    def _makeDirs(self, root, subdirs, initializedFor):
+        def makeDir(subdir):
+            os.makedirs(self._absPath(root, subdir), exist_ok=True)
+            # same key as the one DirectoryInitializer uses
+            initializedFor[subdir] = True
+
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            list(pool.map(makeDir, subdirs))
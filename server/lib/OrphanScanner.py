@@ -0,0 +1,225 @@
+import datetime
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from girder import logger
+from girder.models.folder import Folder
+from girder.models.user import User
+from girder.utility.model_importer import ModelImporter
+from girder.plugins.wholetale.models.tale import Tale
+
+from .DirectoryInitializer import (
+    HomeDirectoryInitializer,
+    TaleDirectoryInitializer,
+    RunsDirectoryInitializer
+)
+
+# Directories of the realm root holding reclaimed directories; dot directories are skipped
+# by the scan (and by ShardingMigrator)
+TRASH_DIR = '.trash'
+# listing and stat-ing directories on shared storage is mostly waiting for the server
+DEFAULT_WORKERS = 8
+# Number of names looked up with each $in query
+BATCH_SIZE = 1000
+# Orphans modified more recently than this (in seconds) are not reclaimed, in case their
+# owner is being created
+DEFAULT_MIN_AGE = 3600
+
+INITIALIZERS = {
+    'homes': HomeDirectoryInitializer,
+    'tales': TaleDirectoryInitializer,
+    'runs': RunsDirectoryInitializer
+}
+
+
+def _objectIds(names):
+    ids = {}
+    for name in names:
+        try:
+            ids[name] = ObjectId(name)
+        except (InvalidId, TypeError):
+            pass
+    return ids
+
+
+class OrphanScanner:
+    """
+    Checks a realm root against Girder. Directories of users (homes), tales (tales) or runs
+    (runs) whose user, tale or run folder no longer exists are orphans, and mapped folders
+    (Home folders and tale workspaces) whose fsPath does not exist are dangling. Both are
+    reported with their size: that of the directory for orphans, that recorded in the
+    workspace manifest for dangling folders.
+
+    The sharded layout is listed one level at a time, with the directories of each level
+    listed concurrently, owners are looked up with batched $in queries, and orphans are
+    measured concurrently. Reclaimed orphans are moved (renamed) to a timestamped
+    directory under <root>/.trash rather than deleted, so they can be restored until an
+    administrator empties it. Scanning while the sharding of the realm is being changed is
+    not supported, since directories are moving (see ShardingMigrator).
+    """
+    def __init__(self, rootPath, pathMapper, maxWorkers=DEFAULT_WORKERS):
+        self.rootPath = os.path.abspath(rootPath)
+        self.pathMapper = pathMapper
+        self.realm = pathMapper.getRealm()
+        self.sharding = pathMapper.sharding
+        self.maxWorkers = maxWorkers
+
+    def _listDirs(self, path):
+        try:
+            return sorted(e.name for e in os.scandir(path) if e.is_dir(follow_symlinks=False))
+        except FileNotFoundError:
+            return []
+
+    def _units(self, pool):
+        """Returns the (id, path relative to the root) of the user/tale/run directories."""
+        level = [()]
+        for i in range(self.sharding.depth):
+            listings = pool.map(self._listDirs,
+                                [os.path.join(self.rootPath, *parts) for parts in level])
+            level = [parts + (name,) for parts, names in zip(level, listings)
+                     for name in names if i > 0 or not name.startswith('.')]
+        listings = pool.map(self._listDirs,
+                            [os.path.join(self.rootPath, *parts) for parts in level])
+        units = [(name, os.path.join(*parts, name)) for parts, names in zip(level, listings)
+                 for name in names if tuple(self.sharding.prefix(name)) == parts]
+        if self.realm != 'runs':
+            return units
+        # <prefix>/<taleId>/<runId>/workspace
+        listings = pool.map(self._listDirs,
+                            [os.path.join(self.rootPath, path) for _, path in units])
+        return [(runId, os.path.join(path, runId))
+                for (_, path), runIds in zip(units, listings) for runId in runIds]
+
+    def _owned(self, units):
+        """Returns the subset of <units> (from _units()) that still have an owner, or that
+        a mapped folder points to (e.g., the directory of a user whose login changed)."""
+        names = [name for name, _ in units]
+        if self.realm == 'homes':
+            owners = {user['login'] for user in User().find(
+                {'login': {'$in': names}}, fields=['login'])}
+        else:
+            ids = _objectIds(names)
+            model = Tale() if self.realm == 'tales' else Folder()
+            found = {doc['_id'] for doc in model.find(
+                {'_id': {'$in': list(ids.values())}}, fields=['_id'])}
+            owners = {name for name, id in ids.items() if id in found}
+        owned = {unit for unit in units if unit[0] in owners}
+        if self.realm != 'runs':
+            paths = {os.path.join(self.rootPath, path): (name, path) for name, path in units}
+            owned.update(paths[folder['fsPath']] for folder in Folder().find(
+                {'fsPath': {'$in': list(paths)}}, fields=['fsPath']))
+        return owned
+
+    def _measure(self, path):
+        """Returns the number of files below <path> and their total size."""
+        files = 0
+        size = 0
+        stack = [path]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+        return files, size
+
+    def _orphan(self, path):
+        absPath = os.path.join(self.rootPath, path)
+        files, size = self._measure(absPath)
+        try:
+            mtime = os.stat(absPath).st_mtime
+        except OSError:
+            mtime = None
+        return {'path': path, 'files': files, 'size': size, 'mtime': mtime}
+
+    def _dangling(self, pool):
+        if self.realm == 'runs':
+            # run folders are not mapped
+            return []
+        folders = list(Folder().find({
+            'isMapping': True,
+            'fsPath': {'$regex': '^%s/' % re.escape(self.rootPath)}
+        }, fields=['fsPath']))
+        exists = pool.map(lambda folder: os.path.isdir(folder['fsPath']), folders)
+        manifestModel = ModelImporter.model('workspace_manifest', 'wt_home_dir')
+        dangling = []
+        for folder, exist in zip(folders, exists):
+            if not exist:
+                entry = {'folderId': folder['_id'], 'fsPath': folder['fsPath']}
+                entry.update(manifestModel.getSize(folder['fsPath']))
+                dangling.append(entry)
+        return dangling
+
+    def scan(self):
+        """Returns the orphans and dangling folders of the realm."""
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            units = self._units(pool)
+            owned = set()
+            for i in range(0, len(units), BATCH_SIZE):
+                owned.update(self._owned(units[i:i + BATCH_SIZE]))
+            orphans = list(pool.map(self._orphan,
+                                    [path for name, path in units
+                                     if (name, path) not in owned]))
+            dangling = self._dangling(pool)
+        return {
+            'realm': self.realm,
+            'scanned': len(units),
+            'orphans': orphans,
+            'orphanSize': sum(orphan['size'] for orphan in orphans),
+            'dangling': dangling
+        }
+
+    def _removeEmpty(self, path):
+        """Removes <path> and its parents below the root as long as they are empty."""
+        while path.startswith(self.rootPath + '/'):
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
+
+    def reclaim(self, orphans, minAge=DEFAULT_MIN_AGE):
+        """Moves the <orphans> returned by scan() that were not modified in the last
+        <minAge> seconds to a new directory of the trash, and forgets their manifest
+        entries. Returns the paths moved and the trash directory."""
+        trash = os.path.join(self.rootPath, TRASH_DIR,
+                             datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+        manifestModel = ModelImporter.model('workspace_manifest', 'wt_home_dir')
+        initializedFor = INITIALIZERS[self.realm].initializedFor
+        now = time.time()
+        reclaimed = []
+        for orphan in orphans:
+            path = orphan['path']
+            src = os.path.join(self.rootPath, path)
+            try:
+                if now - os.stat(src).st_mtime < minAge:
+                    continue
+            except FileNotFoundError:
+                continue
+            # the owner may have appeared since the scan
+            if self._owned([(os.path.basename(path), path)]):
+                continue
+            dest = os.path.join(trash, path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.rename(src, dest)
+            manifestModel.removeRoot(src)
+            # the key DirectoryInitializer uses
+            initializedFor.remove(os.path.join(path, 'workspace') if self.realm == 'runs'
+                                  else path)
+            self._removeEmpty(os.path.dirname(src))
+            reclaimed.append(path)
+        logger.info('Moved %d orphaned directories of %s to %s' %
+                    (len(reclaimed), self.rootPath, trash))
+        return {'reclaimed': reclaimed, 'trash': trash if reclaimed else None}
@@ -1,9 +1,67 @@
+import hashlib
 import pathlib
 from typing import Union
 from ..constants import WORKSPACE_NAME
+from .SharedCache import SharedCache
+
+# Runs are looked up again (and re-recorded) when they are accessed, so the mapping
+# only needs to outlive the processes' interest in a run
+RUN_TO_TALE_TTL = 7 * 24 * 3600.0
+
+
+class PrefixSharding:
+    """Places <id> under a directory named by its first <n> characters."""
+    def __init__(self, n):
+        self.n = n
+        self.depth = 1
+
+    def prefix(self, id: str):
+        assert len(id) != 0
+        return [id[0:self.n]]
+
+    def __str__(self):
+        return 'prefix:%d' % self.n
+
+
+class HashSharding:
+    """Places <id> under <levels> directories named by successive groups of <width>
+    hex digits of the sha1 of the id. Unlike prefixes of ObjectIds, which start with a
+    timestamp, these are evenly distributed."""
+    def __init__(self, levels=2, width=2):
+        self.levels = levels
+        self.width = width
+        self.depth = levels
+
+    def prefix(self, id: str):
+        assert len(id) != 0
+        h = hashlib.sha1(id.encode('utf8')).hexdigest()
+        return [h[i * self.width:(i + 1) * self.width] for i in range(self.levels)]
+
+    def __str__(self):
+        return 'hash:%d:%d' % (self.levels, self.width)
+
+
+def parseSharding(spec: str):
+    """Parses 'prefix:<n>' or 'hash:<levels>[:<width>]'."""
+    parts = spec.split(':')
+    try:
+        args = [int(x) for x in parts[1:]]
+    except ValueError:
+        raise ValueError('Invalid sharding scheme: %s' % spec)
+    if parts[0] == 'prefix' and len(args) == 1 and args[0] > 0:
+        return PrefixSharding(args[0])
+    if parts[0] == 'hash' and len(args) in (1, 2) and all(0 < x <= 8 for x in args):
+        return HashSharding(*args)
+    raise ValueError('Invalid sharding scheme: %s' % spec)
 
 
 class PathMapper:
+    # How user/tale directories are spread over subdirectories of the realm root.
+    # Subclasses set their own; configureSharding() changes them. While directories are
+    # being migrated to a new scheme, previousSharding is the one being migrated from.
+    sharding = PrefixSharding(1)
+    previousSharding = None
+
     def __init__(self):
         pass
 
@@ -16,7 +74,7 @@ class PathMapper:
     def davToGirder(self, path: str):
         raise NotImplementedError()
 
-    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str]) -> str:
+    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str], sharding=None) -> str:
         raise NotImplementedError()
 
     def girderToPhysical(self, path: pathlib.Path):
@@ -39,7 +97,19 @@ class PathMapper:
         else:
             return pathlib.PurePosixPath(prefix, *s.parts)
 
-    def getSubdir(self, environ: dict):
+    def shard(self, s: pathlib.PurePosixPath, sharding=None) -> pathlib.PurePosixPath:
+        """Like addPrefix(), using the sharding scheme of this mapper (or <sharding>)."""
+        sharding = sharding or self.sharding
+        if s.is_absolute():
+            if len(s.parts) == 1:
+                raise Exception('Invalid path: %s' % s)
+            return pathlib.PurePosixPath('/', *sharding.prefix(s.parts[1]), *s.parts[1:])
+        else:
+            return pathlib.PurePosixPath(*sharding.prefix(s.parts[0]), *s.parts)
+
+    def getSubdir(self, context, sharding=None):
+        """Returns the directory of the user/tale/run of a request (RequestContext),
+        relative to the realm root."""
         raise NotImplementedError()
 
     def girderPathMatches(self, path: pathlib.Path):
@@ -73,12 +143,12 @@ class HomePathMapper(PathMapper):
         path = pathlib.Path(spath)
         return '/user/%s/Home/%s' % (path.parts[1], '/'.join(path.parts[2:]).rstrip('/'))
 
-    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str]) -> str:
+    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str], sharding=None) -> str:
         path = self._toPosixPurePath(path)
-        return self.addPrefix(path, 1).as_posix()
+        return self.shard(path, sharding).as_posix()
 
-    def getSubdir(self, environ: dict) -> pathlib.PurePosixPath:
-        return self.addPrefix(pathlib.PurePosixPath(environ['WT_DAV_AUTHORIZED_USER']), 1)
+    def getSubdir(self, context, sharding=None) -> pathlib.PurePosixPath:
+        return self.shard(pathlib.PurePosixPath(context.userName), sharding)
 
     def girderPathMatches(self, path: pathlib.Path):
         return len(path.parts) >= 4 and path.parts[1] == 'user' and path.parts[3] == 'Home'
@@ -105,12 +175,12 @@ class TalePathMapper(PathMapper):
         return '/collection/%s/%s/%s' % \
                (WORKSPACE_NAME, WORKSPACE_NAME, '/'.join(path.parts[1:]).rstrip('/'))
 
-    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str]) -> str:
+    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str], sharding=None) -> str:
         path = self._toPosixPurePath(path)
-        return self.addPrefix(path, 1).as_posix()
+        return self.shard(path, sharding).as_posix()
 
-    def getSubdir(self, environ: dict) -> pathlib.PurePosixPath:
-        return self.addPrefix(pathlib.PurePosixPath(environ['WT_DAV_TALE_ID']), 1)
+    def getSubdir(self, context, sharding=None) -> pathlib.PurePosixPath:
+        return self.shard(pathlib.PurePosixPath(context.taleId), sharding)
 
     def girderPathMatches(self, path: pathlib.Path):
         # we may want to allow removal of the whole thing, and, maybe also in the case of users
@@ -125,9 +195,12 @@ class TalePathMapper(PathMapper):
 
 
 class RunsPathMapper(PathMapper):
-    run_to_tale = dict()  # mutable for a reason...
+    # runId -> taleId, recorded when runs are authorized or provisioned; shared by all
+    # processes so that any of them can map paths of runs seen by another
+    run_to_tale = SharedCache('runs.tales', ttl=RUN_TO_TALE_TTL)
+    sharding = PrefixSharding(2)
 
-    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str]) -> str:
+    def davToPhysical(self, path: Union[pathlib.PurePosixPath, str], sharding=None) -> str:
         path = self._toPosixPurePath(path)
         if path.is_absolute():
             run_id = path.parts[1]
@@ -139,13 +212,31 @@ class RunsPathMapper(PathMapper):
         if remainder:
             path += "/" + "/".join(remainder)
         path = self._toPosixPurePath(path)
-        return self.addPrefix(path, 2).as_posix()
+        return self.shard(path, sharding).as_posix()
 
-    def getSubdir(self, environ: dict) -> pathlib.PurePosixPath:
-        self.run_to_tale[environ["WT_DAV_RUN_ID"]] = environ["WT_DAV_TALE_ID"]
-        path_base = f"{environ['WT_DAV_TALE_ID']}/{environ['WT_DAV_RUN_ID']}/workspace"
-        path = self.addPrefix(pathlib.PurePosixPath(path_base), 2)
+    def getSubdir(self, context, sharding=None) -> pathlib.PurePosixPath:
+        if self.run_to_tale.get(context.runId) != context.taleId:
+            self.run_to_tale[context.runId] = context.taleId
+        path_base = f"{context.taleId}/{context.runId}/workspace"
+        path = self.shard(pathlib.PurePosixPath(path_base), sharding)
         return path
 
     def getRealm(self):
         return "runs"
+
+
+REALM_PATH_MAPPERS = {
+    'homes': HomePathMapper,
+    'tales': TalePathMapper,
+    'runs': RunsPathMapper
+}
+
+
+def configureSharding(config: dict):
+    """Sets the sharding schemes from a {realm: {'scheme': ..., 'previous': ...}} dict.
+    Realms that are not listed keep their current scheme."""
+    for realm, entry in config.items():
+        cls = REALM_PATH_MAPPERS[realm]
+        cls.sharding = parseSharding(entry['scheme'])
+        previous = entry.get('previous')
+        cls.previousSharding = parseSharding(previous) if previous else None
@@ -0,0 +1,48 @@
+# The environ key holding the context
+ENVIRON_KEY = 'wt_home_dirs.context'
+
+
+class IOCounters:
+    """What the provider did on behalf of a request (see IOAccountant)."""
+    __slots__ = ('bytesRead', 'bytesWritten', 'filesOpened', 'stats')
+
+    def __init__(self):
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.filesOpened = 0
+        # resources looked up, each of which stats its file
+        self.stats = 0
+
+
+class RequestContext:
+    """
+    What the WT parts of the DAV stack (domain controller, authorizer, directory
+    initializer, path mapper and provider) find out about a request, kept in a single
+    environ entry so that each of them can use it without parsing the path or looking
+    up the user, tale or run again.
+    """
+    __slots__ = ('path', 'parts', 'userName', 'user', 'taleId', 'tale', 'runId', 'run',
+                 'subdir', 'io')
+
+    def __init__(self, path):
+        self.path = path
+        # '/<id>/a/b' -> ('<id>', 'a', 'b')
+        self.parts = tuple(part for part in path.split('/') if part)
+        self.userName = None
+        self.user = None
+        self.taleId = None
+        self.tale = None
+        self.runId = None
+        self.run = None
+        # the directory holding the user/tale/run files, relative to the realm root;
+        # set by DirectoryInitializer
+        self.subdir = None
+        self.io = IOCounters()
+
+    @classmethod
+    def of(cls, environ):
+        """Returns the context of the request, creating it on first use."""
+        context = environ.get(ENVIRON_KEY)
+        if context is None:
+            context = environ[ENVIRON_KEY] = cls(environ.get('PATH_INFO', '/'))
+        return context
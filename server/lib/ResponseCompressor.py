@@ -0,0 +1,210 @@
+import tempfile
+import zlib
+
+from wsgidav.middleware import BaseMiddleware
+
+DEFAULT_LEVEL = 6
+# Responses whose Content-Length is below this are sent as they are
+DEFAULT_MIN_SIZE = 1024
+# Compressed bodies are kept in memory up to this size, then in a temporary file
+MAX_BUFFERED_SIZE = 16 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+
+# Listings: PROPFIND/REPORT multistatus and WsgiDavDirBrowser pages
+LISTING_TYPES = {'application/xml', 'text/xml', 'text/html'}
+# Files with these types are compressed when enabled; other types are usually compressed
+# already (images, archives, ...) or binary
+FILE_TYPES = {'application/json', 'application/javascript', 'application/xml',
+              'image/svg+xml', 'application/x-ipynb+json', 'application/x-sh'}
+# wbits for zlib.compressobj(); gzip adds a header and a trailer, HTTP's "deflate" is the
+# zlib format
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def parseAcceptEncoding(header):
+    """Returns the content coding to use from ENCODINGS for an Accept-Encoding header,
+    preferring gzip, or None."""
+    accepted = {}
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for coding in ENCODINGS:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def addVary(headers, field):
+    """Returns <headers> with <field> listed in the Vary header."""
+    newHeaders = []
+    found = False
+    for name, value in headers:
+        if name.lower() == 'vary':
+            found = True
+            if field.lower() not in [v.strip().lower() for v in value.split(',')]:
+                value += ', ' + field
+        newHeaders.append((name, value))
+    if not found:
+        newHeaders.append(('Vary', field))
+    return newHeaders
+
+
+class ResponseCompressor(BaseMiddleware):
+    """
+    Compresses listings (PROPFIND multistatus XML and directory browser HTML) with gzip or
+    deflate, as negotiated with Accept-Encoding, while they are sent. Multistatus bodies
+    for large collections are several megabytes of very repetitive XML.
+
+    File bodies (responses with an ETag) are only compressed if the "files" option is
+    set, and only for text types, in which case their ETag is made weak. Partial,
+    HEAD and already encoded responses, and those smaller than "minSize", are left alone.
+    Responses that would be compressed for other clients are sent with "Vary:
+    Accept-Encoding" either way, so that caches keep both variants apart.
+
+    Responses with a Content-Length (multistatus and directory browser bodies are built
+    in full before they are sent) are compressed completely before they are sent, with
+    the compressed length, so that the connection can be kept alive. Those without one
+    are compressed while they are sent, and wsgidav closes the connection after them.
+    Options come from config['wt_compression']: "level" (1-9, 0 disables compression),
+    "minSize" and "files".
+
+    This must sit inside of IOAccountant in the middleware stack, so that the bytes
+    actually sent are accounted.
+    """
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+        options = config.get('wt_compression') or {}
+        self.level = options.get('level', DEFAULT_LEVEL)
+        self.minSize = options.get('minSize', DEFAULT_MIN_SIZE)
+        self.files = options.get('files', False)
+
+    def __call__(self, environ, start_response):
+        if not self.level:
+            return self.application(environ, start_response)
+        coding = None
+        if environ['REQUEST_METHOD'] != 'HEAD':
+            coding = parseAcceptEncoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if coding is not None and self.files and 'HTTP_IF_NONE_MATCH' in environ:
+            # clients send back the weak ETags of compressed files; wsgidav only matches
+            # strong ones, which is fine for If-None-Match
+            environ['HTTP_IF_NONE_MATCH'] = environ['HTTP_IF_NONE_MATCH'].replace('W/', '')
+        response = _CompressedResponse(self, coding, start_response)
+        response.iterable = self.application(environ, response.startResponse)
+        return response
+
+    def shouldCompress(self, status, headers):
+        if not status.startswith('200') and not status.startswith('207'):
+            return False
+        contentType = None
+        isFile = False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding' or \
+                    (name == 'cache-control' and 'no-transform' in value.lower()):
+                return False
+            if name == 'content-length':
+                try:
+                    if int(value) < self.minSize:
+                        return False
+                except ValueError:
+                    return False
+            if name == 'content-type':
+                contentType = value.split(';')[0].strip().lower()
+            elif name == 'etag':
+                isFile = True
+        if contentType is None:
+            return False
+        if isFile:
+            isText = contentType.startswith('text/') or contentType in FILE_TYPES
+            return self.files and isText
+        return contentType in LISTING_TYPES
+
+
+class _CompressedResponse:
+    def __init__(self, compressor, coding, start_response):
+        self.compressor = compressor
+        self.coding = coding
+        self.start_response = start_response
+        self.iterable = None
+        # set when the response turns out to be compressible
+        self.zobj = None
+        # the compressed body and the arguments of start_response, if the response is
+        # only started once its compressed length is known
+        self.buffer = None
+        self.pending = None
+
+    def startResponse(self, status, headers, exc_info=None):
+        headers = self._headers(status, headers)
+        if self.buffer is None:
+            return self.start_response(status, headers, exc_info)
+        self.pending = (status, headers, exc_info)
+        return self._write
+
+    def _write(self, data):
+        self.buffer.write(self.zobj.compress(data))
+
+    def _headers(self, status, headers):
+        """Returns the headers to send."""
+        if not self.compressor.shouldCompress(status, headers):
+            return headers
+        headers = addVary(headers, 'Accept-Encoding')
+        if self.coding is None:
+            return headers
+        self.zobj = zlib.compressobj(self.compressor.level, zlib.DEFLATED,
+                                     ENCODINGS[self.coding])
+        newHeaders = []
+        for name, value in headers:
+            lname = name.lower()
+            if lname == 'content-length':
+                # the length is known, so the body is not a stream that could go on
+                self.buffer = tempfile.SpooledTemporaryFile(max_size=MAX_BUFFERED_SIZE)
+                continue
+            if lname == 'etag' and not value.startswith('W/'):
+                # the compressed bytes are not those of the resource
+                value = 'W/' + value
+            newHeaders.append((name, value))
+        newHeaders.append(('Content-Encoding', self.coding))
+        return newHeaders
+
+    def __iter__(self):
+        for data in self.iterable:
+            if self.zobj is None:
+                yield data
+            elif self.buffer is not None:
+                self._write(data)
+            else:
+                data = self.zobj.compress(data)
+                if data:
+                    yield data
+        if self.zobj is None:
+            return
+        if self.buffer is None:
+            yield self.zobj.flush()
+            return
+        self.buffer.write(self.zobj.flush())
+        status, headers, exc_info = self.pending
+        self.start_response(status, headers + [('Content-Length', str(self.buffer.tell()))],
+                            exc_info)
+        self.buffer.seek(0)
+        while True:
+            data = self.buffer.read(BLOCK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
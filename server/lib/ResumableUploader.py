@@ -0,0 +1,237 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST, HTTP_CONFLICT, HTTP_CREATED, \
+    HTTP_FORBIDDEN, HTTP_METHOD_NOT_ALLOWED, HTTP_NO_CONTENT
+from wsgidav.middleware import BaseMiddleware
+from wsgidav import compat, util
+
+from ..constants import STAGING_DIR
+from .ContentStore import hashFile
+from .WTFilesystemProvider import CHANGE_WRITE
+
+_logger = util.getModuleLogger(__name__, True)
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+UPLOADS_DIR = 'uploads'
+# Sessions that have not received data for this long are removed
+SESSION_TTL = 24 * 3600
+CLEANUP_INTERVAL = 600
+
+_RANGE_RE = re.compile(r'^bytes\s+(?:(\d+)-(\d+)|\*)/(\d+)$')
+
+
+class ResumableUploader(BaseMiddleware):
+    """
+    Implements resumable uploads through PUT requests carrying a Content-Range header
+    (which wsgidav rejects), similar to the protocol used by Google Cloud Storage:
+
+        PUT /tales/<taleId>/big.dat
+        Content-Range: bytes 0-1048575/31457280000
+
+    sends the first MiB of a file. Each chunk must start at or before the current
+    offset of the upload; the response is "308 Resume Incomplete" with a
+    "Range: bytes=0-<last byte received>" header until the last chunk, which gets the
+    usual 201/204. After a dropped connection, the client asks for the offset with an
+    empty body and
+
+        Content-Range: bytes */31457280000
+
+    and resumes from there.
+
+    Received data is appended to a file in the realm's staging directory, which is on
+    the same filesystem as the target, and only replaces the target, atomically, once
+    complete, so the target is never seen partially written. The offset is the size of
+    the staged data, so it survives process restarts and is shared by all worker
+    processes. Sessions are per user and target; only chunks start or restart them,
+    probes merely report the offset. Sessions that receive no data for SESSION_TTL
+    seconds are removed. Completed uploads are deduplicated if the realm has a content
+    store (see ContentStore).
+    """
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+        self.blockSize = config.get('block_size', DEFAULT_BLOCK_SIZE)
+        self.uploadsDir = os.path.join(config['wt_home_dirs_root'], STAGING_DIR, UPLOADS_DIR)
+        self.lastCleanup = 0.0
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'PUT' or 'HTTP_CONTENT_RANGE' not in environ:
+            return self.application(environ, start_response)
+        match = _RANGE_RE.match(environ['HTTP_CONTENT_RANGE'].strip())
+        if match is None:
+            raise DAVError(HTTP_BAD_REQUEST, 'Invalid Content-Range header')
+        total = int(match.group(3))
+        if match.group(1) is None:
+            start = end = None
+        else:
+            start, end = int(match.group(1)), int(match.group(2))
+            if end < start or end >= total:
+                raise DAVError(HTTP_BAD_REQUEST, 'Invalid Content-Range header')
+
+        self._maybeCleanup()
+        provider = environ['wsgidav.provider']
+        if provider.isReadOnly():
+            raise DAVError(HTTP_FORBIDDEN)
+        path = environ['PATH_INFO']
+        res = provider.getResourceInst(path, environ)
+        if res is not None and res.isCollection:
+            raise DAVError(HTTP_METHOD_NOT_ALLOWED, 'Cannot PUT to a collection')
+        parentRes = provider.getResourceInst(util.getUriParent(path), environ)
+        if parentRes is None or not parentRes.isCollection:
+            raise DAVError(HTTP_CONFLICT, 'PUT parent must be a collection')
+        self._checkLocks(provider, path, environ)
+
+        target = provider._locToFilePath(path, environ)
+        user = environ.get('http_authenticator.username')
+        partPath, metaPath = self._sessionPaths(target, user)
+        if start is None:
+            # probes only report the offset, they never start or restart a session
+            return self._sendOffset(environ, start_response,
+                                    self._getOffset(partPath, metaPath, total),
+                                    '308 Resume Incomplete')
+        os.makedirs(self.uploadsDir, exist_ok=True)
+        with open(partPath, 'ab') as part:
+            # Serialize chunks of the same upload across threads and processes
+            fcntl.flock(part, fcntl.LOCK_EX)
+            meta = self._loadMeta(metaPath)
+            if meta is None or meta['total'] != total:
+                if meta is not None:
+                    _logger.info('Restarting upload of %s with a different size' % path)
+                part.truncate(0)
+                meta = {'path': path, 'target': target, 'total': total, 'user': user,
+                        'created': time.time()}
+                self._saveMeta(metaPath, meta)
+            offset = os.fstat(part.fileno()).st_size
+            if start > offset:
+                return self._sendOffset(environ, start_response, offset, '409 Conflict')
+            if start < offset:
+                # a retransmission of data we already have
+                part.truncate(start)
+                offset = start
+            offset = self._receive(environ, part, end - start + 1, offset)
+            self._saveMeta(metaPath, dict(meta, offset=offset, updated=time.time()))
+
+            if offset < total:
+                return self._sendOffset(environ, start_response, offset,
+                                        '308 Resume Incomplete')
+            isNew = self._complete(provider.contentStore, part, partPath, metaPath, target,
+                                   total)
+        provider.notifyChange(CHANGE_WRITE, path, environ)
+        _logger.debug('Resumable upload of %s complete (%d bytes)' % (path, total))
+        return util.sendStatusResponse(environ, start_response,
+                                       HTTP_CREATED if isNew else HTTP_NO_CONTENT)
+
+    def _complete(self, store, part, partPath, metaPath, target, total):
+        """Moves the data of a complete upload into place. Returns whether the target
+        is new."""
+        part.flush()
+        os.fsync(part.fileno())
+        digest = None
+        if store is not None and store.supported and total >= store.minSize:
+            # chunks may come from several processes and be retransmitted, so the data is
+            # hashed once complete rather than as it arrives
+            digest = hashFile(partPath, self.blockSize)
+        isNew = not os.path.exists(target)
+        # Replace rather than overwrite the target so that content hard-linked elsewhere
+        # is preserved (see WTFileResource.beginWrite)
+        os.replace(partPath, target)
+        os.remove(metaPath)
+        if digest is not None:
+            store.addFile(target, digest)
+        return isNew
+
+    def _checkLocks(self, provider, path, environ):
+        lockMan = provider.lockManager
+        if lockMan is None:
+            return
+        if 'wsgidav.conditions.if' not in environ:
+            util.parseIfHeaderDict(environ)
+        lockMan.checkWritePermission(compat.quote(provider.sharePath + path), '0',
+                                     environ['wsgidav.ifLockTokenList'],
+                                     environ.get('http_authenticator.username'))
+
+    def _sessionPaths(self, target, user):
+        # Each user has their own session for a given target, so that users cannot
+        # append to (or restart) each other's uploads
+        key = hashlib.sha1(('%s\0%s' % (user or '', target)).encode(
+            'utf8', 'surrogateescape')).hexdigest()
+        base = os.path.join(self.uploadsDir, key)
+        return base + '.part', base + '.json'
+
+    def _getOffset(self, partPath, metaPath, total):
+        """Returns the offset of the session of an upload of <total> bytes, 0 if there is
+        none."""
+        try:
+            with open(partPath, 'rb') as part:
+                fcntl.flock(part, fcntl.LOCK_SH)
+                meta = self._loadMeta(metaPath)
+                if meta is None or meta['total'] != total:
+                    return 0
+                return os.fstat(part.fileno()).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _loadMeta(self, metaPath):
+        try:
+            with open(metaPath) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _saveMeta(self, metaPath, meta):
+        tmpPath = metaPath + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmpPath, metaPath)
+
+    def _receive(self, environ, part, length, offset):
+        stream = environ['wsgi.input']
+        remaining = length
+        try:
+            while remaining > 0:
+                data = stream.read(min(remaining, self.blockSize))
+                if not data:
+                    break
+                environ['wsgidav.some_input_read'] = 1
+                part.write(data)
+                remaining -= len(data)
+                offset += len(data)
+        finally:
+            # whatever made it to disk counts; the client resumes from there
+            part.flush()
+        if remaining == 0:
+            environ['wsgidav.all_input_read'] = 1
+        return offset
+
+    def _sendOffset(self, environ, start_response, offset, status):
+        headers = [('Content-Length', '0'), ('Date', util.getRfc1123Time())]
+        if offset > 0:
+            headers.append(('Range', 'bytes=0-%d' % (offset - 1)))
+        start_response(status, headers)
+        return [b'']
+
+    def _maybeCleanup(self):
+        now = time.time()
+        if now - self.lastCleanup > CLEANUP_INTERVAL:
+            self.lastCleanup = now
+            self.cleanup(now - SESSION_TTL)
+
+    def cleanup(self, olderThan):
+        """Removes upload sessions that have not been touched since <olderThan>."""
+        try:
+            entries = list(os.scandir(self.uploadsDir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < olderThan:
+                    os.remove(entry.path)
+                    _logger.debug('Removed stale upload data %s' % entry.path)
+            except FileNotFoundError:
+                pass
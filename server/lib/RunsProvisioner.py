@@ -0,0 +1,51 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from girder.models.folder import Folder
+
+from .Authorizer import RunsAuthorizer
+from .DirectoryInitializer import RunsDirectoryInitializer
+from .PathMapper import RunsPathMapper
+from .RequestContext import RequestContext
+
+# mkdir on shared storage is mostly waiting for the server, so do a few at once
+DEFAULT_WORKERS = 8
+
+
+class RunsProvisioner:
+    """
+    Prepares the runs realm for runs that are about to be used, so that the first DAV
+    requests made for them (typically from the containers running them) do not have to
+    load the run and tale folders or create directories. For a batch of run folders,
+    it loads all parent folders with one query, fills the run -> tale index of
+    RunsPathMapper and the folder cache of RunsAuthorizer, and creates the workspace
+    directories concurrently.
+    """
+    def __init__(self, rootPath, maxWorkers=DEFAULT_WORKERS):
+        self.rootPath = rootPath
+        self.maxWorkers = maxWorkers
+        self.pathMapper = RunsPathMapper()
+
+    def provision(self, runs):
+        parentIds = list({run['parentId'] for run in runs})
+        parents = {parent['_id']: parent for parent in Folder().find({'_id': {'$in': parentIds}})}
+        subdirs = []
+        for run in runs:
+            parent = parents.get(run['parentId'])
+            if parent is None:
+                continue
+            RunsAuthorizer.cacheRun(run, parent)
+            # what RunsAuthorizer finds out for requests about the run
+            context = RequestContext('/%s' % run['_id'])
+            context.runId = str(run['_id'])
+            context.taleId = parent['name']
+            # also records the run in RunsPathMapper.run_to_tale
+            subdirs.append(self.pathMapper.getSubdir(context))
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            list(pool.map(self._makeDir, subdirs))
+        return len(subdirs)
+
+    def _makeDir(self, subdir):
+        # same path as the one DirectoryInitializer would create
+        os.makedirs('/%s/%s' % (self.rootPath, subdir), exist_ok=True)
+        RunsDirectoryInitializer.initializedFor[subdir] = True
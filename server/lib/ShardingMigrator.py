@@ -0,0 +1,107 @@
+import os
+import re
+
+from girder import logger
+from girder.models.folder import Folder
+from girder.utility.model_importer import ModelImporter
+from girder.utility.progress import noProgress
+
+from .PathMapper import RunsPathMapper
+
+
+class ShardingMigrator:
+    """
+    Moves the user/tale directories of a realm from one sharding scheme to another and
+    updates the fsPath of the Girder folders (and the workspace manifest) accordingly.
+
+    The migration is meant to run while the DAV server is in use: the realm's path
+    mapper must already be configured with the new scheme and with the old one as
+    previousSharding, so that directories are looked up at their old location until
+    they are moved (see WTFilesystemProvider._locToFilePath()), in every server process
+    (see Homedirs.setSharding()). Each directory is moved with a single rename, so it is
+    never visible at both locations.
+    """
+    def __init__(self, rootPath, pathMapper, oldSharding, newSharding):
+        self.rootPath = os.path.abspath(rootPath)
+        self.pathMapper = pathMapper
+        self.oldSharding = oldSharding
+        self.newSharding = newSharding
+        # The runs realm has a directory per tale holding a directory per run. New runs
+        # can be created in the new layout while the migration is in progress, in
+        # which case the runs from the old tale directory are merged into it.
+        self.mergeDepth = 1 if isinstance(pathMapper, RunsPathMapper) else 0
+
+    def _sourceDirs(self):
+        # <root>/<prefix 1>/.../<prefix n>/<id>; dot directories are ours (staging, CAS)
+        level = [()]
+        for i in range(self.oldSharding.depth):
+            level = [parts + (name,) for parts in level
+                     for name in self._listDirs(os.path.join(self.rootPath, *parts))
+                     if i > 0 or not name.startswith('.')]
+        for parts in level:
+            for name in self._listDirs(os.path.join(self.rootPath, *parts)):
+                # skip anything that does not belong to the old layout (e.g., the
+                # directories of the new layout, if both have the same depth)
+                if tuple(self.oldSharding.prefix(name)) == parts:
+                    yield name, os.path.join(self.rootPath, *parts, name)
+
+    def _listDirs(self, path):
+        try:
+            return sorted(e.name for e in os.scandir(path) if e.is_dir(follow_symlinks=False))
+        except FileNotFoundError:
+            return []
+
+    def _move(self, src, dest, depth, stats):
+        if os.path.isdir(dest):
+            if not os.listdir(dest):
+                # created (but not used) in the new layout after the migration started
+                os.rmdir(dest)
+            elif depth < self.mergeDepth:
+                for name in os.listdir(src):
+                    self._move(os.path.join(src, name), os.path.join(dest, name),
+                               depth + 1, stats)
+                self._removeEmpty(src)
+                return
+            else:
+                logger.warning('Not moving %s: %s already exists' % (src, dest))
+                stats['conflicts'].append(src)
+                return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.rename(src, dest)
+        stats['folders'] += self._updatePaths(src, dest)
+
+    def _updatePaths(self, src, dest):
+        """Points the folders and manifest entries below <src> to <dest>."""
+        n = 0
+        cursor = Folder().find({'fsPath': {'$regex': '^%s(/|$)' % re.escape(src)}},
+                               fields=['fsPath'])
+        for folder in cursor:
+            Folder().update({'_id': folder['_id']},
+                            {'$set': {'fsPath': dest + folder['fsPath'][len(src):]}})
+            n += 1
+        ModelImporter.model('workspace_manifest', 'wt_home_dir').moveRoot(src, dest)
+        return n
+
+    def _removeEmpty(self, path):
+        """Removes <path> and its parents below the root as long as they are empty."""
+        while path.startswith(self.rootPath + '/'):
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
+
+    def migrate(self, progress=noProgress):
+        stats = {'moved': 0, 'folders': 0, 'conflicts': []}
+        for name, src in list(self._sourceDirs()):
+            dest = os.path.join(self.rootPath, *self.newSharding.prefix(name), name)
+            if src == dest:
+                continue
+            progress.update(increment=1, message='Moving %s' % name)
+            self._move(src, dest, 0, stats)
+            if not os.path.exists(src):
+                stats['moved'] += 1
+                self._removeEmpty(os.path.dirname(src))
+        logger.info('Sharding of %s changed from %s to %s: %s' %
+                    (self.rootPath, self.oldSharding, self.newSharding, stats))
+        return stats
@@ -0,0 +1,269 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+import bson
+from girder import logger
+
+# How often a process looks for entries invalidated by other processes
+POLL_INTERVAL = 0.5
+# How long invalidations are kept for other processes to see
+INVALIDATION_TTL = 300.0
+CLEANUP_INTERVAL = 60.0
+DEFAULT_LOCAL_SIZE = 10000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB,
+    expire REAL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_expire ON entries (expire);
+CREATE TABLE IF NOT EXISTS invalidations (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    namespace TEXT NOT NULL,
+    key TEXT,
+    time REAL
+);
+'''
+
+
+class SharedStore:
+    """
+    The shared tier of SharedCache: a table of entries in an SQLite database in WAL
+    mode that all Girder processes on a host open, along with a log of invalidations
+    through which each process learns which of its local entries to drop. Like the lock
+    database (see WTLockStorage), it should be on a local filesystem, ideally tmpfs.
+    """
+    def __init__(self, storagePath):
+        self.storagePath = os.path.abspath(storagePath)
+        # sqlite connections cannot be shared between threads
+        self._local = threading.local()
+        self._lastCleanup = 0.0
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.storagePath)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.storagePath, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def open(self):
+        # Only Girder may read the entries (e.g., user records and hashed token IDs).
+        # SQLite gives the -wal and -shm files the mode of the database.
+        os.makedirs(os.path.dirname(self.storagePath), mode=0o700, exist_ok=True)
+        os.close(os.open(self.storagePath, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(self.storagePath, 0o600)
+        self._connection().executescript(_SCHEMA)
+
+    def get(self, namespace, key):
+        """Returns (value, expire) or None."""
+        row = self._connection().execute(
+            'SELECT value, expire FROM entries WHERE namespace = ? AND key = ?',
+            (namespace, key)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return bson.BSON(row[0]).decode()['v'], row[1]
+
+    def set(self, namespace, key, value, expire):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO entries (namespace, key, value, expire) VALUES (?, ?, ?, ?)',
+            (namespace, key, bson.BSON.encode({'v': value}), expire))
+        self._maybeCleanup()
+
+    def invalidate(self, namespace, key=None):
+        """Removes an entry (or, if key is None, all entries of the namespace) and tells
+        the other processes to drop their copies."""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN')
+            if key is None:
+                conn.execute('DELETE FROM entries WHERE namespace = ?', (namespace,))
+            else:
+                conn.execute('DELETE FROM entries WHERE namespace = ? AND key = ?',
+                             (namespace, key))
+            conn.execute('INSERT INTO invalidations (namespace, key, time) VALUES (?, ?, ?)',
+                         (namespace, key, time.time()))
+
+    def lastInvalidation(self):
+        row = self._connection().execute('SELECT MAX(seq) FROM invalidations').fetchone()
+        return row[0] or 0
+
+    def invalidationsSince(self, seq):
+        return self._connection().execute(
+            'SELECT seq, namespace, key FROM invalidations WHERE seq > ? ORDER BY seq',
+            (seq,)).fetchall()
+
+    def _maybeCleanup(self):
+        now = time.time()
+        if now - self._lastCleanup < CLEANUP_INTERVAL:
+            return
+        self._lastCleanup = now
+        conn = self._connection()
+        conn.execute('DELETE FROM entries WHERE expire < ?', (now,))
+        conn.execute('DELETE FROM invalidations WHERE time < ?', (now - INVALIDATION_TTL,))
+
+
+class _Broadcast:
+    # Applies the invalidations logged by other processes to the local tiers
+    def __init__(self):
+        self.store = None
+        self.caches = collections.defaultdict(list)
+        self.seq = 0
+        self.lastPoll = 0.0
+        self.lock = threading.Lock()
+
+    def configure(self, store):
+        with self.lock:
+            self.store = store
+            self.seq = store.lastInvalidation() if store is not None else 0
+            for caches in self.caches.values():
+                for cache in caches:
+                    cache.clearLocal()
+
+    def poll(self):
+        now = time.time()
+        if self.store is None or now - self.lastPoll < POLL_INTERVAL:
+            return
+        with self.lock:
+            if now - self.lastPoll < POLL_INTERVAL:
+                return
+            self.lastPoll = now
+            try:
+                rows = self.store.invalidationsSince(self.seq)
+            except sqlite3.Error:
+                logger.exception('Cannot read cache invalidations from %s' % self.store)
+                return
+            for seq, namespace, key in rows:
+                self.seq = seq
+                for cache in self.caches.get(namespace, ()):
+                    if key is None:
+                        cache.clearLocal()
+                    else:
+                        cache.removeLocal(key)
+
+
+_broadcast = _Broadcast()
+
+
+def configureSharedCaches(storagePath):
+    """Makes all SharedCache instances use the database at <storagePath> as their
+    shared tier. Until this is called, they are local to the process."""
+    store = None
+    if storagePath is not None:
+        store = SharedStore(storagePath)
+        store.open()
+    _broadcast.configure(store)
+
+
+class SharedCache:
+    """
+    A cache with two tiers: an LRU dictionary local to the process, in front of a
+    table shared by all processes on the host (see configureSharedCaches()). Entries
+    expire after <ttl> seconds (never if None). Removing entries removes them from all
+    processes, which pick up the change within POLL_INTERVAL. Values must be BSON
+    serializable.
+
+    Keys are converted to strings. Instances also support `key in cache`, `cache[key]`
+    and `cache[key] = value`, so that they can replace plain dictionaries.
+
+    Values that are not BSON serializable can be cached with <encode> and <decode>
+    functions, which convert them to and from what is kept in the shared tier; the local
+    tier keeps the values themselves.
+    """
+    def __init__(self, namespace, ttl=None, maxSize=DEFAULT_LOCAL_SIZE, encode=None,
+                 decode=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.encode = encode
+        self.decode = decode
+        self.local = collections.OrderedDict()
+        self.lock = threading.Lock()
+        _broadcast.caches[namespace].append(self)
+
+    def get(self, key, default=None):
+        key = str(key)
+        _broadcast.poll()
+        now = time.time()
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > now:
+                    self.local.move_to_end(key)
+                    return entry[0]
+                del self.local[key]
+        store = _broadcast.store
+        if store is None:
+            return default
+        try:
+            shared = store.get(self.namespace, key)
+        except sqlite3.Error:
+            logger.exception('Cannot read from %s' % store)
+            return default
+        if shared is None:
+            return default
+        value = shared[0] if self.decode is None else self.decode(shared[0])
+        self._setLocal(key, value, shared[1])
+        return value
+
+    def set(self, key, value, ttl=None):
+        key = str(key)
+        ttl = self.ttl if ttl is None else ttl
+        expire = None if ttl is None else time.time() + ttl
+        self._setLocal(key, value, expire)
+        store = _broadcast.store
+        if store is not None:
+            if self.encode is not None:
+                value = self.encode(value)
+            try:
+                store.set(self.namespace, key, value, expire)
+            except sqlite3.Error:
+                logger.exception('Cannot write to %s' % store)
+
+    def _setLocal(self, key, value, expire):
+        with self.lock:
+            self.local[key] = (value, expire)
+            self.local.move_to_end(key)
+            while len(self.local) > self.maxSize:
+                self.local.popitem(last=False)
+
+    def remove(self, key):
+        key = str(key)
+        self.removeLocal(key)
+        if _broadcast.store is not None:
+            _broadcast.store.invalidate(self.namespace, key)
+
+    def clear(self):
+        self.clearLocal()
+        if _broadcast.store is not None:
+            _broadcast.store.invalidate(self.namespace)
+
+    def removeLocal(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+
+    def clearLocal(self):
+        with self.lock:
+            self.local.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
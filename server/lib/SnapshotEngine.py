@@ -0,0 +1,247 @@
+import errno
+import fcntl
+import gzip
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from girder import logger
+from girder.utility.progress import noProgress
+
+# Snapshots are made of hard links to the files of the workspace (cheap, but files
+# that are later modified in place also change in the snapshot; see
+# WTFileResource.beginWrite()) or of reflinks (copy-on-write clones, on filesystems that
+# support them, such as XFS and btrfs; plain copies elsewhere).
+MODE_LINK = 'link'
+MODE_REFLINK = 'reflink'
+DEFAULT_WORKERS = 16
+# The manifest of a snapshot is kept next to it, in <snapshot><MANIFEST_SUFFIX>
+MANIFEST_SUFFIX = '.wt-manifest.gz'
+# from linux/fs.h
+FICLONE = 0x40049409
+# Directories modified this close to (or after) the time the base snapshot started are
+# listed again, since further changes within the same timestamp tick would go unnoticed
+RACY_WINDOW_NS = 2 * 10**9
+
+_KIND_DIR = 'd'
+_KIND_FILE = 'f'
+_KIND_LINK = 'l'
+
+
+class SnapshotEngine:
+    """
+    Creates point-in-time copies of workspace directories, e.g., for tale versions.
+
+    Directories are processed in parallel by a thread pool, since the time goes into
+    metadata operations that mostly wait for the (possibly remote) filesystem. Each
+    snapshot records, in its manifest, the mtime of each directory and the size and
+    mtime of each entry. When a previous snapshot of the same workspace is given as a
+    base, directories whose mtime has not changed since are not listed again: the names
+    and kinds of their entries are taken from the base manifest. Their files are still
+    stat-ed, since files modified in place keep their name and leave the mtime of the
+    directory alone. Every directory is still stat-ed (a change below a directory does
+    not change its mtime, so unchanged subtrees cannot be skipped) and created in the
+    snapshot. With reflinks, files that have not changed are hard-linked to their copy
+    in the base snapshot rather than cloned again.
+
+    The snapshot is built under a temporary name and renamed into place when
+    complete, so a partial snapshot is never visible at <dest>.
+    """
+    def __init__(self, mode=MODE_LINK, maxWorkers=DEFAULT_WORKERS):
+        if mode not in (MODE_LINK, MODE_REFLINK):
+            raise ValueError('Unknown snapshot mode: %s' % mode)
+        self.mode = mode
+        self.maxWorkers = maxWorkers
+        self.reflinkSupported = True
+
+    def snapshot(self, src, dest, base=None, progress=noProgress):
+        """
+        Copies the directory <src> to <dest>, which must not exist, optionally using
+        the earlier snapshot <base> of <src>. Returns statistics: the number of
+        directories, files and symbolic links, the size of the files, and the number of
+        directories listed and of files taken from <base>.
+        """
+        src = os.path.abspath(src)
+        dest = os.path.abspath(dest)
+        if os.path.lexists(dest):
+            raise FileExistsError(errno.EEXIST, 'Snapshot already exists', dest)
+        baseManifest = None
+        if base is not None:
+            base = os.path.abspath(base)
+            baseManifest = self.readManifest(base)
+        tmpDest = '%s.%s.wt-tmp' % (dest, uuid.uuid4().hex)
+        job = _SnapshotJob(self, src, tmpDest, base, baseManifest, progress)
+        try:
+            job.run()
+            os.rename(tmpDest, dest)
+        except BaseException:
+            shutil.rmtree(tmpDest, ignore_errors=True)
+            raise
+        self._writeManifest(dest, job.manifest)
+        logger.info('Snapshot of %s to %s: %s' % (src, dest, job.stats))
+        return job.stats
+
+    def readManifest(self, snapshot):
+        try:
+            with gzip.open(snapshot + MANIFEST_SUFFIX, 'rt', encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning('No usable manifest for snapshot %s' % snapshot)
+            return None
+
+    def _writeManifest(self, snapshot, manifest):
+        tmpPath = '%s.%s' % (snapshot + MANIFEST_SUFFIX, uuid.uuid4().hex)
+        with gzip.open(tmpPath, 'wt', encoding='utf8', compresslevel=1) as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmpPath, snapshot + MANIFEST_SUFFIX)
+
+    def removeSnapshot(self, snapshot):
+        shutil.rmtree(snapshot)
+        try:
+            os.unlink(snapshot + MANIFEST_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def cloneFile(self, srcPath, destPath):
+        if self.mode == MODE_LINK:
+            os.link(srcPath, destPath)
+            return
+        if self.reflinkSupported:
+            with open(srcPath, 'rb') as fsrc, open(destPath, 'wb') as fdest:
+                try:
+                    fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+                    shutil.copystat(srcPath, destPath)
+                    return
+                except OSError as ex:
+                    if ex.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                                        errno.ENOTTY):
+                        raise
+                    logger.info('Reflinks not supported for %s; copying files' % destPath)
+                    self.reflinkSupported = False
+        shutil.copy2(srcPath, destPath)
+
+
+class _SnapshotJob:
+    def __init__(self, engine, src, dest, base, baseManifest, progress):
+        self.engine = engine
+        self.src = src
+        self.dest = dest
+        self.base = base
+        self.progress = progress
+        self.baseTime = (baseManifest or {}).get('time', 0)
+        self.baseDirs = (baseManifest or {}).get('dirs', {})
+        # 'dirs' maps relative directory paths to [mtime_ns, {name: [kind, size, mtime_ns]}]
+        self.manifest = {'time': time.time_ns(), 'dirs': {}}
+        self.dirStats = []
+        self.stats = {'directories': 0, 'files': 0, 'links': 0, 'bytes': 0, 'listed': 0,
+                      'reused': 0}
+        self.lock = threading.Lock()
+
+    def run(self):
+        total = sum(len(entries) for _, entries in self.baseDirs.values())
+        self.progress.update(total=total, current=0, message='Snapshot of %s' % self.src)
+        os.mkdir(self.dest)
+        with ThreadPoolExecutor(max_workers=self.engine.maxWorkers) as pool:
+            pending = {pool.submit(self._copyDir, '')}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for relPath in future.result():
+                        pending.add(pool.submit(self._copyDir, relPath))
+        # directory mtimes change as entries are added, so set them last, deepest first
+        for destPath, st in sorted(self.dirStats, key=lambda e: e[0], reverse=True):
+            os.utime(destPath, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def _list(self, srcDir, relPath, st):
+        """Returns the {name: [kind, size, mtime_ns]} entries of the directory, reusing
+        the base manifest if the directory has not changed since (in which case the
+        sizes and mtimes of files must be refreshed by the caller)."""
+        baseDir = self.baseDirs.get(relPath)
+        if baseDir is not None and baseDir[0] == st.st_mtime_ns and \
+                st.st_mtime_ns < self.baseTime - RACY_WINDOW_NS:
+            return dict(baseDir[1]), True
+        entries = {}
+        with os.scandir(srcDir) as it:
+            for entry in it:
+                est = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(est.st_mode):
+                    kind = _KIND_DIR
+                elif stat.S_ISREG(est.st_mode):
+                    kind = _KIND_FILE
+                elif stat.S_ISLNK(est.st_mode):
+                    kind = _KIND_LINK
+                else:
+                    continue
+                entries[entry.name] = [kind, est.st_size, est.st_mtime_ns]
+        return entries, False
+
+    def _copyDir(self, relPath):
+        srcDir = os.path.join(self.src, relPath)
+        destDir = os.path.join(self.dest, relPath)
+        st = os.stat(srcDir)
+        entries, unchanged = self._list(srcDir, relPath, st)
+        baseEntries = self.baseDirs.get(relPath, [None, {}])[1]
+        subdirs = []
+        nFiles = nLinks = nBytes = nReused = 0
+        for name, entry in list(entries.items()):
+            childPath = name if not relPath else relPath + '/' + name
+            try:
+                if self._copyEntry(srcDir, destDir, name, entry, entries, unchanged,
+                                   baseEntries.get(name), childPath):
+                    nReused += 1
+            except FileNotFoundError:
+                # removed while the snapshot was being taken
+                del entries[name]
+                continue
+            if entry[0] == _KIND_DIR:
+                subdirs.append(childPath)
+            elif entry[0] == _KIND_FILE:
+                nFiles += 1
+                nBytes += entries[name][1]
+            else:
+                nLinks += 1
+        os.chmod(destDir, stat.S_IMODE(st.st_mode))
+        with self.lock:
+            self.manifest['dirs'][relPath] = [st.st_mtime_ns, entries]
+            self.dirStats.append((destDir, st))
+            self.stats['directories'] += 1
+            self.stats['files'] += nFiles
+            self.stats['links'] += nLinks
+            self.stats['bytes'] += nBytes
+            self.stats['reused'] += nReused
+            if not unchanged:
+                self.stats['listed'] += 1
+        self.progress.update(increment=len(entries))
+        return subdirs
+
+    def _copyEntry(self, srcDir, destDir, name, entry, entries, unchanged, baseEntry,
+                   childPath):
+        """Returns True if the file was taken from the base snapshot."""
+        kind = entry[0]
+        srcPath = os.path.join(srcDir, name)
+        destPath = os.path.join(destDir, name)
+        if kind == _KIND_DIR:
+            os.mkdir(destPath)
+        elif kind == _KIND_LINK:
+            os.symlink(os.readlink(srcPath), destPath)
+        elif self.engine.mode == MODE_LINK:
+            os.link(srcPath, destPath)
+            if unchanged:
+                # the file may have been modified in place; the link shares its inode
+                est = os.lstat(destPath)
+                entries[name] = [kind, est.st_size, est.st_mtime_ns]
+        else:
+            if unchanged:
+                # names are the same, but the content may have changed in place
+                est = os.lstat(srcPath)
+                entry = entries[name] = [kind, est.st_size, est.st_mtime_ns]
+            if self.base is not None and baseEntry == entry:
+                os.link(os.path.join(self.base, childPath), destPath)
+                return True
+            self.engine.cloneFile(srcPath, destPath)
+        return False
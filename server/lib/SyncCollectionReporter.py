@@ -0,0 +1,144 @@
+import datetime
+
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST, HTTP_FORBIDDEN, HTTP_NOT_FOUND, \
+    HTTP_INSUFFICIENT_STORAGE
+from wsgidav.middleware import BaseMiddleware
+from wsgidav import compat, util, xml_tools
+from wsgidav.xml_tools import etree
+
+from ..models.workspace_manifest import TOMBSTONE_TTL
+from .WorkspaceIndexer import WorkspaceIndexer
+
+_logger = util.getModuleLogger(__name__, True)
+
+TOKEN_PREFIX = 'urn:x-wt-sync:'
+# Tokens point this far before the time of the report, so that entries written at about
+# the same time (possibly by another host, with a slightly different clock) are reported
+# again rather than missed
+TOKEN_MARGIN = datetime.timedelta(seconds=2)
+EPOCH = datetime.datetime(1970, 1, 1)
+# Reported when a token is unknown or older than the tombstones of removed files
+PRECONDITION_VALID_SYNC_TOKEN = '{DAV:}valid-sync-token'
+PRECONDITION_WITHIN_LIMITS = '{DAV:}number-of-matches-within-limits'
+
+
+def makeSyncToken(time):
+    """A sync token for the changes after <time>: a URI, as RFC 6578 requires, holding
+    the time in hex milliseconds."""
+    return TOKEN_PREFIX + '%x' % ((time - EPOCH) // datetime.timedelta(milliseconds=1))
+
+
+def parseSyncToken(token):
+    """Returns the time of a token from makeSyncToken(), or None if it is not one."""
+    if not token.startswith(TOKEN_PREFIX):
+        return None
+    try:
+        ms = int(token[len(TOKEN_PREFIX):], 16)
+    except ValueError:
+        return None
+    return EPOCH + datetime.timedelta(milliseconds=ms)
+
+
+class SyncCollectionReporter(BaseMiddleware):
+    """
+    Answers sync-collection REPORT requests (RFC 6578) on collections, so that sync
+    clients get what changed since their last sync instead of listing the whole tree
+    with PROPFIND, e.g.:
+
+        REPORT /homes/<user>/data
+
+        <sync-collection xmlns="DAV:">
+          <sync-token>urn:x-wt-sync:18f0c2a4b10</sync-token>
+          <sync-level>infinite</sync-level>
+          <prop><getetag/><getcontentlength/></prop>
+        </sync-collection>
+
+    Changes come from the workspace manifest, which is the journal of each user/tale/run
+    directory: WorkspaceIndexer records changes made through DAV as they happen, and
+    rescans the directories followed this way periodically to pick up those made by
+    containers. Only files are reported: changed files with the requested properties,
+    removed ones with a 404 status. A request without a token lists all the files (and
+    brings the manifest up to date first). Tokens hold the time of the report; those
+    older than the tombstones of removed files are rejected, in which case clients start
+    over without a token.
+
+    This must sit inside of DirectoryInitializer in the middleware stack.
+    """
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+        self.indexer = WorkspaceIndexer()
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'REPORT':
+            return self.application(environ, start_response)
+        requestEL = util.parseXmlBody(environ)
+        if requestEL.tag != '{DAV:}sync-collection':
+            # no other report is supported
+            raise DAVError(HTTP_FORBIDDEN, errcondition='{DAV:}supported-report')
+        token, recursive, props, limit = self._parseBody(requestEL)
+        provider = environ['wsgidav.provider']
+        res = provider.getResourceInst(environ['PATH_INFO'], environ)
+        if res is None:
+            raise DAVError(HTTP_NOT_FOUND)
+        if not res.isCollection:
+            raise DAVError(HTTP_FORBIDDEN, errcondition='{DAV:}supported-report')
+        since = None
+        if token:
+            since = parseSyncToken(token)
+            if since is None or since < datetime.datetime.utcnow() - TOMBSTONE_TTL:
+                raise DAVError(HTTP_FORBIDDEN, errcondition=PRECONDITION_VALID_SYNC_TOKEN)
+
+        root, path = provider.workspaceRoot(environ['PATH_INFO'], environ)
+        now = datetime.datetime.utcnow()
+        if since is None:
+            self.indexer.manifestModel.scan(root, path)
+        self.indexer.watch(root, scanned=since is None)
+        changes = list(self.indexer.manifestModel.changes(root, path, since, recursive))
+        if limit is not None and len(changes) > limit:
+            raise DAVError(HTTP_INSUFFICIENT_STORAGE, errcondition=PRECONDITION_WITHIN_LIMITS)
+        _logger.debug('%s: %d changes since %s' % (environ['PATH_INFO'], len(changes), since))
+
+        multistatusEL = xml_tools.makeMultistatusEL()
+        prefix = len(path) + 1 if path else 0
+        for change in changes:
+            relPath = change['path'][prefix:]
+            href = util.joinUri(res.getHref(), compat.quote(relPath))
+            member = None
+            if not change['deleted']:
+                member = provider.getResourceInst(util.joinUri(res.path, relPath), environ)
+            if member is None or member.isCollection:
+                responseEL = etree.SubElement(multistatusEL, '{DAV:}response')
+                etree.SubElement(responseEL, '{DAV:}href').text = href
+                etree.SubElement(responseEL, '{DAV:}status').text = 'HTTP/1.1 404 Not Found'
+            else:
+                util.addPropertyResponse(multistatusEL, href,
+                                         member.getProperties('named', nameList=props))
+        etree.SubElement(multistatusEL, '{DAV:}sync-token').text = \
+            makeSyncToken(now - TOKEN_MARGIN)
+        return util.sendMultiStatusResponse(environ, start_response, multistatusEL)
+
+    def _parseBody(self, requestEL):
+        token = ''
+        recursive = False
+        props = []
+        limit = None
+        for node in requestEL:
+            if node.tag == '{DAV:}sync-token':
+                token = (node.text or '').strip()
+            elif node.tag == '{DAV:}sync-level':
+                level = (node.text or '').strip()
+                if level not in ('1', 'infinite'):
+                    raise DAVError(HTTP_BAD_REQUEST, 'Invalid sync-level: %s' % level)
+                recursive = level == 'infinite'
+            elif node.tag == '{DAV:}prop':
+                props = [propEL.tag for propEL in node]
+            elif node.tag == '{DAV:}limit':
+                for limitEL in node:
+                    if limitEL.tag == '{DAV:}nresults':
+                        try:
+                            limit = int(limitEL.text)
+                        except (TypeError, ValueError):
+                            raise DAVError(HTTP_BAD_REQUEST, 'Invalid nresults')
+        return token, recursive, props or ['{DAV:}getetag'], limit
@@ -0,0 +1,52 @@
+from wsgidav.middleware import BaseMiddleware
+
+from .Authorizer import DAV_READ_OPS
+from .RequestContext import RequestContext
+from .WTDomainController import WTDomainController
+
+TOKEN_COOKIE = 'girderToken'
+# Where the login of the user is passed to HTTPAuthenticator (as its trusted_auth_header).
+# Not an HTTP_ key, so clients cannot set it.
+TOKEN_USER_KEY = 'wt_home_dirs.token_user'
+
+
+class TokenAuthenticator(BaseMiddleware):
+    """
+    Authenticates requests carrying a Girder token in a Girder-Token header, as an
+    "Authorization: Bearer" header or, for read-only requests, in the Girder cookie.
+    Such requests skip basic authentication: HTTPAuthenticator takes the login of their
+    user from TOKEN_USER_KEY, so that it is also their lock principal. Must sit outside
+    of HTTPAuthenticator in the stack.
+
+    Tokens are accepted under the same conditions as "token:<id>" basic passwords
+    (valid, belonging to a user and with a user authentication or WebDAV scope; see
+    WTDomainController.getTokenUser()), and both go through the same cache.
+    """
+    def __init__(self, application, config):
+        BaseMiddleware.__init__(self, application, config)
+        self.application = application
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        tokenId = self.getTokenId(environ)
+        if tokenId:
+            user = WTDomainController.getTokenUser(tokenId)
+            if user is not None:
+                RequestContext.of(environ).user = user
+                environ[TOKEN_USER_KEY] = user.login
+        return self.application(environ, start_response)
+
+    def getTokenId(self, environ):
+        if 'HTTP_GIRDER_TOKEN' in environ:
+            return environ['HTTP_GIRDER_TOKEN']
+        authorization = environ.get('HTTP_AUTHORIZATION', '')
+        if authorization[:7].lower() == 'bearer ':
+            return authorization[7:].strip()
+        # As in Girder, cookies are not accepted for requests that change anything,
+        # since browsers send them along with cross-site requests
+        if environ['REQUEST_METHOD'] in DAV_READ_OPS and 'HTTP_COOKIE' in environ:
+            for cookie in environ['HTTP_COOKIE'].split(';'):
+                name, _, value = cookie.strip().partition('=')
+                if name == TOKEN_COOKIE:
+                    return value
+        return None
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+from girder import logger
+
+from .SharedCache import SharedCache
+from .WTFilesystemProvider import CHANGE_MOVE, CHANGE_MKDIR
+
+# How long the usage of a directory is kept after it was last computed...
+USAGE_TTL = 24 * 3600.0
+# ... and how old it can get before it is recomputed, when still asked for
+REFRESH_INTERVAL = 3600.0
+# Upper bound on the number of directories measured in one pass of the background task
+REFRESH_BATCH = 20
+
+
+def measure(root):
+    """Returns the total size of the files below <root> (a cached du)."""
+    size = 0
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def availableBytes(root):
+    st = os.statvfs(root)
+    return st.f_bavail * st.f_frsize
+
+
+class UsageIndex:
+    """
+    The space used by each user/tale/run directory and the space available on its
+    filesystem, for the RFC 4331 quota properties of their root collections. Requests
+    only read the index: directories are measured (with statvfs and a walk) by
+    refresh(), which runs in the background, when they are first asked for and then
+    at most every REFRESH_INTERVAL. In between, instances registered as provider change
+    listeners apply the size changes of writes and deletes of files, and queue the
+    directories affected by other changes for measuring. The index is shared by the
+    processes on a host.
+    """
+    # manifest root (see ResourceChange.workspaceRoot()) -> {'used', 'available', 'time'}
+    usage = SharedCache('usage', ttl=USAGE_TTL)
+    # roots to measure, in this process
+    pending = set()
+    pendingLock = threading.Lock()
+
+    def get(self, root):
+        """Returns the usage of <root>, or None if it was not measured yet."""
+        entry = self.usage.get(root)
+        if entry is None or time.time() - entry['time'] > REFRESH_INTERVAL:
+            self.schedule(root)
+        return entry
+
+    def schedule(self, root):
+        with self.pendingLock:
+            self.pending.add(root)
+
+    def __call__(self, change):
+        root, _ = change.workspaceRoot()
+        if change.sizeDelta is not None:
+            self.adjust(root, change.sizeDelta)
+        elif change.action == CHANGE_MOVE:
+            destRoot, _ = change.workspaceRoot(change.destPath)
+            if destRoot != root:
+                self.schedule(root)
+                self.schedule(destRoot)
+        elif change.action != CHANGE_MKDIR:
+            # copies, and changes to collections
+            self.schedule(change.workspaceRoot(change.destPath)[0]
+                          if change.destPath is not None else root)
+
+    def adjust(self, root, delta):
+        entry = self.usage.get(root)
+        if entry is None or not delta:
+            return
+        entry = dict(entry, used=max(entry['used'] + delta, 0),
+                     available=max(entry['available'] - delta, 0))
+        self.usage.set(root, entry)
+
+    def refresh(self):
+        """Measures the directories that are due."""
+        with self.pendingLock:
+            roots = [self.pending.pop() for i in range(min(len(self.pending),
+                                                           REFRESH_BATCH))]
+        for root in roots:
+            try:
+                entry = {'available': availableBytes(root), 'used': measure(root),
+                         'time': time.time()}
+            except FileNotFoundError:
+                continue
+            except OSError:
+                logger.exception('Cannot measure %s' % root)
+                continue
+            self.usage.set(root, entry)
@@ -0,0 +1,48 @@
+class UserRecord:
+    """
+    The parts of a user document that the DAV stack needs: the login, whether the user
+    can log in, and what Girder access checks look at (_id, admin and groups). Records
+    are loaded with a projection and cached instead of full user documents. They can be
+    passed as `user` to Girder models, which only read them with `user[key]` and
+    `user.get(key)`.
+    """
+    __slots__ = ('_id', 'login', 'status', 'admin', 'groups')
+    # the projection used to load records
+    FIELDS = list(__slots__)
+
+    def __init__(self, _id, login, status='enabled', admin=False, groups=()):
+        self._id = _id
+        self.login = login
+        self.status = status
+        self.admin = admin
+        self.groups = groups
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self._id, self.login)
+
+    @classmethod
+    def fromDocument(cls, doc):
+        """Makes a record from a (possibly projected) user document or from asDict()."""
+        return cls(doc['_id'], doc['login'], doc.get('status', 'enabled'),
+                   doc.get('admin', False), tuple(doc.get('groups', ())))
+
+    def asDict(self):
+        return {'_id': self._id, 'login': self.login, 'status': self.status,
+                'admin': self.admin, 'groups': list(self.groups)}
+
+    def canLogin(self):
+        return self.status != 'disabled'
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.__slots__
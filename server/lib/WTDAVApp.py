@@ -0,0 +1,8 @@
+from wsgidav.wsgidav_app import WsgiDAVApp
+
+
+class WTDAVApp(WsgiDAVApp):
+    def __call__(self, environ, start_response):
+        if 'HTTP_X_FORWARDED_PROTO' in environ:
+            environ['wsgi.url_scheme'] = environ['HTTP_X_FORWARDED_PROTO']
+        return super().__call__(environ, start_response)
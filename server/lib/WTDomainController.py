@@ -1,11 +1,16 @@
 import datetime
+import hashlib
 import time
 from girder import logger
-from girder.constants import SettingKey
+from girder.constants import SettingKey, TokenScope
 from girder.models.api_key import ApiKey as ApiKeyModel
 from girder.models.model_base import AccessException
 from girder.models.setting import Setting
 from girder.utility.model_importer import ModelImporter
+from ..constants import DAV_TOKEN_SCOPE
+from .RequestContext import RequestContext
+from .SharedCache import SharedCache
+from .UserRecord import UserRecord
 
 
 class CacheEntry:
@@ -18,9 +23,10 @@ class CacheEntry:
 
 
 class Cache:
-    def __init__(self, expirationTime=1.0):
+    def __init__(self, expirationTime=1.0, maxSize=None):
         self.dict = {}
         self.expirationTime = expirationTime
+        self.maxSize = maxSize
 
     def get(self, key):
         try:
@@ -37,8 +43,18 @@ class Cache:
             return entry.value
 
     def set(self, key, value):
+        if self.maxSize is not None and len(self.dict) >= self.maxSize:
+            self.purge()
         self.dict[key] = CacheEntry(value)
 
+    def purge(self):
+        # drop expired entries, or everything if that is not enough
+        for key, entry in list(self.dict.items()):
+            if entry.isExpired(self.expirationTime):
+                self.remove(key)
+        if self.maxSize is not None and len(self.dict) >= self.maxSize:
+            self.dict.clear()
+
     def remove(self, key):
         try:
             del self.dict[key]
@@ -49,14 +65,101 @@ class Cache:
         self.dict.clear()
 
 
+# How long a token is trusted without looking at the database again. Removed tokens are
+# dropped from the cache of all processes (see forgetToken() in the plugin), so this
+# only bounds the effect of changes made behind Girder's back.
+TOKEN_CACHE_TTL = 60.0
+# How long user records are cached; they are dropped when a user is saved or removed
+USER_CACHE_TTL = 300.0
+
+
+class TokenCache:
+    """
+    Maps token IDs to the IDs of the users they belong to. Entries are valid until the
+    token expires or for TOKEN_CACHE_TTL, whichever comes first. Entries are shared by
+    the Girder processes of a host (see SharedCache), keyed by the sha256 of the token
+    ID, so that the shared database does not hold usable tokens.
+    """
+    def __init__(self, ttl=TOKEN_CACHE_TTL):
+        self.ttl = ttl
+        self.cache = SharedCache('tokens.users', ttl=ttl)
+
+    def _key(self, tokenId):
+        return hashlib.sha256(tokenId.encode('utf8')).hexdigest()
+
+    def get(self, tokenId):
+        return self.cache.get(self._key(tokenId))
+
+    def set(self, tokenId, userId, tokenExpires):
+        remaining = (tokenExpires - datetime.datetime.utcnow()).total_seconds()
+        if remaining > 0:
+            self.cache.set(self._key(tokenId), userId, min(self.ttl, remaining))
+
+    def remove(self, tokenId):
+        self.cache.remove(self._key(tokenId))
+
+    def clear(self):
+        self.cache.clear()
+
+
+class UserCache:
+    """
+    The records (see UserRecord) of users, by ID, along with the IDs of users by login,
+    shared by the Girder processes of a host. forget() drops what is cached for a user
+    when it is saved or removed; entries cached under a former login are detected by
+    the login of the record they lead to.
+    """
+    def __init__(self, ttl=USER_CACHE_TTL):
+        self.records = SharedCache('users.records', ttl=ttl, encode=UserRecord.asDict,
+                                   decode=UserRecord.fromDocument)
+        self.logins = SharedCache('users.logins', ttl=ttl)
+
+    def getById(self, userId):
+        """Returns the record of a user, or None if there is no such user."""
+        user = self.records.get(userId)
+        if user is None:
+            doc = ModelImporter.model('user').load(userId, force=True,
+                                                   fields=UserRecord.FIELDS)
+            if doc is None:
+                return None
+            user = self._add(doc)
+        return user
+
+    def getByLogin(self, login):
+        """Returns the record of the user with <login>, or None."""
+        userId = self.logins.get(login)
+        if userId is not None:
+            user = self.getById(userId)
+            if user is not None and user.login == login:
+                return user
+        doc = ModelImporter.model('user').findOne({'login': login}, fields=UserRecord.FIELDS)
+        if doc is None:
+            return None
+        return self._add(doc)
+
+    def _add(self, doc):
+        user = UserRecord.fromDocument(doc)
+        self.records.set(user._id, user)
+        self.logins.set(user.login, user._id)
+        return user
+
+    def forget(self, user):
+        self.records.remove(user['_id'])
+        self.logins.remove(user['login'])
+
+    def clear(self):
+        self.records.clear()
+        self.logins.clear()
+
+
 class WTDomainController(object):
+    # shared by all realms and by TokenAuthenticator
+    tokenCache = TokenCache()
+    userCache = UserCache()
+
     def __init__(self, realm):
         self.realm = realm
-        self.userModel = ModelImporter.model('user')
         self.passwordModel = ModelImporter.model('password', 'wt_home_dir')
-        self.tokenModel = ModelImporter.model('token')
-        self.tokenCache = Cache()
-        self.userCache = Cache()
 
     def __repr__(self):
         return self.__class__.__name__
@@ -69,6 +172,8 @@ class WTDomainController(object):
         return self.realm
 
     def requireAuthentication(self, realmname, environ):
+        # Always; users found by TokenAuthenticator are accepted by HTTPAuthenticator
+        # through its trusted_auth_header, which also sets the lock principal
         return True
 
     def isRealmUser(self, realmname, username, environ):
@@ -94,7 +199,7 @@ class WTDomainController(object):
                 success = False
 
         if success:
-            environ['WT_DAV_USER_DICT'] = self._getUser(username)
+            RequestContext.of(environ).user = self._getUser(username)
         return success
 
     def _authenticateApiKey(self, username, password):
@@ -107,40 +212,35 @@ class WTDomainController(object):
         return token_user.get('_id', 'no_token') == user['_id']
 
     def _authenticateToken(self, username, password):
-        token = self._getToken(password[6:])
-        if token is None:
-            return False
-        if 'userId' not in token:
+        tokenUser = self.getTokenUser(password[6:])
+        if tokenUser is None:
             return False
         user = self._getUser(username)
-        if token['userId'] != user['_id']:
+        if tokenUser['_id'] != user['_id']:
             return False
         return True
 
     def _getUser(self, username):
-        user = self.userCache.get(username)
-        if user is not None:
-            return user
-        user = self.userModel.findOne({'login': username})
-        if user is None:
-            return None
-        else:
-            self.userCache.set(username, user)
-            return user
-
-    def _getToken(self, tokenStr):
-        now = datetime.datetime.utcnow()
-        token = self.tokenCache.get(tokenStr)
-        if token is None:
-            token = self.tokenModel.load(tokenStr, force=True, objectId=False)
-            if token is None:
+        """Returns the UserRecord of a user that can log in, or None."""
+        user = self.userCache.getByLogin(username)
+        return user if user is not None and user.canLogin() else None
+
+    @classmethod
+    def getTokenUser(cls, tokenId):
+        """Returns the UserRecord of the user a valid token belongs to, or None. Only
+        tokens that authenticate their user, or grant WebDAV access, are valid here."""
+        userId = cls.tokenCache.get(tokenId)
+        if userId is None:
+            tokenModel = ModelImporter.model('token')
+            token = tokenModel.load(tokenId, force=True, objectId=False,
+                                    fields=['userId', 'expires', 'scope'])
+            if token is None or 'userId' not in token or \
+                    token['expires'] < datetime.datetime.utcnow():
                 return None
-            else:
-                self.tokenCache.set(tokenStr, token)
-        if now > token['expires']:
-            try:
-                self.tokenCache.remove[tokenStr]
-            except KeyError:
-                pass
-            return None
-        return token
+            if not tokenModel.hasScope(token, TokenScope.USER_AUTH) and \
+                    not tokenModel.hasScope(token, DAV_TOKEN_SCOPE):
+                return None
+            userId = token['userId']
+            cls.tokenCache.set(tokenId, userId, token['expires'])
+        user = cls.userCache.getById(userId)
+        return user if user is not None and user.canLogin() else None
@@ -1,29 +1,104 @@
 import os
 import stat
 
-from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN
+from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN, HTTP_INSUFFICIENT_STORAGE, \
+    HTTP_NOT_FOUND
+from wsgidav.dav_provider import DAVCollection, DAVNonCollection
 from wsgidav.fs_dav_provider import \
     FilesystemProvider, FolderResource, FileResource
 from wsgidav import compat, util
+from wsgidav.xml_tools import etree
 from girder import logger
+from .ContentStore import HashingWriter, breakLink
+from .IOAccountant import CountingReader, CountingWriter
+from .IOTuning import IOTuning, releaseUnused
 from .PathMapper import PathMapper
+from .RequestContext import RequestContext, ENVIRON_KEY
 
 
 PROP_EXECUTABLE = '{http://apache.org/dav/props/}executable'
+# RFC 3253; lists the sync-collection REPORT on collections (see SyncCollectionReporter)
+PROP_SUPPORTED_REPORT_SET = '{DAV:}supported-report-set'
+# RFC 4331; on the root collections of users, tales and runs (see UsageIndex)
+PROP_QUOTA_USED = '{DAV:}quota-used-bytes'
+PROP_QUOTA_AVAILABLE = '{DAV:}quota-available-bytes'
 WT_HOME_FLAG = '__WT_HOME__'
 
+# Kinds of changes reported to provider change listeners. A write to a collection means
+# that anything under it may have changed (e.g., after extracting an archive into it).
+CHANGE_WRITE = 'write'
+CHANGE_MKDIR = 'mkdir'
+CHANGE_DELETE = 'delete'
+CHANGE_MOVE = 'move'
+CHANGE_COPY = 'copy'
+
+
+class ResourceChange:
+    """A change made through a provider, as passed to its change listeners."""
+    def __init__(self, provider, action, path, environ, destPath=None, hash=None,
+                 sizeDelta=None):
+        self.provider = provider
+        self.action = action
+        self.path = path
+        self.destPath = destPath
+        self.environ = environ
+        # sha256 of the new content of a written file, if it was computed
+        self.hash = hash
+        # by how much the size of the files of the user/tale/run changed, if known
+        self.sizeDelta = sizeDelta
+
+    @property
+    def filePath(self):
+        return self.provider._locToFilePath(self.path, self.environ)
+
+    @property
+    def destFilePath(self):
+        if self.destPath is None:
+            return None
+        return self.provider._locToFilePath(self.destPath, self.environ)
+
+    def workspaceRoot(self, path=None):
+        """Returns the physical root of the user/tale/run directory containing <path>
+        (by default, the changed resource), and the path relative to it."""
+        return self.provider.workspaceRoot(path or self.path, self.environ)
+
+
+def isExecutableValue(value):
+    """Whether a value of the executable property (an XML element) means executable."""
+    return value is not None and value.text in ('1', 'T')
+
+
+def executableMode(mode, executable):
+    """Returns <mode> with the executable bit set or cleared."""
+    return mode | stat.S_IEXEC if executable else mode & ~stat.S_IEXEC
+
+
+def _initFromStat(res, base, path, environ, fp, filestat):
+    # What FileResource/FolderResource.__init__() do, with a stat result at hand
+    base.__init__(res, path, environ)
+    res._filePath = fp
+    res.filestat = filestat
+    res.name = compat.to_native(os.path.basename(fp))
+
 
 # A mixin to deal with the executable property for WT*Resource
 class _WTDAVResource:
     def __init__(self, pathMapper):
         self.pathMapper = pathMapper
+        self.io = RequestContext.of(self.environ).io
+        self.io.stats += 1
 
     def getPropertyNames(self, isAllProp):
         props = super().getPropertyNames(isAllProp)
         props.append(PROP_EXECUTABLE)
+        if not isAllProp and self._isWorkspaceRoot():
+            # RFC 4331 keeps them out of allprop
+            props.extend([PROP_QUOTA_USED, PROP_QUOTA_AVAILABLE])
         return props
 
     def getPropertyValue(self, propname):
+        if propname in (PROP_QUOTA_USED, PROP_QUOTA_AVAILABLE):
+            return self._getQuotaValue(propname)
         if propname == PROP_EXECUTABLE:
             return self.isExecutable()
         else:
@@ -43,51 +118,140 @@ class _WTDAVResource:
             return 'T'
 
     def setExecutable(self, value):
-        if value.text == '1' or value.text == 'T':
-            newmode = self.filestat[stat.ST_MODE] | stat.S_IEXEC
-        else:
-            newmode = self.filestat[stat.ST_MODE] & (~stat.S_IEXEC)
+        newmode = executableMode(self.filestat[stat.ST_MODE], isExecutableValue(value))
+        if not self.isCollection:
+            # the mode belongs to the inode, which may be shared with other files
+            breakLink(self._filePath)
         os.chmod(self._filePath, newmode)
         # re-read stat
         self.filestat = os.stat(self._filePath)
 
     def getUser(self):
-        return self.environ['WT_DAV_USER_DICT']
+        return RequestContext.of(self.environ).user
+
+    def _isWorkspaceRoot(self):
+        path = self.path.strip('/')
+        return self.isCollection and path != '' and '/' not in path
+
+    def _getQuotaValue(self, propname):
+        usageIndex = self.provider.usageIndex
+        usage = None
+        if usageIndex is not None and self._isWorkspaceRoot():
+            # never measured here; the first request only queues the directory
+            usage = usageIndex.get(self._filePath)
+        if usage is None:
+            raise DAVError(HTTP_NOT_FOUND)
+        return str(usage['used'] if propname == PROP_QUOTA_USED else usage['available'])
+
+    def _notify(self, action, destPath=None, hash=None, sizeDelta=None):
+        self.provider.notifyChange(action, self.path, self.environ, destPath, hash,
+                                   sizeDelta)
 
 
 class WTFolderResource(_WTDAVResource, FolderResource):
-    def __init__(self, path, environ, fp, pathMapper):
-        FolderResource.__init__(self, path, environ, fp)
+    def __init__(self, path, environ, fp, pathMapper, filestat=None):
+        if filestat is None:
+            FolderResource.__init__(self, path, environ, fp)
+        else:
+            _initFromStat(self, DAVCollection, path, environ, fp, filestat)
         _WTDAVResource.__init__(self, pathMapper)
 
+    def getPropertyNames(self, isAllProp):
+        props = super().getPropertyNames(isAllProp)
+        if not isAllProp:
+            # not worth adding to every allprop listing
+            props.append(PROP_SUPPORTED_REPORT_SET)
+        return props
+
+    def getPropertyValue(self, propname):
+        if propname == PROP_SUPPORTED_REPORT_SET:
+            supportedReportSetEL = etree.Element(propname)
+            reportEL = etree.SubElement(
+                etree.SubElement(supportedReportSetEL, '{DAV:}supported-report'),
+                '{DAV:}report')
+            etree.SubElement(reportEL, '{DAV:}sync-collection')
+            return supportedReportSetEL
+        return super().getPropertyValue(propname)
+
     # Override to return proper objects when doing recursive listings.
     # One would have thought that FilesystemProvider.getResourceInst() was
     # the only place that needed to be overriden...
     def getMember(self, name):
         assert compat.is_native(name), "%r" % name
         fp = os.path.join(self._filePath, compat.to_unicode(name))
+        try:
+            st = os.stat(fp)
+        except (OSError, ValueError):
+            return None
+        return self._makeMember(name, fp, st)
+
+    def getMemberList(self):
+        # One stat per member (from a single directory listing), shared by the checks
+        # for the type of the member and its live properties, including the executable
+        # one, rather than the several that getMemberNames() and getMember() do. This is
+        # what PROPFIND requests with Depth 1 or infinity go through.
+        members = []
+        with os.scandir(self._filePath) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # dangling symlink or removed since the listing
+                    continue
+                res = self._makeMember(compat.to_native(entry.name), entry.path, st)
+                if res is not None:
+                    members.append(res)
+        return members
+
+    def _makeMember(self, name, fp, st):
         path = util.joinUri(self.path, name)
-        if os.path.isdir(fp):
-            res = WTFolderResource(path, self.environ, fp, self.pathMapper)
-        elif os.path.isfile(fp):
-            res = WTFileResource(path, self.environ, fp, self.pathMapper)
-        else:
-            res = None
-        return res
+        if stat.S_ISDIR(st.st_mode):
+            return WTFolderResource(path, self.environ, fp, self.pathMapper, st)
+        elif stat.S_ISREG(st.st_mode):
+            return WTFileResource(path, self.environ, fp, self.pathMapper, st)
+        return None
 
     def createCollection(self, name):
         logger.debug('%s -> createCollection(%s)' % (self.getRefUrl(), name))
         FolderResource.createCollection(self, name)
+        self.provider.notifyChange(CHANGE_MKDIR, util.joinUri(self.path, name), self.environ)
 
     def createEmptyResource(self, name):
         logger.debug('%s -> createEmptyResource(%s)' % (self.getRefUrl(), name))
-        return FolderResource.createEmptyResource(self, name)
+        res = FolderResource.createEmptyResource(self, name)
+        self.provider.notifyChange(CHANGE_WRITE, res.path, self.environ, sizeDelta=0)
+        return res
+
+    def delete(self):
+        FolderResource.delete(self)
+        self._notify(CHANGE_DELETE)
+
+    def copyMoveSingle(self, destPath, isMove):
+        # a move is done as a copy followed by a delete, which is reported separately
+        FolderResource.copyMoveSingle(self, destPath, isMove)
+        self._notify(CHANGE_COPY, destPath)
+
+    def moveRecursive(self, destPath):
+        FolderResource.moveRecursive(self, destPath)
+        self._notify(CHANGE_MOVE, destPath)
 
 
 class WTFileResource(_WTDAVResource, FileResource):
-    def __init__(self, path, environ, fp, pathMapper):
-        FileResource.__init__(self, path, environ, fp)
+    def __init__(self, path, environ, fp, pathMapper, filestat=None):
+        if filestat is None:
+            FileResource.__init__(self, path, environ, fp)
+        else:
+            _initFromStat(self, DAVNonCollection, path, environ, fp, filestat)
         _WTDAVResource.__init__(self, pathMapper)
+        self.writer = None
+        self.preallocated = False
+        # the size of the file being overwritten
+        self.previousSize = None
+
+    def getEtag(self):
+        # same as wsgidav's util.getETag(), without stat-ing the file again
+        return '%d-%d-%d' % (self.filestat[stat.ST_INO], self.filestat[stat.ST_MTIME],
+                             self.filestat[stat.ST_SIZE])
 
     def delete(self):
         if os.path.isfile(self._filePath):
@@ -95,6 +259,7 @@ class WTFileResource(_WTDAVResource, FileResource):
         else:
             self.removeAllProperties(True)
             self.removeAllLocks(True)
+        self._notify(CHANGE_DELETE, sizeDelta=-self.filestat[stat.ST_SIZE])
 
     def beginWrite(self, contentType=None):
         # Override to delete file instead of simply truncating in order to
@@ -106,14 +271,88 @@ class WTFileResource(_WTDAVResource, FileResource):
         if self.provider.readonly:
             raise DAVError(HTTP_FORBIDDEN)
         os.remove(self._filePath)
-        return super().beginWrite(contentType=contentType)
+        self.previousSize = self.filestat[stat.ST_SIZE]
+        file = super().beginWrite(contentType=contentType)
+        self.io.filesOpened += 1
+        try:
+            file, self.preallocated = self.provider.ioTuning.openForWriting(
+                file, self._getUploadLength())
+        except OSError as ex:
+            # not enough space for the upload
+            raise DAVError(HTTP_INSUFFICIENT_STORAGE, str(ex))
+        if self.provider.contentStore is not None:
+            file = self.writer = HashingWriter(file)
+        return CountingWriter(file, self.io)
+
+    def _getUploadLength(self):
+        try:
+            return int(self.environ['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            # chunked
+            return None
+
+    def getContent(self):
+        contentCache = self.provider.contentCache
+        if contentCache is not None and contentCache.isCacheable(self.filestat):
+            return contentCache.open(self._filePath, self.filestat, self.io)
+        self.io.filesOpened += 1
+        file = self.provider.ioTuning.openForReading(FileResource.getContent(self),
+                                                     self.filestat[stat.ST_SIZE])
+        return CountingReader(file, self.io)
+
+    def endWrite(self, withErrors):
+        if self.preallocated and withErrors:
+            releaseUnused(self._filePath)
+        hash = None
+        if self.writer is not None and not withErrors:
+            hash = self.writer.hexdigest()
+            self.provider.contentStore.addFile(self._filePath, hash)
+        sizeDelta = None
+        if self.previousSize is not None:
+            try:
+                sizeDelta = os.stat(self._filePath).st_size - self.previousSize
+            except OSError:
+                pass
+        # even a failed write changes the content
+        self._notify(CHANGE_WRITE, hash=hash, sizeDelta=sizeDelta)
+
+    def copyMoveSingle(self, destPath, isMove):
+        FileResource.copyMoveSingle(self, destPath, isMove)
+        self._notify(CHANGE_COPY, destPath)
+
+    def moveRecursive(self, destPath):
+        FileResource.moveRecursive(self, destPath)
+        self._notify(CHANGE_MOVE, destPath)
 
 
-# Adds support for 'executable' property
+# Adds support for 'executable' property and change notifications
 class WTFilesystemProvider(FilesystemProvider):
     def __init__(self, rootDir, pathMapper: PathMapper):
         FilesystemProvider.__init__(self, rootDir)
         self.pathMapper = pathMapper
+        self.changeListeners = []
+        # deduplicates written files if set (see ContentStore)
+        self.contentStore = None
+        # serves small files from memory if set (see ContentCache)
+        self.contentCache = None
+        self.ioTuning = IOTuning()
+        # serves the quota properties if set (see UsageIndex)
+        self.usageIndex = None
+
+    def addChangeListener(self, listener):
+        """Registers a callable invoked with a ResourceChange after each successful
+        modification of the tree done through this provider."""
+        self.changeListeners.append(listener)
+
+    def notifyChange(self, action, path, environ, destPath=None, hash=None, sizeDelta=None):
+        change = ResourceChange(self, action, path, environ, destPath, hash, sizeDelta)
+        for listener in self.changeListeners:
+            try:
+                listener(change)
+            except Exception:
+                # the change itself was made; listeners must not fail the request
+                logger.exception('Change listener %r failed for %s %s' %
+                                 (listener, action, path))
 
     def getResourceInst(self, path, environ):
         """Return info dictionary for path.
@@ -122,13 +361,50 @@ class WTFilesystemProvider(FilesystemProvider):
         """
         self._count_getResourceInst += 1
         fp = self._locToFilePath(path, environ)
-        if not os.path.exists(fp):
+        try:
+            st = os.stat(fp)
+        except (OSError, ValueError):
             return None
 
-        if os.path.isdir(fp):
-            return WTFolderResource(path, environ, fp, self.pathMapper)
-        return WTFileResource(path, environ, fp, self.pathMapper)
+        if stat.S_ISDIR(st.st_mode):
+            return WTFolderResource(path, environ, fp, self.pathMapper, st)
+        return WTFileResource(path, environ, fp, self.pathMapper, st)
+
+    def workspaceRoot(self, path, environ):
+        """Returns the physical root of the user/tale/run directory containing <path>, and
+        the path relative to it: the root and path used by the workspace manifest."""
+        parts = path.strip('/').split('/')
+        root = self._locToFilePath('/' + parts[0], environ)
+        return root, '/'.join(parts[1:])
 
     def _locToFilePath(self, path, environ=None):
-        return FilesystemProvider._locToFilePath(self, self.pathMapper.davToPhysical(path),
-                                                 environ)
+        context = environ.get(ENVIRON_KEY) if environ is not None else None
+        if context is not None and context.subdir is not None:
+            # Most paths are within the user/tale/run directory of the request, whose
+            # location DirectoryInitializer already worked out
+            top, _, rest = path.lstrip('/').partition('/')
+            if top == context.parts[0]:
+                return FilesystemProvider._locToFilePath(
+                    self, '/%s/%s' % (context.subdir, rest), environ)
+        sharding = None
+        if self.pathMapper.previousSharding is not None:
+            sharding = self._shardingOf(path)
+        return FilesystemProvider._locToFilePath(
+            self, self.pathMapper.davToPhysical(path, sharding), environ)
+
+    def _shardingOf(self, path):
+        # While the realm is being migrated to a new sharding scheme (see
+        # ShardingMigrator), user/tale directories that were not moved yet are at their
+        # location in the previous one.
+        parts = path.strip('/').split('/')
+        if not parts[0]:
+            return None
+        top = '/' + parts[0]
+        if os.path.exists(FilesystemProvider._locToFilePath(
+                self, self.pathMapper.davToPhysical(top))):
+            return None
+        previous = self.pathMapper.previousSharding
+        if os.path.exists(FilesystemProvider._locToFilePath(
+                self, self.pathMapper.davToPhysical(top, previous))):
+            return previous
+        return None
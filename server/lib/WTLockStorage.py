@@ -0,0 +1,229 @@
+import os
+import sqlite3
+import threading
+import time
+
+from wsgidav import compat, util
+from wsgidav.dav_error import DAVError, DAVErrorCondition, HTTP_LOCKED, \
+    PRECONDITION_CODE_LockConflict
+from wsgidav.lock_manager import generateLockToken, lockString, normalizeLockRoot, validateLock
+from wsgidav.lock_storage import LockStorageDict
+
+_logger = util.getModuleLogger(__name__, True)
+
+_COLUMNS = ('token', 'root', 'principal', 'type', 'scope', 'depth', 'owner', 'timeout', 'expire')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS locks (
+    token TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    principal TEXT,
+    type TEXT,
+    scope TEXT,
+    depth TEXT,
+    owner BLOB,
+    timeout REAL,
+    expire REAL
+);
+CREATE INDEX IF NOT EXISTS locks_root ON locks (root);
+CREATE INDEX IF NOT EXISTS locks_expire ON locks (expire);
+'''
+
+
+class WTLockStorage(object):
+    """
+    A lock storage for wsgidav's LockManager that keeps locks in an SQLite database
+    in WAL mode, so that all DAV worker processes on a host see the same locks.
+
+    Locks are indexed by their (normalized) root. Looking up the locks of a path and of
+    its parents is one index lookup per level, and the locks of all descendants of
+    /a/b are the roots in the half-open range ['/a/b/', '/a/b0'), which is an index
+    range scan rather than a scan of the whole lock table. Expired locks are filtered out
+    of every query and periodically purged in bulk.
+
+    LockManager checks for conflicting locks before creating one, but only under its own
+    in-process lock, so create() checks again, in the same transaction as the insert, and
+    raises HTTP_LOCKED when another process got there first.
+
+    The database should live on a local filesystem (e.g., /tmp); SQLite locking is not
+    reliable over NFS.
+    """
+    LOCK_TIME_OUT_DEFAULT = LockStorageDict.LOCK_TIME_OUT_DEFAULT
+    LOCK_TIME_OUT_MAX = LockStorageDict.LOCK_TIME_OUT_MAX
+    CLEANUP_INTERVAL = 60.0
+
+    def __init__(self, storagePath):
+        self._storagePath = os.path.abspath(storagePath)
+        # sqlite connections cannot be shared between threads
+        self._local = threading.local()
+        self._lastCleanup = 0.0
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._storagePath)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._storagePath, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _toLock(self, row):
+        return dict(zip(_COLUMNS, row))
+
+    def open(self):
+        os.makedirs(os.path.dirname(self._storagePath), exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def cleanup(self):
+        """Purge all expired locks."""
+        now = time.time()
+        self._lastCleanup = now
+        cursor = self._connection().execute(
+            'DELETE FROM locks WHERE expire >= 0 AND expire < ?', (now,))
+        if cursor.rowcount > 0:
+            _logger.debug('Purged %d expired locks' % cursor.rowcount)
+
+    def _maybeCleanup(self):
+        if time.time() - self._lastCleanup > self.CLEANUP_INTERVAL:
+            self.cleanup()
+
+    def clear(self):
+        self._connection().execute('DELETE FROM locks')
+
+    def get(self, token):
+        row = self._connection().execute(
+            'SELECT %s FROM locks WHERE token = ?' % ', '.join(_COLUMNS), (token,)).fetchone()
+        if row is None:
+            return None
+        lock = self._toLock(row)
+        if 0 <= lock['expire'] < time.time():
+            _logger.debug('Lock timed-out(%s): %s' % (lock['expire'], lockString(lock)))
+            self.delete(token)
+            return None
+        return lock
+
+    def create(self, path, lock):
+        # Same contract as LockStorageDict.create()
+        assert lock.get('token') is None
+        assert lock.get('expire') is None, 'Use timeout instead of expire'
+        assert path and '/' in path
+
+        lock['root'] = normalizeLockRoot(path)
+
+        timeout = lock.get('timeout')
+        if timeout is None:
+            timeout = self.LOCK_TIME_OUT_DEFAULT
+        else:
+            timeout = float(timeout)
+            if timeout < 0 or timeout > self.LOCK_TIME_OUT_MAX:
+                timeout = self.LOCK_TIME_OUT_MAX
+        lock['timeout'] = timeout
+        lock['expire'] = time.time() + timeout
+
+        validateLock(lock)
+        lock['token'] = generateLockToken()
+
+        self._maybeCleanup()
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the database write lock, so no other process can create
+        # a lock between the check and the insert
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conflicts = self._getConflicts(conn, lock)
+            if not conflicts:
+                conn.execute(
+                    'INSERT INTO locks (%s) VALUES (%s)' % (', '.join(_COLUMNS),
+                                                            ', '.join('?' * len(_COLUMNS))),
+                    tuple(lock[c] for c in _COLUMNS))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if conflicts:
+            _logger.debug('WTLockStorage.create(%r): conflicts with %s' % (path, conflicts))
+            errcond = DAVErrorCondition(PRECONDITION_CODE_LockConflict)
+            for root in conflicts:
+                errcond.add_href(root)
+            raise DAVError(HTTP_LOCKED, errcondition=errcond)
+        _logger.debug('WTLockStorage.create(%r): %s' % (path, lockString(lock)))
+        return lock
+
+    def _getConflicts(self, conn, lock):
+        """Returns the roots of the live locks that conflict with <lock>, with the same
+        rules as LockManager._checkLockPermission()."""
+        root = lock['root']
+        parents = []
+        parent = root
+        while parent != '/':
+            parent = parent.rsplit('/', 1)[0] or '/'
+            parents.append(parent)
+        # the root itself, and parents with depth infinity
+        conditions = ['root = ?']
+        args = [root]
+        if parents:
+            conditions.append("(root IN (%s) AND depth = 'infinity')" %
+                              ', '.join('?' * len(parents)))
+            args.extend(parents)
+        query = '(%s)' % ' OR '.join(conditions)
+        if lock['scope'] == 'shared':
+            # shared locks are compatible with each other
+            query += " AND scope != 'shared'"
+        if lock['depth'] == 'infinity':
+            # any lock on a descendant
+            prefix = root.rstrip('/') + '/'
+            query = '(%s) OR (root >= ? AND root < ? AND root != ?)' % query
+            args.extend([prefix, prefix[:-1] + chr(ord('/') + 1), root])
+        args.append(time.time())
+        rows = conn.execute(
+            'SELECT DISTINCT root FROM locks WHERE (%s) AND (expire < 0 OR expire >= ?)' %
+            query, args).fetchall()
+        return [row[0] for row in rows]
+
+    def refresh(self, token, timeout):
+        assert timeout == -1 or timeout > 0
+        if timeout < 0 or timeout > self.LOCK_TIME_OUT_MAX:
+            timeout = self.LOCK_TIME_OUT_MAX
+        cursor = self._connection().execute(
+            'UPDATE locks SET timeout = ?, expire = ? WHERE token = ?',
+            (timeout, time.time() + timeout, token))
+        if cursor.rowcount == 0:
+            raise ValueError('Lock does not exist: %s' % token)
+        return self.get(token)
+
+    def delete(self, token):
+        cursor = self._connection().execute('DELETE FROM locks WHERE token = ?', (token,))
+        return cursor.rowcount > 0
+
+    def getLockList(self, path, includeRoot, includeChildren, tokenOnly):
+        assert compat.is_native(path)
+        assert path and path.startswith('/')
+        assert includeRoot or includeChildren
+
+        path = normalizeLockRoot(path)
+        conditions = []
+        args = []
+        if includeRoot:
+            conditions.append('root = ?')
+            args.append(path)
+        if includeChildren:
+            prefix = path.rstrip('/') + '/'
+            conditions.append('(root >= ? AND root < ? AND root != ?)')
+            args.extend([prefix, prefix[:-1] + chr(ord('/') + 1), path])
+
+        columns = 'token' if tokenOnly else ', '.join(_COLUMNS)
+        query = 'SELECT %s FROM locks WHERE (%s) AND (expire < 0 OR expire >= ?)' % \
+            (columns, ' OR '.join(conditions))
+        args.append(time.time())
+        rows = self._connection().execute(query, args).fetchall()
+        if tokenOnly:
+            return [row[0] for row in rows]
+        return [self._toLock(row) for row in rows]
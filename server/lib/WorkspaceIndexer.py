@@ -0,0 +1,114 @@
+import datetime
+import threading
+import time
+
+from girder import logger
+from girder.models.folder import Folder
+from girder.models.setting import Setting
+from girder.utility.model_importer import ModelImporter
+
+from ..constants import PluginSettings
+from .WTFilesystemProvider import CHANGE_WRITE, CHANGE_MKDIR, CHANGE_DELETE, CHANGE_MOVE, \
+    CHANGE_COPY
+
+# Upper bound on the number of directories rescanned in one pass of the periodic task
+RESCAN_BATCH = 20
+# Directories followed by sync clients (see watch()) are rescanned this often (seconds)...
+WATCHED_RESCAN_INTERVAL = 60
+# ... until they have not been polled for this long
+WATCH_TTL = 3600
+
+
+class WorkspaceIndexer:
+    """
+    Keeps the workspace manifest up to date. Changes made through the DAV realms are
+    recorded as they happen (instances are registered as provider change listeners);
+    changes made in other ways (e.g., by running containers) are picked up by periodic
+    rescans of the mapped Girder folders, which only write entries whose size or mtime
+    changed. Directories that clients follow with sync-collection REPORT requests are
+    rescanned more often (see watch()).
+    """
+    # root -> [time of the last poll, time of the last rescan], for this process
+    watched = {}
+    watchedLock = threading.Lock()
+
+    def __init__(self):
+        self.manifestModel = ModelImporter.model('workspace_manifest', 'wt_home_dir')
+
+    def __call__(self, change):
+        root, path = change.workspaceRoot()
+        if change.action == CHANGE_DELETE:
+            self.manifestModel.markDeleted(root, path)
+        elif change.action == CHANGE_MOVE:
+            self.manifestModel.markDeleted(root, path)
+            destRoot, destPath = change.workspaceRoot(change.destPath)
+            self.manifestModel.scan(destRoot, destPath)
+        elif change.action == CHANGE_COPY:
+            destRoot, destPath = change.workspaceRoot(change.destPath)
+            self.manifestModel.scan(destRoot, destPath)
+        elif change.action == CHANGE_WRITE and change.hash is not None:
+            self.manifestModel.updateFile(root, path, hash=change.hash)
+        elif change.action == CHANGE_WRITE:
+            self.manifestModel.scan(root, path)
+        elif change.action != CHANGE_MKDIR:
+            logger.warning('Unknown change: %s' % change.action)
+
+    def rescanStale(self):
+        """Rescans mapped folders that were not scanned within the configured interval."""
+        interval = Setting().get(PluginSettings.INDEX_RESCAN_INTERVAL)
+        if not interval:
+            return
+        now = datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(seconds=interval)
+        for i in range(RESCAN_BATCH):
+            # claim the folder first, so that other processes skip it
+            folder = Folder().collection.find_one_and_update(
+                {'isMapping': True, 'fsPath': {'$exists': True},
+                 '$or': [{'wtManifestScanned': {'$exists': False}},
+                         {'wtManifestScanned': {'$lt': cutoff}}]},
+                {'$set': {'wtManifestScanned': now}},
+                projection={'fsPath': True})
+            if folder is None:
+                break
+            try:
+                result = self.manifestModel.scan(folder['fsPath'])
+                logger.debug('Rescanned %s: %s' % (folder['fsPath'], result))
+            except Exception:
+                logger.exception('Failed to rescan %s' % folder['fsPath'])
+
+    def watch(self, root, scanned=False):
+        """Notes that changes to <root> (a manifest root) are being polled, so that
+        changes not made through DAV show up within WATCHED_RESCAN_INTERVAL. <scanned>
+        tells that the caller just rescanned it."""
+        now = time.time()
+        with self.watchedLock:
+            entry = self.watched.setdefault(root, [0, 0])
+            entry[0] = now
+            if scanned:
+                entry[1] = now
+
+    def rescanWatched(self):
+        """Rescans the watched directories that are due, and forgets those that are no
+        longer polled."""
+        now = time.time()
+        with self.watchedLock:
+            for root in [root for root, (polled, _) in self.watched.items()
+                         if now - polled > WATCH_TTL]:
+                del self.watched[root]
+            due = [root for root, (_, scanned) in self.watched.items()
+                   if now - scanned >= WATCHED_RESCAN_INTERVAL]
+        for root in due:
+            try:
+                result = self.manifestModel.scan(root)
+                logger.debug('Rescanned %s: %s' % (root, result))
+            except Exception:
+                logger.exception('Failed to rescan %s' % root)
+            with self.watchedLock:
+                if root in self.watched:
+                    self.watched[root][1] = now
+
+    def rescan(self, folder, computeHash=False):
+        result = self.manifestModel.scan(folder['fsPath'], computeHash=computeHash)
+        Folder().update({'_id': folder['_id']},
+                        {'$set': {'wtManifestScanned': datetime.datetime.utcnow()}})
+        return result
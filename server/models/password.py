@@ -1,10 +1,62 @@
 from girder.models.model_base import AccessControlledModel, AccessException
+from girder.models.setting import Setting
 from girder.utility.model_importer import ModelImporter
 from girder.constants import AccessType
 from bson import objectid
 import datetime
+import json
+import time
 from passlib import pwd
-from passlib.hash import pbkdf2_sha256 as pdigest
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+from ..constants import PluginSettings
+
+# Schemes that can be set in the PluginSettings.PASSWORD_HASHING setting. Hashes made
+# with any of them keep working when the setting changes, and are replaced on the next
+# successful login.
+HASH_SCHEMES = ('pbkdf2_sha256', 'pbkdf2_sha512', 'sha256_crypt', 'sha512_crypt', 'bcrypt',
+                'argon2')
+DEFAULT_HASHING = {'scheme': 'pbkdf2_sha256'}
+# The fewest rounds accepted for passwords chosen by users, which must resist dictionary
+# attacks if the hashes leak, and for generated passwords, which only need to resist brute
+# force. Schemes missing here only have the limits of passlib.
+MIN_ROUNDS = {'pbkdf2_sha256': 29000, 'pbkdf2_sha512': 25000, 'sha256_crypt': 5000,
+              'sha512_crypt': 5000, 'bcrypt': 10}
+MIN_GENERATED_ROUNDS = {'pbkdf2_sha256': 1000, 'pbkdf2_sha512': 1000}
+BENCHMARK_PASSWORD = 'correct horse battery staple'
+
+
+def validateHashingPolicy(policy, generated=False):
+    """Checks a {'scheme': ..., 'rounds': ...} policy for user-set or generated passwords,
+    raising ValueError if it is not usable."""
+    if not isinstance(policy, dict) or policy.get('scheme') not in HASH_SCHEMES:
+        raise ValueError('The scheme must be one of %s' % ', '.join(HASH_SCHEMES))
+    handler = get_crypt_handler(policy['scheme'])
+    if hasattr(handler, 'has_backend') and not handler.has_backend():
+        raise ValueError('No backend is installed for %s' % policy['scheme'])
+    rounds = policy.get('rounds')
+    if rounds is not None:
+        if not isinstance(rounds, int) or isinstance(rounds, bool) or \
+                'rounds' not in handler.setting_kwds:
+            raise ValueError('Invalid rounds for %s' % policy['scheme'])
+        minRounds = (MIN_GENERATED_ROUNDS if generated else MIN_ROUNDS).get(
+            policy['scheme'], handler.min_rounds)
+        if not minRounds <= rounds <= handler.max_rounds:
+            raise ValueError('The rounds of %s must be between %d and %d' %
+                             (policy['scheme'], minRounds, handler.max_rounds))
+
+
+def makeCryptContext(policy):
+    """Returns a CryptContext hashing with <policy>, under which hashes made with other
+    schemes, or other rounds if rounds are set, need to be updated."""
+    scheme = policy['scheme']
+    options = {}
+    if policy.get('rounds') is not None:
+        for option in ('rounds', 'min_rounds', 'max_rounds'):
+            options['%s__%s' % (scheme, option)] = policy['rounds']
+    return CryptContext(schemes=[scheme] + [s for s in HASH_SCHEMES if s != scheme],
+                        default=scheme, deprecated='auto', **options)
 
 
 class Password(AccessControlledModel):
@@ -15,13 +67,29 @@ class Password(AccessControlledModel):
         self.name = 'password'
         self.exposeFields(level=AccessType.READ,
                           fields={'_id', 'userId', 'userName', 'hash', 'lockedUntil',
-                                  'resetOn', 'failedCount'})
+                                  'resetOn', 'failedCount', 'generated'})
         self.itemModel = ModelImporter.model('item')
+        self._contexts = {}
+
+    def getHashingPolicy(self, generated=False):
+        """Returns the configured hashing policy for user-set or generated passwords."""
+        config = Setting().get(PluginSettings.PASSWORD_HASHING) or DEFAULT_HASHING
+        if generated and config.get('generated'):
+            config = config['generated']
+        return {'scheme': config['scheme'], 'rounds': config.get('rounds')}
+
+    def _getContext(self, generated=False):
+        policy = self.getHashingPolicy(generated)
+        key = json.dumps(policy, sort_keys=True)
+        context = self._contexts.get(key)
+        if context is None:
+            context = self._contexts[key] = makeCryptContext(policy)
+        return context
 
     def validate(self, password):
         return password
 
-    def setPassword(self, user, password):
+    def setPassword(self, user, password, generated=False):
         existing = self.findOne({'userId': user['_id']})
         if existing is None:
             existing = {
@@ -30,13 +98,14 @@ class Password(AccessControlledModel):
                 'userName': user['login'],
                 'lockedUntil': Password.NOT_LOCKED,
             }
-        existing['hash'] = pdigest.hash(password)
+        existing['hash'] = self._getContext(generated).hash(password)
+        existing['generated'] = generated
         self.save(existing)
         return existing
 
     def generateAndSetPassword(self, user):
         password = self._generatePassword()
-        self.setPassword(user, password)
+        self.setPassword(user, password, generated=True)
         return {'password': password}
 
     def authenticate(self, username, password):
@@ -45,9 +114,49 @@ class Password(AccessControlledModel):
             self._authenticationFailed()
             raise AccessException('Invalid username/password')
         self._checkLocked(entry)
-        if not pdigest.verify(password, entry['hash']):
+        context = self._getContext(entry.get('generated', False))
+        valid, newHash = context.verify_and_update(password, entry['hash'])
+        if not valid:
             self._authenticationFailed(entry)
             raise AccessException('Invalid username/password')
+        if newHash is not None:
+            # Hashed under a previous policy. Only replace the hash that was verified, in
+            # case the password was changed in the meantime.
+            self.update({'_id': entry['_id'], 'hash': entry['hash']},
+                        {'$set': {'hash': newHash}}, multi=False)
+
+    def benchmark(self, policies=None, samples=3):
+        """
+        Returns how long, in seconds, verifying a password takes with each policy
+        ({'scheme': ..., 'rounds': ...}), averaged over <samples> verifications. By
+        default, the configured policies and the default rounds of each available scheme
+        are measured.
+        """
+        if policies is None:
+            policies = [self.getHashingPolicy(), self.getHashingPolicy(generated=True)]
+            for scheme in HASH_SCHEMES:
+                handler = get_crypt_handler(scheme)
+                if not hasattr(handler, 'has_backend') or handler.has_backend():
+                    policies.append({'scheme': scheme, 'rounds': None})
+        results = []
+        seen = set()
+        for policy in policies:
+            validateHashingPolicy(policy, generated=True)
+            key = json.dumps(policy, sort_keys=True)
+            if key in seen:
+                continue
+            seen.add(key)
+            context = makeCryptContext(policy)
+            hash = context.hash(BENCHMARK_PASSWORD)
+            start = time.perf_counter()
+            for i in range(samples):
+                context.verify(BENCHMARK_PASSWORD, hash)
+            results.append({
+                'scheme': policy['scheme'],
+                'rounds': context.handler().parsehash(hash).get('rounds', policy.get('rounds')),
+                'seconds': (time.perf_counter() - start) / samples
+            })
+        return results
 
     def _checkLocked(self, entry):
         now = datetime.datetime.now()
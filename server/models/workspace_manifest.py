@@ -0,0 +1,195 @@
+import datetime
+import hashlib
+import os
+import re
+
+from girder.models.model_base import Model
+from pymongo import UpdateOne
+
+# Entries of removed files are kept this long so that "what changed since" queries
+# can report removals
+TOMBSTONE_TTL = datetime.timedelta(days=30)
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class WorkspaceManifest(Model):
+    """
+    A listing of the files in the physical directories backing homes, tale workspaces
+    and runs. Each entry holds the (absolute, normalized) path of the directory it
+    belongs to (`root`), the path of the file relative to it, the size, the mtime, an
+    optional sha256 and the time the entry last changed. Removed files are marked as
+    deleted rather than removed for a while.
+    """
+    def initialize(self):
+        self.name = 'workspace_manifest'
+        self.ensureIndices([
+            ([('root', 1), ('path', 1)], {'unique': True}),
+            ([('root', 1), ('updated', 1)], {})
+        ])
+
+    def validate(self, entry):
+        return entry
+
+    def _prefixQuery(self, root, path):
+        query = {'root': os.path.abspath(root)}
+        if path:
+            query['$or'] = [{'path': path},
+                            {'path': {'$regex': '^%s/' % re.escape(path)}}]
+        return query
+
+    def _entryUpdate(self, root, path, st, hash, now):
+        fields = {'size': st.st_size, 'mtime': st.st_mtime, 'deleted': False,
+                  'updated': now}
+        update = {'$set': fields}
+        if hash is None:
+            # the content changed, so any previous hash is stale
+            update['$unset'] = {'hash': ''}
+        else:
+            fields['hash'] = hash
+        return UpdateOne({'root': root, 'path': path}, update, upsert=True)
+
+    def updateFile(self, root, path, hash=None):
+        """Records the current state of file <path> under <root>."""
+        root = os.path.abspath(root)
+        try:
+            st = os.stat(os.path.join(root, path))
+        except FileNotFoundError:
+            return self.markDeleted(root, path)
+        now = datetime.datetime.utcnow()
+        self.collection.bulk_write([self._entryUpdate(root, path, st, hash, now)])
+
+    def markDeleted(self, root, path=''):
+        """Marks <path> under <root>, and anything below it, as deleted."""
+        query = self._prefixQuery(root, path)
+        query['deleted'] = False
+        self.update(query, {'$set': {'deleted': True,
+                                     'updated': datetime.datetime.utcnow()}})
+
+    def removeRoot(self, root):
+        self.collection.delete_many({'root': os.path.abspath(root)})
+
+    def moveRoot(self, old, new):
+        """Moves the entries of <old> and of the directories below it to <new>."""
+        old = os.path.abspath(old)
+        new = os.path.abspath(new)
+        roots = self.collection.distinct(
+            'root', {'root': {'$regex': '^%s(/|$)' % re.escape(old)}})
+        for root in roots:
+            self.update({'root': root}, {'$set': {'root': new + root[len(old):]}})
+
+    def _walk(self, dir, prefix):
+        stack = [(dir, prefix)]
+        while stack:
+            dir, prefix = stack.pop()
+            try:
+                entries = list(os.scandir(dir))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, path + '/'))
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        yield path, entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        pass
+
+    def _hash(self, filePath):
+        h = hashlib.sha256()
+        with open(filePath, 'rb') as f:
+            while True:
+                data = f.read(HASH_BLOCK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+        return h.hexdigest()
+
+    def scan(self, root, path='', computeHash=False):
+        """
+        Brings the entries for <path> under <root> (a file or a directory) up to date
+        with the filesystem. Only files whose size or mtime differ from their entry are
+        written (and, if requested, hashed). Returns the number of changed and removed
+        entries.
+        """
+        root = os.path.abspath(root)
+        known = {}
+        for entry in self.collection.find(self._prefixQuery(root, path),
+                                          {'path': True, 'size': True, 'mtime': True,
+                                           'hash': True, 'deleted': True, '_id': False}):
+            known[entry['path']] = entry
+
+        physicalPath = os.path.join(root, path)
+        if os.path.isdir(physicalPath):
+            found = self._walk(physicalPath, path + '/' if path else '')
+        elif os.path.isfile(physicalPath):
+            found = [(path, os.stat(physicalPath))]
+        else:
+            found = []
+
+        now = datetime.datetime.utcnow()
+        ops = []
+        changed = 0
+        for filePath, st in found:
+            entry = known.pop(filePath, None)
+            if entry is not None and not entry['deleted'] and entry['size'] == st.st_size \
+                    and entry['mtime'] == st.st_mtime \
+                    and (entry.get('hash') is not None or not computeHash):
+                continue
+            hash = None
+            if computeHash:
+                try:
+                    hash = self._hash(os.path.join(root, filePath))
+                except OSError:
+                    continue
+            ops.append(self._entryUpdate(root, filePath, st, hash, now))
+            changed += 1
+            if len(ops) >= 1000:
+                self.collection.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+
+        removed = [p for p, entry in known.items() if not entry['deleted']]
+        for i in range(0, len(removed), 1000):
+            self.update({'root': root, 'path': {'$in': removed[i:i + 1000]}},
+                        {'$set': {'deleted': True, 'updated': now}})
+        self.collection.delete_many({'root': root, 'deleted': True,
+                                     'updated': {'$lt': now - TOMBSTONE_TTL}})
+        return {'changed': changed, 'removed': len(removed)}
+
+    def list(self, root, since=None, limit=0, offset=0, sort=None):
+        """Lists current files under <root> or, if <since> is given, the entries that
+        changed after that time, including removed files."""
+        query = {'root': os.path.abspath(root)}
+        if since is None:
+            query['deleted'] = False
+        else:
+            query['updated'] = {'$gt': since}
+        return self.find(query, limit=limit, offset=offset, sort=sort or [('path', 1)],
+                         fields={'_id': False, 'root': False})
+
+    def changes(self, root, path='', since=None, recursive=True):
+        """Lists the paths of the files below directory <path> under <root> (only those
+        directly in it unless <recursive>) whose entry changed after <since>, with
+        "deleted" set for removed files, or, without <since>, those of the current files.
+        """
+        pattern = '^' + (re.escape(path + '/') if path else '')
+        if not recursive:
+            pattern += '[^/]+$'
+        query = {'root': os.path.abspath(root), 'path': {'$regex': pattern}}
+        if since is None:
+            query['deleted'] = False
+        else:
+            query['updated'] = {'$gt': since}
+        return self.collection.find(query, {'path': True, 'deleted': True, '_id': False},
+                                    sort=[('path', 1)])
+
+    def getSize(self, root):
+        result = list(self.collection.aggregate([
+            {'$match': {'root': os.path.abspath(root), 'deleted': False}},
+            {'$group': {'_id': None, 'files': {'$sum': 1}, 'size': {'$sum': '$size'}}}
+        ]))
+        if not result:
+            return {'files': 0, 'size': 0}
+        return {'files': result[0]['files'], 'size': result[0]['size']}
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from girder.api.rest import Resource
+import json
+
+from girder.api.rest import Resource, RestException
 from girder.constants import AccessType
 from girder.api import access
 from girder.api.describe import Description, describeRoute
 
+MAX_BENCHMARK_SAMPLES = 10
+
 
 class Homedirpass(Resource):
     def initialize(self):
@@ -31,3 +35,27 @@ class Homedirpass(Resource):
     def generatePassword(self, params):
         user = self.getCurrentUser()
         return self.model('password', 'wt_home_dir').generateAndSetPassword(user)
+
+    @access.admin
+    @describeRoute(
+        Description('Measures how long verifying a password takes with each hashing scheme.')
+        .param('policies', 'A JSON list of {"scheme": ..., "rounds": ...} objects. Defaults '
+               'to the configured policies and the default rounds of each available '
+               'scheme.', required=False)
+        .param('samples', 'The number of verifications to average over.', required=False,
+               dataType='integer', default=3)
+    )
+    def benchmark(self, params):
+        try:
+            policies = json.loads(params['policies']) if params.get('policies') else None
+            samples = int(params.get('samples', 3))
+        except ValueError:
+            raise RestException('Invalid policies or samples')
+        if policies is not None and not isinstance(policies, list):
+            raise RestException('Policies must be a list')
+        if not 1 <= samples <= MAX_BENCHMARK_SAMPLES:
+            raise RestException('Samples must be between 1 and %d' % MAX_BENCHMARK_SAMPLES)
+        try:
+            return self.model('password', 'wt_home_dir').benchmark(policies, samples)
+        except ValueError as ex:
+            raise RestException(str(ex))
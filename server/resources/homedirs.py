@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import dateutil.parser
+import threading
+import time
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from girder.api.rest import Resource, RestException, loadmodel
+from girder.constants import AccessType
+from girder.api import access
+from girder.api.describe import Description, describeRoute
+from girder import logger
+from girder.utility.progress import ProgressContext
+
+from ..constants import PluginSettings, SHARDING_POLL_INTERVAL
+from ..lib.IOAccountant import IOAccountant, COUNTERS, KINDS, WINDOW_BUCKETS
+from ..lib.Onboarder import Onboarder
+from ..lib.OrphanScanner import OrphanScanner, DEFAULT_MIN_AGE
+from ..lib.PathMapper import parseSharding, configureSharding
+from ..lib.RunsProvisioner import RunsProvisioner
+from ..lib.ShardingMigrator import ShardingMigrator
+from ..lib.WorkspaceIndexer import WorkspaceIndexer
+
+# Upper bound on the number of runs provisioned in one call
+MAX_PROVISIONED_RUNS = 1000
+# Upper bound on the number of users, and of tales, onboarded in one call
+MAX_ONBOARDED = 5000
+# Directories are only moved to a new sharding scheme once all server processes had time
+# to pick it up, and with it the previous scheme to fall back to
+ADOPTION_DELAY = 2 * SHARDING_POLL_INTERVAL
+
+
+class Homedirs(Resource):
+    # realm -> status of the last sharding migration started by this process
+    migrations = {}
+    migrationsLock = threading.Lock()
+
+    def __init__(self, apps):
+        super().__init__()
+        self.resourceName = 'homedirs'
+        self.apps = apps
+        self.indexer = WorkspaceIndexer()
+
+    def _getRoot(self, folder):
+        if not folder.get('isMapping') or 'fsPath' not in folder:
+            raise RestException('Folder %s is not mapped to a directory' % folder['_id'])
+        return folder['fsPath']
+
+    @access.user
+    @loadmodel(model='folder', level=AccessType.READ)
+    @describeRoute(
+        Description('List the files in a mapped folder (home or tale workspace), or the '
+                    'changes since a given time.')
+        .notes('Entries are read from the manifest maintained by the indexer, so the '
+               'directory is not listed. Changes include removed files, with '
+               '"deleted" set.')
+        .param('id', 'The ID of the folder.', paramType='path')
+        .param('since', 'Only return entries that changed after this time (ISO 8601).',
+               required=False)
+        .pagingParams(defaultSort='path')
+    )
+    def getManifest(self, folder, params):
+        root = self._getRoot(folder)
+        limit, offset, sort = self.getPagingParameters(params, 'path')
+        since = None
+        if params.get('since'):
+            try:
+                since = dateutil.parser.parse(params['since'])
+            except ValueError:
+                raise RestException('Invalid date: %s' % params['since'])
+        return list(self.model('workspace_manifest', 'wt_home_dir').list(
+            root, since=since, limit=limit, offset=offset, sort=sort))
+
+    @access.user
+    @loadmodel(model='folder', level=AccessType.READ)
+    @describeRoute(
+        Description('Get the number of files in a mapped folder and their total size.')
+        .param('id', 'The ID of the folder.', paramType='path')
+    )
+    def getSize(self, folder, params):
+        result = self.model('workspace_manifest', 'wt_home_dir').getSize(self._getRoot(folder))
+        result['scanned'] = folder.get('wtManifestScanned')
+        return result
+
+    @access.user
+    @loadmodel(model='folder', level=AccessType.WRITE)
+    @describeRoute(
+        Description('Update the manifest of a mapped folder from the filesystem.')
+        .param('id', 'The ID of the folder.', paramType='path')
+        .param('hash', 'Whether to compute checksums of new and changed files.',
+               dataType='boolean', required=False, default=False)
+    )
+    def rescan(self, folder, params):
+        self._getRoot(folder)
+        return self.indexer.rescan(folder, computeHash=self.boolParam('hash', params, False))
+
+    @access.user
+    @describeRoute(
+        Description('Prepare the runs realm for a batch of new runs.')
+        .notes('Creates the run directories and caches what the first WebDAV requests for '
+               'the runs would otherwise have to look up. Meant to be called when runs '
+               'are created.')
+        .param('ids', 'JSON list of run folder IDs.', required=True)
+        .errorResponse('Write access was denied on a run folder.', 403)
+    )
+    def provisionRuns(self, params):
+        try:
+            entry = self.apps.getApp('runs')
+        except KeyError:
+            raise RestException('The runs realm is not enabled')
+        try:
+            ids = [ObjectId(id) for id in self.getParamJson('ids', params)]
+        except (TypeError, InvalidId):
+            raise RestException('Invalid run IDs')
+        if len(ids) > MAX_PROVISIONED_RUNS:
+            raise RestException('At most %d runs can be provisioned at once'
+                                % MAX_PROVISIONED_RUNS)
+        user = self.getCurrentUser()
+        folderModel = self.model('folder')
+        runs = list(folderModel.find({'_id': {'$in': ids}}))
+        for run in runs:
+            folderModel.requireAccess(run, user=user, level=AccessType.WRITE)
+        provisioner = RunsProvisioner(entry.app.config['wt_home_dirs_root'])
+        return {'provisioned': provisioner.provision(runs)}
+
+    @access.admin
+    @describeRoute(
+        Description('Map the Home folders of many users, or the workspaces of many tales, '
+                    'at once.')
+        .notes('For users and tales imported without the usual per-user and per-tale '
+               'mapping (see deferredMapping() in the plugin). Users and tales that are '
+               'already mapped are skipped.')
+        .param('users', 'JSON list of user IDs.', required=False)
+        .param('tales', 'JSON list of tale IDs.', required=False)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def onboard(self, params):
+        ids = {}
+        for name in ('users', 'tales'):
+            try:
+                ids[name] = [ObjectId(id) for id in self.getParamJson(name, params, [])]
+            except (TypeError, InvalidId):
+                raise RestException('Invalid %s IDs' % name[:-1])
+            if len(ids[name]) > MAX_ONBOARDED:
+                raise RestException('At most %d %s can be onboarded at once' %
+                                    (MAX_ONBOARDED, name))
+        settingModel = self.model('setting')
+        onboarder = Onboarder(settingModel.get(PluginSettings.HOME_DIRS_ROOT),
+                              settingModel.get(PluginSettings.TALE_DIRS_ROOT))
+        users = self.model('user').find({'_id': {'$in': ids['users']}}, fields=['login'])
+        tales = self.model('tale', 'wholetale').find({'_id': {'$in': ids['tales']}})
+        return {
+            'users': onboarder.provisionUsers(users) if ids['users'] else None,
+            'tales': onboarder.provisionTales(tales) if ids['tales'] else None
+        }
+
+    @access.admin
+    @describeRoute(
+        Description('Get the sharding scheme of each realm, and the status of the last '
+                    'migration to a new scheme started by this server process.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getSharding(self, params):
+        result = {}
+        for realm in ('homes', 'tales', 'runs'):
+            try:
+                pathMapper = self.apps.getApp(realm).pathMapper
+            except KeyError:
+                continue
+            previous = pathMapper.previousSharding
+            result[realm] = {
+                'scheme': str(pathMapper.sharding),
+                'previous': str(previous) if previous is not None else None,
+                'migration': self.migrations.get(realm)
+            }
+        return result
+
+    @access.admin
+    @describeRoute(
+        Description('Change the sharding scheme of a realm and move the existing '
+                    'directories to match.')
+        .notes('The new scheme is published first, along with the current one, which '
+               'all server processes keep looking directories up with until they are '
+               'moved. The directories are then moved in the background, once the '
+               'other processes had time to pick up the change; the returned status '
+               'is also reported by GET /homedirs/sharding. Directories that already '
+               'exist at their new location are reported as conflicts, in which case '
+               'the migration can be resumed by calling this again with the same '
+               'scheme.')
+        .param('realm', 'The realm (homes, tales or runs).', required=True)
+        .param('scheme', 'The new scheme: "prefix:<n>" (directories named by the first n '
+               'characters of the login or ID) or "hash:<levels>:<width>" (levels of '
+               'directories named by successive groups of <width> hex digits of the sha1 '
+               'of the login or ID).', required=True)
+        .param('progress', 'Whether to record progress on the migration.',
+               dataType='boolean', required=False, default=False)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def setSharding(self, params):
+        self.requireParams(('realm', 'scheme'), params)
+        realm = params['realm']
+        try:
+            entry = self.apps.getApp(realm)
+        except KeyError:
+            raise RestException('Unknown or disabled realm: %s' % realm)
+        try:
+            new = parseSharding(params['scheme'])
+        except ValueError as ex:
+            raise RestException(str(ex))
+        pathMapper = entry.pathMapper
+        with self.migrationsLock:
+            status = self.migrations.get(realm)
+            if status is not None and status['status'] in ('waiting', 'running'):
+                raise RestException('The sharding of %s is being changed' % realm)
+            config = dict(self.model('setting').get(PluginSettings.SHARDING))
+            old = pathMapper.previousSharding
+            if old is None:
+                old = pathMapper.sharding
+                published = None
+            elif str(new) != str(pathMapper.sharding):
+                raise RestException('The migration from %s to %s has not completed' %
+                                    (old, pathMapper.sharding))
+            else:
+                # resuming: the schemes were published when the migration started
+                published = config.get(realm, {}).get('published', 0)
+            if str(old) == str(new):
+                return {'scheme': str(new), 'previous': None, 'status': 'done', 'moved': 0,
+                        'folders': 0, 'conflicts': []}
+
+            if published is None:
+                published = time.time()
+                config[realm] = {'scheme': str(new), 'previous': str(old),
+                                 'published': published}
+                self.model('setting').set(PluginSettings.SHARDING, config)
+                configureSharding(config)
+            status = self.migrations[realm] = {
+                'scheme': str(new), 'previous': str(old), 'status': 'waiting',
+                'startsAt': published + ADOPTION_DELAY}
+        migrator = ShardingMigrator(entry.app.config['wt_home_dirs_root'], pathMapper, old, new)
+        threading.Thread(target=self._migrate, name='wt_home_dirs sharding (%s)' % realm,
+                         args=(realm, migrator, status, self.getCurrentUser(),
+                               self.boolParam('progress', params, False)),
+                         daemon=True).start()
+        return status
+
+    def _migrate(self, realm, migrator, status, user, progress):
+        delay = status['startsAt'] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        status['status'] = 'running'
+        try:
+            with ProgressContext(progress, user=user,
+                                 title='Changing the sharding of %s' % realm) as ctx:
+                result = migrator.migrate(ctx)
+        except Exception:
+            logger.exception('Changing the sharding of %s failed' % realm)
+            status['status'] = 'failed'
+            return
+        if not result['conflicts']:
+            config = dict(self.model('setting').get(PluginSettings.SHARDING))
+            config[realm] = {'scheme': status['scheme']}
+            self.model('setting').set(PluginSettings.SHARDING, config)
+            configureSharding(config)
+        status.update(result, status='done')
+
+    def _getOrphanScanner(self, realm):
+        try:
+            entry = self.apps.getApp(realm)
+        except KeyError:
+            raise RestException('Unknown or disabled realm: %s' % realm)
+        if entry.pathMapper.previousSharding is not None:
+            raise RestException('The sharding of %s is being changed' % realm)
+        return OrphanScanner(entry.app.config['wt_home_dirs_root'], entry.pathMapper)
+
+    @access.admin
+    @describeRoute(
+        Description('Find the directories of a realm that no Girder user, tale or run '
+                    'folder owns anymore, and the mapped folders whose directory is '
+                    'missing.')
+        .notes('Orphans are reported with the number and total size of their files, '
+               'dangling folders with what the workspace manifest recorded for them. '
+               'Nothing is changed.')
+        .param('realm', 'The realm (homes, tales or runs).', required=True)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def scanOrphans(self, params):
+        self.requireParams(('realm',), params)
+        return self._getOrphanScanner(params['realm']).scan()
+
+    @access.admin
+    @describeRoute(
+        Description('Move the orphaned directories of a realm to its trash.')
+        .notes('Orphans are found as with GET /homedirs/orphans and moved to '
+               '<root>/.trash/<time>, from which they can be restored or deleted. Orphans '
+               'modified recently are left alone.')
+        .param('realm', 'The realm (homes, tales or runs).', required=True)
+        .param('minAge', 'Only move orphans not modified in this many seconds.',
+               dataType='integer', required=False, default=DEFAULT_MIN_AGE)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def reclaimOrphans(self, params):
+        self.requireParams(('realm',), params)
+        try:
+            minAge = int(params.get('minAge', DEFAULT_MIN_AGE))
+        except ValueError:
+            raise RestException('Invalid minAge')
+        scanner = self._getOrphanScanner(params['realm'])
+        result = scanner.scan()
+        result.update(scanner.reclaim(result['orphans'], minAge=minAge))
+        return result
+
+    @access.admin
+    @describeRoute(
+        Description('List the users (or tales or runs) doing the most I/O through WebDAV, '
+                    'and the users whose clients were flagged as misbehaving.')
+        .notes('Statistics are kept in memory by each server process over the last hour; '
+               'only those of the process answering this request are returned. Clients '
+               'are flagged for PROPFIND loops, recursive PROPFIND requests and slow '
+               'transfers.')
+        .param('kind', 'What to list the statistics of.', required=False, default='user',
+               enum=list(KINDS))
+        .param('sort', 'The counter to sort by.', required=False, default='wallTime',
+               enum=list(COUNTERS))
+        .param('limit', 'The number of entries to return.', dataType='integer',
+               required=False, default=10)
+        .param('minutes', 'The length of the window, in minutes.', dataType='integer',
+               required=False, default=5)
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getIOStats(self, params):
+        kind = params.get('kind', 'user')
+        sort = params.get('sort', 'wallTime')
+        if kind not in KINDS:
+            raise RestException('Invalid kind: %s' % kind)
+        if sort not in COUNTERS:
+            raise RestException('Invalid sort counter: %s' % sort)
+        try:
+            limit = int(params.get('limit', 10))
+            minutes = int(params.get('minutes', 5))
+        except ValueError:
+            raise RestException('Invalid limit or minutes')
+        if limit < 1 or not 1 <= minutes <= WINDOW_BUCKETS:
+            raise RestException('limit must be positive and minutes between 1 and %d'
+                                % WINDOW_BUCKETS)
+        accounting = IOAccountant.accounting
+        return {
+            'top': accounting.top(kind, sort, limit, minutes),
+            'flagged': accounting.flagged(minutes)
+        }